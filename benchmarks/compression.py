@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: compression.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+"""Times writing and reading reduced frames as plain FITS and as tile-compressed FITS.
+
+    python benchmarks/compression.py --sizes 1024 2048 --frames 5 --output compression.json
+
+Each format (plain FITS, lossless, and quantized at each --quantize-levels) is timed writing the
+frames, reading them whole, and reading only a stamp around every star, which of a compressed
+file only decompresses the tiles under the stamps. The size on disk and the largest error of the
+quantized frames (in units of their noise) are saved along with the throughputs as JSON.
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ccd'))
+
+from frames import image_hdu, open_frame, read_frame, read_section, write_frame
+from run_benchmarks import measure
+from science import CalibrationContext, reduce_science_data
+from synthetic import make_night
+
+# Side of the stamps read around each star, in pixels
+STAMP_SIZE = 35
+
+
+def reduced_frames(directory, size, n_frames, trim=100):
+    "Makes a synthetic night and returns its reduced science frames (with their headers) and the star positions"
+
+    from bias import create_median_bias
+    from darks import create_median_dark
+    from flats import create_median_flat
+
+    night = make_night(directory, size=size, n_bias=3, n_dark=3, n_flat=3, n_science=n_frames, trim=trim)
+
+    masters = [os.path.join(directory, f"Median-{name}.fits") for name in ('Bias', 'AutoFlat', 'Dark')]
+    create_median_bias(night['bias'], masters[0], trim=trim)
+    create_median_dark(night['dark'], masters[0], masters[2], trim=trim)
+    create_median_flat(night['flat'], masters[0], masters[1], masters[2], trim=trim)
+
+    calibration = CalibrationContext(*masters)
+    frames = [reduce_science_data(filename, calibration, cosmic_rays='off', trim=trim) for filename in night['science']]
+
+    return frames, list(zip(night['x_positions'], night['y_positions']))
+
+
+def benchmark_format(directory, frames, positions, output_format, quantize_level=None, repeat=3):
+    "Times writing, reading and reading stamps of the frames in one format, returning the results of each"
+
+    filenames = [os.path.join(directory, f"frame{i}.fits") for i in range(len(frames))]
+    n_pixels = frames[0][0].size
+    half = STAMP_SIZE // 2
+
+    def write():
+        for filename, (data, header) in zip(filenames, frames):
+            write_frame(filename, data, header, output_format, quantize_level)
+
+    def read():
+        for filename in filenames:
+            read_frame(filename, trim=0)
+
+    def read_stamps():
+        for filename in filenames:
+            with open_frame(filename) as hdul:
+                hdu = image_hdu(hdul)
+                for x, y in positions:
+                    read_section(hdu, slice(max(int(y) - half, 0), int(y) + half + 1),
+                                 slice(max(int(x) - half, 0), int(x) + half + 1))
+
+    results = dict()
+    for operation, function in (('write', write), ('read', read), ('stamps', read_stamps)):
+        results[operation] = measure(function, len(frames), n_pixels, repeat=repeat, trace_memory=False)
+
+    # Largest difference with the original frames, relative to their noise
+    errors = []
+    for filename, (data, header) in zip(filenames, frames):
+        noise = 1.4826 * numpy.median(numpy.abs(data - numpy.median(data)))
+        errors.append(numpy.abs(read_frame(filename, trim=0)[0] - data).max() / noise)
+
+    results['bytes'] = sum(os.path.getsize(filename) for filename in filenames)
+    results['max_error_sigma'] = float(max(errors))
+
+    return results
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048], help="raw frame sizes (pixels per side)")
+    parser.add_argument('--frames', type=int, default=5, help="number of science frames")
+    parser.add_argument('--quantize-levels', type=float, nargs='+', default=[4, 16],
+                        help="quantization levels of the lossy frames")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each operation, of which the fastest is kept")
+    parser.add_argument('--output', default='compression-results.json', help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    formats = [('fits', None), ('compressed', None)] + [('compressed', level) for level in args.quantize_levels]
+
+    results = []
+    print(f"{'format':>14} {'size':>6} {'ratio':>6} {'write MPix/s':>13} {'read MPix/s':>12} {'stamps frames/s':>16} "
+          f"{'error':>7}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            frames, positions = reduced_frames(directory, size, args.frames)
+
+            plain_bytes = None
+            for output_format, quantize_level in formats:
+                name = output_format if quantize_level is None else f"quantized-{quantize_level:g}"
+                result = benchmark_format(directory, frames, positions, output_format, quantize_level, args.repeat)
+                plain_bytes = plain_bytes or result['bytes']
+
+                results.append({'format': name, 'size': size, 'frames': args.frames, **result})
+                print(f"{name:>14} {size:>6} {plain_bytes / result['bytes']:6.2f} "
+                      f"{result['write']['mpix_per_second']:13.1f} {result['read']['mpix_per_second']:12.1f} "
+                      f"{result['stamps']['frames_per_second']:16.1f} {result['max_error_sigma']:7.3f}")
+
+    output = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
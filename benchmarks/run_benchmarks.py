@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: run_benchmarks.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+"""Times every stage of the reduction on synthetic nights of several sizes.
+
+    python benchmarks/run_benchmarks.py --sizes 512 1024 --frames 5 --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json
+
+The results (seconds, frames/s, MPix/s and peak memory of each stage at each size) are written
+as JSON, and compared with a baseline results file if one is given, to show speedups and catch
+regressions. Everything runs offline on data made by synthetic.make_night.
+
+Only entry points that exist in the first version of src/ccd are required, so the same script
+can time a checkout of it (with --src) to give the baseline:
+
+    python benchmarks/run_benchmarks.py --src /path/to/old/src/ccd --output baseline.json
+
+Stages use the faster entry points of later versions when they are there: the science frames are
+reduced with a CalibrationContext, and the centroids and photometry measured on the frames in
+memory instead of reading them again.
+
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from astropy.io import fits
+import matplotlib
+matplotlib.use('Agg')
+import numpy
+
+# Stages that are timed, in the order they run
+STAGES = ('bias', 'dark', 'flat', 'science', 'centroid', 'photometry', 'period')
+
+# Pixels trimmed from each edge of the frames, which the first version always does
+TRIM = 100
+
+# Sources of the package that are timed, which can be changed with --src
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ccd')
+
+
+def measure(function, n_frames, n_pixels=None, repeat=3, trace_memory=True, warmup=True):
+    """Runs function repeat times and returns its best time, throughput (frames/s and MPix/s of
+    n_frames frames of n_pixels pixels) and peak memory. The peak is what tracemalloc sees being
+    allocated (numpy arrays included) during the first run; it is left out with trace_memory=False,
+    since tracing slows pure Python code down a little. With warmup, function is run once more
+    before, untimed, so that lazy imports (e.g. of photutils) and first-call caches aren't timed."""
+
+    peak_memory = None
+    seconds = numpy.inf
+
+    if warmup:
+        function()
+
+    for i in range(repeat):
+        gc.collect()
+        if trace_memory and i == 0:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+
+        if tracemalloc.is_tracing():
+            peak_memory = tracemalloc.get_traced_memory()[1] / 1024**2
+            tracemalloc.stop()
+
+    return {
+        'seconds': seconds,
+        'frames_per_second': n_frames / seconds,
+        'mpix_per_second': n_frames * n_pixels / 1e6 / seconds if n_pixels else None,
+        'peak_memory_mb': peak_memory,
+        # ru_maxrss is in kB on Linux and only ever grows, so it is the peak of the whole run so far
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def benchmark_night(directory, size, n_frames, stages=STAGES, repeat=3, trace_memory=True, warmup=True,
+                    light_curve_points=2000):
+    """Makes a synthetic night of n_frames frames of each type and times each of the stages on it,
+    with the functions of the package in SOURCE_DIR (which must be on sys.path)"""
+
+    from analysis import determine_period
+    from bias import create_median_bias
+    from darks import create_median_dark
+    from flats import create_median_flat
+    from photometry import do_aperture_photometry
+    from science import reduce_science_frame
+    from synthetic import make_night
+
+    night = make_night(directory, size=size, n_bias=n_frames, n_dark=n_frames, n_flat=n_frames,
+                       n_science=n_frames, trim=TRIM)
+    n_pixels = (size - 2 * TRIM)**2
+
+    median_bias_filename = os.path.join(directory, 'Median-Bias.fits')
+    median_dark_filename = os.path.join(directory, 'Median-Dark.fits')
+    median_flat_filename = os.path.join(directory, 'Median-AutoFlat.fits')
+    reduced_filenames = [os.path.join(directory, f'reduced_science{i+1}.fits') for i in range(n_frames)]
+    positions = list(zip(night['x_positions'], night['y_positions']))
+
+    try:
+        from science import CalibrationContext
+    except ImportError:
+        # The first version reads the masters again for each frame
+        def science():
+            for science_filename, reduced_filename in zip(night['science'], reduced_filenames):
+                reduce_science_frame(science_filename, median_bias_filename, median_flat_filename,
+                                     median_dark_filename, reduced_filename)
+    else:
+        def science():
+            calibration = CalibrationContext(median_bias_filename, median_flat_filename, median_dark_filename)
+            buffer = None
+            for science_filename, reduced_filename in zip(night['science'], reduced_filenames):
+                buffer = reduce_science_frame(science_filename, calibration, reduced_science_filename=reduced_filename,
+                                              out=buffer)
+
+    reduced = []
+
+    try:
+        from registration import centroid_cutouts
+    except ImportError:
+        # The first version centroids the whole frame, as its diff_photometry script does
+        from photutils.centroids import centroid_quadratic, centroid_sources
+
+        def centroid():
+            for data in reduced:
+                centroid_sources(data - numpy.median(data), xpos=night['x_positions'], ypos=night['y_positions'],
+                                 box_size=35, centroid_func=centroid_quadratic)
+    else:
+        def centroid():
+            for data in reduced:
+                centroid_cutouts(data, night['x_positions'], night['y_positions'])
+
+    try:
+        from photometry import measure_apertures  # noqa: F401 (only there once frames can be measured in memory)
+    except ImportError:
+        # The first version only takes filenames, and reads each frame again
+        def photometry():
+            for filename in reduced_filenames:
+                do_aperture_photometry(filename, positions, [5, 10, 15], 18, 4)
+    else:
+        def photometry():
+            for data in reduced:
+                do_aperture_photometry(data, positions, [5, 10, 15], 18, 4)
+
+    # A noisy sinusoid sampled unevenly, like a night of observations (times in minutes)
+    rng = numpy.random.default_rng(0)
+    times = numpy.sort(rng.uniform(0, 600, light_curve_points))
+    fluxes = 1 + 0.1 * numpy.sin(2 * numpy.pi * times / 150) + rng.normal(0, 0.01, light_curve_points)
+
+    def period():
+        # determine_period saves its plot to figures/, so it runs in the night's directory
+        cwd = os.getcwd()
+        os.makedirs(os.path.join(directory, 'figures'), exist_ok=True)
+        os.chdir(directory)
+        try:
+            determine_period(times, fluxes)
+        finally:
+            os.chdir(cwd)
+
+    # The masters are made with the default trim, which is TRIM
+    functions = {
+        'bias': (lambda: create_median_bias(night['bias'], median_bias_filename), n_frames),
+        'dark': (lambda: create_median_dark(night['dark'], median_bias_filename, median_dark_filename), n_frames),
+        'flat': (lambda: create_median_flat(night['flat'], median_bias_filename, median_flat_filename,
+                                            median_dark_filename), n_frames),
+        'science': (science, n_frames),
+        'centroid': (centroid, n_frames),
+        'photometry': (photometry, n_frames),
+        'period': (period, light_curve_points),
+    }
+
+    results = []
+    for stage in STAGES:
+        # The masters and reduced frames are made even if their stage isn't timed, since later stages need them
+        if stage not in stages:
+            if stage in ('bias', 'dark', 'flat', 'science'):
+                functions[stage][0]()
+        else:
+            function, n_items = functions[stage]
+            # The light curve has points instead of frames
+            result = measure(function, n_items, n_pixels if stage != 'period' else None, repeat, trace_memory,
+                             warmup)
+            results.append({'stage': stage, 'size': size, 'frames': n_items, **result})
+            print(f"{stage:>10} {size:>6} {n_items:>6} {result['seconds']:9.3f} s "
+                  f"{result['frames_per_second']:9.2f} frames/s {result['mpix_per_second'] or 0:9.2f} MPix/s")
+
+        if stage == 'science':
+            reduced = [fits.getdata(filename) for filename in reduced_filenames]
+
+    return results
+
+
+def result_key(result):
+    return result['stage'], result['size'], result['frames']
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Prints the speedup of each stage over the baseline results and returns the stages that are
+    more than tolerance (a fraction) slower"""
+
+    baseline_results = {result_key(result): result for result in baseline['results']}
+    regressions = []
+
+    print(f"\n{'stage':>10} {'size':>6} {'frames':>6} {'baseline':>10} {'now':>10} {'speedup':>8}")
+    for result in results:
+        before = baseline_results.get(result_key(result))
+        if before is None:
+            continue
+
+        speedup = before['seconds'] / result['seconds']
+        print(f"{result['stage']:>10} {result['size']:>6} {result['frames']:>6} {before['seconds']:9.3f}s "
+              f"{result['seconds']:9.3f}s {speedup:7.2f}x")
+
+        if speedup < 1 / (1 + tolerance):
+            regressions.append(result_key(result))
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024], help="raw frame sizes (pixels per side)")
+    parser.add_argument('--frames', type=int, nargs='+', default=[5], help="number of frames of each type")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--light-curve-points', type=int, default=2000, help="points of the light curve for 'period'")
+    parser.add_argument('--output', default='benchmark-results.json', help="JSON file to write the results to")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="slowdown over the baseline counted as a regression")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each stage, of which the fastest is kept")
+    parser.add_argument('--no-memory', action='store_true', help="don't trace the peak memory of each stage")
+    parser.add_argument('--no-warmup', action='store_true',
+                        help="don't run each stage once untimed before timing it (which halves the run time)")
+    parser.add_argument('--src', default=SOURCE_DIR, help="directory of the package to time, e.g. an older checkout")
+    parser.add_argument('--keep', help="directory to keep the synthetic data in, instead of a temporary one")
+    args = parser.parse_args(argv)
+
+    # The baseline is read before anything runs, and never overwritten by the results
+    baseline = None
+    if args.baseline:
+        if os.path.abspath(args.baseline) == os.path.abspath(args.output):
+            parser.error(f"--output and --baseline are both {args.output}, give another --output for the results")
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    # The package is imported from --src, and synthetic from next to this script
+    sys.path[:0] = [os.path.abspath(args.src), os.path.dirname(os.path.abspath(__file__))]
+
+    results = []
+    for size in args.sizes:
+        for n_frames in args.frames:
+            with tempfile.TemporaryDirectory() as directory:
+                if args.keep:
+                    directory = os.path.join(args.keep, f'{size}-{n_frames}')
+                results += benchmark_night(directory, size, n_frames, args.stages, repeat=args.repeat,
+                                           trace_memory=not args.no_memory, warmup=not args.no_warmup,
+                                           light_curve_points=args.light_curve_points)
+
+    output = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression: {} at size {} with {} frames".format(*regression))
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: synthetic.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import os
+
+from astropy.io import fits
+import numpy
+
+# Levels of the synthetic detector, in ADU
+BIAS_LEVEL = 1000
+READ_NOISE = 5
+DARK_CURRENT = 0.05  # ADU / s
+SKY_LEVEL = 100  # ADU / s
+FLAT_LEVEL = 20000  # ADU
+
+
+def write_frame(filename, data, **keywords):
+    "Writes data as a uint16 FITS file (like the camera does), with the given header keywords"
+
+    header = fits.Header()
+    for key, value in keywords.items():
+        header[key] = value
+
+    data = numpy.clip(numpy.round(data), 0, 65535).astype('u2')
+    fits.PrimaryHDU(data=data, header=header).writeto(filename, overwrite=True)
+
+
+def add_stars(data, positions, fluxes, fwhm=4):
+    "Adds Gaussian stars of total flux fluxes at positions, a list of (x, y) tuples, to data"
+
+    sigma = fwhm / 2.355
+    half_size = int(5 * sigma) + 1
+
+    for (x, y), flux in zip(positions, fluxes):
+        x0, y0 = int(round(x)), int(round(y))
+        rows = slice(max(y0 - half_size, 0), min(y0 + half_size + 1, data.shape[0]))
+        columns = slice(max(x0 - half_size, 0), min(x0 + half_size + 1, data.shape[1]))
+        yy, xx = numpy.mgrid[rows, columns]
+        data[rows, columns] += flux / (2 * numpy.pi * sigma**2) * numpy.exp(-((xx - x)**2 + (yy - y)**2) / (2 * sigma**2))
+
+
+def make_night(
+    directory,
+    size=1024,
+    n_bias=5,
+    n_dark=5,
+    n_flat=5,
+    n_science=5,
+    n_stars=20,
+    n_cosmic_rays=50,
+    trim=100,
+    seed=0,
+):
+    """Writes a synthetic night of size x size raw frames to directory, named like the real data
+    (Bias*, Dark*, domeflat*, LPSEB*), so that it can be reduced by run_reduction.
+
+    - The science frames have n_stars Gaussian stars that drift by about a pixel per frame, n_cosmic_rays
+      hot pixels and JD-OBS one minute apart. The flats have a vignetting pattern and Poisson noise.
+    - Return a dictionary with the lists of files ('bias', 'dark', 'flat', 'science') and the star
+      positions in the first science frame, in trimmed coordinates ('x_positions', 'y_positions').
+
+    """
+
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    yy, xx = numpy.mgrid[:size, :size]
+    files = {'bias': [], 'dark': [], 'flat': [], 'science': []}
+
+    def noise():
+        return BIAS_LEVEL + rng.normal(0, READ_NOISE, (size, size))
+
+    for i in range(n_bias):
+        files['bias'].append(os.path.join(directory, f"Bias{i:03d}.fits"))
+        write_frame(files['bias'][-1], noise(), EXPTIME=0.0)
+
+    for i in range(n_dark):
+        files['dark'].append(os.path.join(directory, f"Dark{i:03d}.fits"))
+        write_frame(files['dark'][-1], noise() + rng.poisson(DARK_CURRENT * 60, (size, size)), EXPTIME=60.0)
+
+    vignetting = 1 - 0.2 * ((xx - size / 2)**2 + (yy - size / 2)**2) / size**2
+    for i in range(n_flat):
+        exptime = 5.0 + i
+        files['flat'].append(os.path.join(directory, f"domeflat{i:03d}.fits"))
+        write_frame(files['flat'][-1], noise() + rng.poisson(FLAT_LEVEL * exptime / 10, (size, size)) * vignetting,
+                    EXPTIME=exptime)
+
+    # Stars away from the trimmed edges, with a range of brightness
+    margin = trim + 40
+    x_positions = rng.uniform(margin, size - margin, n_stars)
+    y_positions = rng.uniform(margin, size - margin, n_stars)
+    fluxes = 10**rng.uniform(4, 6, n_stars)
+
+    for i in range(n_science):
+        exptime = 30.0
+        data = noise() + rng.poisson((SKY_LEVEL + DARK_CURRENT) * exptime, (size, size)) * vignetting
+        dx, dy = rng.normal(i, 0.5, 2)
+        add_stars(data, zip(x_positions + dx, y_positions + dy), fluxes)
+        data[rng.integers(0, size, n_cosmic_rays), rng.integers(0, size, n_cosmic_rays)] = 30000
+
+        files['science'].append(os.path.join(directory, f"LPSEB{i:03d}.fits"))
+        write_frame(files['science'][-1], data, EXPTIME=exptime, **{'JD-OBS': 2460000.5 + i / (24 * 60)})
+
+    files['x_positions'] = x_positions - trim
+    files['y_positions'] = y_positions - trim
+
+    return files
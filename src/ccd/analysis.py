@@ -1,11 +1,183 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy
-import matplotlib.pyplot as plt
-from astropy.timeseries import LombScargle
+from eclipsing import measure_eclipses, period_grid, search_eclipses
+from store import STORE_NAME, PhotometryStore
+
+# Lomb-Scargle algorithms of search_periods and the astropy method used for each of them: 'fast' is
+# the O(N log N) extirpolation method of Press & Rybicki, 'exact' evaluates the sums directly
+PERIOD_METHODS = {'fast': 'fast', 'exact': 'cython'}
+
+# Number of bootstrap resamples done by each task of bootstrap_false_alarm
+BOOTSTRAP_CHUNK = 25
+
+
+class PeriodResult:
+    """Periodogram of one light curve.
+
+    - frequency and power: the periodogram, as numpy arrays.
+    - best_frequency and best_power: its highest peak. period is 1 / best_frequency.
+    - false_alarm_probability: fraction of the bootstrap resamples of the fluxes whose highest
+      peak is at least best_power, or None if there were no resamples.
+    - bootstrap_powers: highest peak of each bootstrap resample.
+
+    """
+
+    def __init__(self, frequency, power, bootstrap_powers=None):
+
+        self.frequency = frequency
+        self.power = power
+
+        best = numpy.argmax(power)
+        self.best_frequency = frequency[best]
+        self.best_power = power[best]
+        self.period = 1 / self.best_frequency
+
+        self.bootstrap_powers = bootstrap_powers
+        self.false_alarm_probability = None
+        if bootstrap_powers is not None and len(bootstrap_powers):
+            self.false_alarm_probability = numpy.mean(bootstrap_powers >= self.best_power)
+
+
+def frequency_grid(times, minimum_frequency=None, maximum_frequency=None, samples_per_peak=5, nyquist_factor=5):
+    """Regular grid of frequencies (in 1 / units of times) to search, with samples_per_peak points
+    across the width of a peak (1 / baseline). Without maximum_frequency, the grid goes up to
+    nyquist_factor times the average Nyquist frequency, as LombScargle.autopower does."""
+
+    from astropy.timeseries import LombScargle
+
+    return LombScargle(times, numpy.ones_like(times)).autofrequency(
+        samples_per_peak=samples_per_peak, nyquist_factor=nyquist_factor,
+        minimum_frequency=minimum_frequency, maximum_frequency=maximum_frequency)
+
+
+def is_regular_grid(frequency):
+    "Whether the frequencies are evenly spaced, as the 'fast' method needs"
+
+    return len(frequency) < 3 or numpy.allclose(numpy.diff(frequency), frequency[1] - frequency[0])
+
+
+def _periodogram(task):
+    """Lomb-Scargle power of one light curve on a frequency grid. The 'fast' method only works on
+    regular grids, so any other grid is computed with the 'exact' one."""
+
+    from astropy.timeseries import LombScargle
+
+    times, fluxes, frequency, method = task
+
+    # astropy would otherwise rebuild a regular grid from the first two frequencies
+    if method == 'fast' and not is_regular_grid(frequency):
+        method = 'exact'
+
+    return LombScargle(times, fluxes).power(frequency, method=PERIOD_METHODS[method],
+                                            assume_regular_frequency=method == 'fast')
+
+
+def _bootstrap_maxima(task):
+    """Highest peak of the periodogram of n_bootstraps resamples (with replacement) of the fluxes,
+    keeping the times, drawn from a generator seeded with seed"""
+
+    times, fluxes, frequency, method, seed, n_bootstraps = task
+    rng = numpy.random.default_rng(seed)
+
+    maxima = numpy.empty(n_bootstraps)
+    for i in range(n_bootstraps):
+        resampled = fluxes[rng.integers(0, len(fluxes), len(fluxes))]
+        maxima[i] = _periodogram((times, resampled, frequency, method)).max()
+
+    return maxima
+
+
+def search_periods(
+    light_curves,
+    method='fast',
+    frequency=None,
+    minimum_frequency=None,
+    maximum_frequency=None,
+    samples_per_peak=5,
+    nyquist_factor=5,
+    n_bootstraps=0,
+    workers=1,
+    seed=0,
+):
+    """Lomb-Scargle period search of many light curves at once.
+
+    - Accept a list of (times, fluxes) pairs as light_curves.
+    - Compute the periodogram of each one with method ('fast' or 'exact', see PERIOD_METHODS)
+      on frequency, or on the grid made by frequency_grid from minimum_frequency,
+      maximum_frequency, samples_per_peak and nyquist_factor. A frequency grid that isn't evenly
+      spaced is always computed with the 'exact' method.
+    - With n_bootstraps, estimate the false alarm probability of the highest peak of each
+      light curve from that many bootstrap resamples of its fluxes (seeded from seed, so the
+      result doesn't depend on workers).
+    - Spread the periodograms and chunks of BOOTSTRAP_CHUNK resamples over workers processes.
+    - Return a list with a PeriodResult for each light curve.
+
+    """
+
+    if method not in PERIOD_METHODS:
+        raise ValueError(f"method must be one of {tuple(PERIOD_METHODS)}, not {method!r}")
+
+    light_curves = [(numpy.asarray(times, dtype='f8'), numpy.asarray(fluxes, dtype='f8'))
+                    for times, fluxes in light_curves]
+
+    if frequency is None:
+        frequencies = [frequency_grid(times, minimum_frequency, maximum_frequency, samples_per_peak, nyquist_factor)
+                       for times, fluxes in light_curves]
+    else:
+        frequencies = [numpy.asarray(frequency, dtype='f8')] * len(light_curves)
+
+    periodogram_tasks = [(times, fluxes, frequency, method)
+                         for (times, fluxes), frequency in zip(light_curves, frequencies)]
+
+    # Every chunk of resamples gets its own seed, so they are the same whichever process runs them
+    seeds = numpy.random.SeedSequence(seed).spawn(len(light_curves) * -(-n_bootstraps // BOOTSTRAP_CHUNK))
+    bootstrap_tasks = []
+    for i, task in enumerate(periodogram_tasks):
+        for start in range(0, n_bootstraps, BOOTSTRAP_CHUNK):
+            bootstrap_tasks.append((i, task + (seeds[len(bootstrap_tasks)], min(BOOTSTRAP_CHUNK, n_bootstraps - start))))
+
+    if workers == 1:
+        powers = list(map(_periodogram, periodogram_tasks))
+        maxima = list(map(_bootstrap_maxima, [task for i, task in bootstrap_tasks]))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            powers = list(executor.map(_periodogram, periodogram_tasks))
+            maxima = list(executor.map(_bootstrap_maxima, [task for i, task in bootstrap_tasks]))
+
+    results = []
+    for i, (frequency, power) in enumerate(zip(frequencies, powers)):
+        bootstrap_powers = None
+        if n_bootstraps:
+            bootstrap_powers = numpy.concatenate([chunk for (j, task), chunk in zip(bootstrap_tasks, maxima) if j == i])
+        results.append(PeriodResult(frequency, power, bootstrap_powers))
+
+    return results
+
+
+def load_light_curve(path=STORE_NAME, star=None, column=None):
+    """Times (minutes after the first frame) and fluxes of a light curve from the
+    store.PhotometryStore at path: the flux ratio of the target (RATIO) by default, or column of
+    one star (its index or id), by default its LIGHT_CURVE if the store has one and its FLUX if
+    not. The values are read into memory."""
+
+    store = PhotometryStore(path)
+    times = numpy.array(store.column('TIME'))
+
+    if star is None:
+        return times, numpy.array(store.column(column or 'RATIO'))
+
+    if column is None:
+        column = 'LIGHT_CURVE' if 'LIGHT_CURVE' in store.schema['star_columns'] else 'FLUX'
+
+    return times, numpy.array(store.star(column, star))
 
 
 def plot_light_curve(times, fluxes):
     "Plot light curve of system"
 
+    import matplotlib.pyplot as plt
+
     # Plot light curve
     plt.scatter(times, fluxes, s=8, color='black', label='LPSEB35 Data')
     plt.axvline(75, color="green", linestyle="-.", label='Egress start')
@@ -21,22 +193,33 @@ def plot_light_curve(times, fluxes):
     plt.clf()
 
 
-def determine_period(times, fluxes):
-    "Determine period of system with LombScargle"
+def determine_period(times, fluxes, method='fast', frequency=None, samples_per_peak=5, n_bootstraps=0, workers=1):
+    """Determine period of system with LombScargle
+
+    The periodogram is computed by search_periods with method, frequency (in 1 / h) and
+    samples_per_peak, and the false alarm probability of its peak is printed if n_bootstraps
+    resamples are done over workers processes.
+
+    """
 
     # Convert times to hours
     time_hour = times / 60
 
     # Perform LombScargle to find frequency
-    frequency, power = LombScargle(time_hour, fluxes).autopower()
+    result = search_periods([(time_hour, fluxes)], method=method, frequency=frequency,
+                            samples_per_peak=samples_per_peak, n_bootstraps=n_bootstraps, workers=workers)[0]
+    frequency, power = result.frequency, result.power
 
     # Pick the best frequency
-    best_freq = frequency[numpy.argmax(power)]
+    best_freq = result.best_frequency
+    if result.false_alarm_probability is not None:
+        print(f"False alarm probability: {result.false_alarm_probability:.3g} ({n_bootstraps} bootstraps)")
 
     # The actual period is twice the period of the periodiogram
     period = 2/best_freq
 
     # Plot periodogram
+    import matplotlib.pyplot as plt
     plt.plot(frequency, power)
     plt.axvline(x=best_freq, label="Best frequency", color='green', linestyle="-.")
     plt.xlabel("Frequency (1 / h)", fontsize=16)
@@ -55,14 +238,18 @@ def determine_period(times, fluxes):
 
 
 def plot_phase_folded(times, fluxes, period):
-    """Plot a phase-folded light curve with eclipse depth"""
+    """Plot a phase-folded light curve with eclipse depth
+
+    The eclipses are found by eclipsing.measure_eclipses, so the phase is counted from the
+    primary eclipse and no phase windows need to be chosen by hand.
+
+    """
 
-    # Convert time to days for consistency
-    time_days = times / (60 * 24)
-    period_days = period / 24
+    # Finds the primary and secondary eclipses at this period (in minutes, like the times)
+    solution = measure_eclipses(times, fluxes, period * 60)
 
-    # Phase-fold the data
-    phase = (time_days % period_days) / period_days
+    # Phase-fold the data, with the primary eclipse at phase 0.25
+    phase = ((times - solution.epoch) / (period * 60) + 0.25) % 1
 
     # Optionally sort by phase for plotting
     mag = -2.5 * numpy.log10(fluxes)
@@ -72,19 +259,23 @@ def plot_phase_folded(times, fluxes, period):
     phase_sorted = phase[sorted_idx]
     mag_sorted = mag[sorted_idx]
 
-    # Define in-eclipse and out-of-eclipse regions by phase
-    in_eclipse = (phase > 0.2) & (phase < 0.3)
-    out_of_eclipse = (phase > 0.49) & (phase < 0.52)
-
-    # Compute median magnitudes
-    mag_eclipse = numpy.median(mag[in_eclipse])
+    # Out-of-eclipse points are those away from both eclipses
+    secondary = 0.25 + solution.secondary_phase
+    out_of_eclipse = ((numpy.abs(phase - 0.25) > solution.primary_duration / 2) &
+                      (numpy.abs((phase - secondary + 0.5) % 1 - 0.5) > solution.secondary_duration / 2))
     mag_out = numpy.median(mag[out_of_eclipse])
 
     # Calculate eclipse depth
-    depth_mag = mag_eclipse - mag_out
-    print(f"Eclipse Depth: {depth_mag:.3f} mag")
-    
+    depth_mag = -2.5 * numpy.log10(1 - solution.primary_depth)
+    depth_mag_error = 2.5 / numpy.log(10) * solution.primary_depth_error / (1 - solution.primary_depth)
+    mag_eclipse = mag_out + depth_mag
+    print(f"Eclipse Depth: {depth_mag:.3f} +- {depth_mag_error:.3f} mag")
+    if solution.secondary_detected:
+        secondary_mag = -2.5 * numpy.log10(1 - solution.secondary_depth)
+        print(f"Secondary Eclipse Depth: {secondary_mag:.3f} mag at phase {solution.secondary_phase:.3f}")
+
     # Plot phase-folded light curve
+    import matplotlib.pyplot as plt
     plt.scatter(phase_sorted, mag_sorted, s=7, color='black', label="Data")
     plt.axhline(mag_out, color='green', linestyle='--', label="Out-of-Eclipse")
     plt.axhline(mag_eclipse, color='blue', linestyle='--', label="In-Eclipse")
@@ -99,17 +290,33 @@ def plot_phase_folded(times, fluxes, period):
     plt.savefig('figures/phase_plot.pdf')
     plt.clf()
 
+    return solution
 
-if __name__ == "__main__":
 
-    # Load the datas
-    times = numpy.load("times.npy") # minutes
-    fluxes = numpy.load("fluxes.npy")    
+def run_analysis(times, fluxes, method='fast', n_bootstraps=0, workers=1):
+    """Plots the light curve, finds its period (with determine_period, refined by
+    eclipsing.search_eclipses) and plots it phase folded, saving the plots to figures/. Returns
+    the EclipseSolution."""
 
     # Plot all plots
     plot_light_curve(times, fluxes)
 
-    period = determine_period(times, fluxes)
+    period = determine_period(times, fluxes, method=method, n_bootstraps=n_bootstraps, workers=workers)
     print(f"Period: {period:.3f} h")
 
-    plot_phase_folded(times, fluxes, period)
\ No newline at end of file
+    # Refines the period around the Lomb-Scargle one with a box least squares search for the eclipses
+    solution = search_eclipses(times, fluxes, period_grid(times, 0.5 * period * 60, 1.5 * period * 60))
+    period = solution.period / 60
+    print(f"Eclipse period: {period:.3f} +- {solution.period_error / 60:.3f} h")
+
+    plot_phase_folded(times, fluxes, period)
+
+    return solution
+
+
+if __name__ == "__main__":
+
+    # Load the datas
+    times, fluxes = load_light_curve()  # minutes
+
+    run_analysis(times, fluxes)
@@ -6,11 +6,12 @@
 
 import pdb
 from astropy.io import fits
-from astropy.stats import sigma_clip
-import numpy
+from combine import DEFAULT_MEMORY_LIMIT, combine_frames
+from frames import DEFAULT_TRIM, write_frame
 
 
-def create_median_bias(bias_list, median_bias_filename):
+def create_median_bias(bias_list, median_bias_filename, memory_limit=DEFAULT_MEMORY_LIMIT, workers=1,
+                       method='astropy', validate=False, trim=DEFAULT_TRIM, output_format='fits'):
     """This function must:
 
     - Accept a list of bias file paths as bias_list.
@@ -21,24 +22,17 @@ def create_median_bias(bias_list, median_bias_filename):
       median_bias_filename.
     - Return the median bias frame as a 2D numpy array.
 
-    """
-
-    bias_images = []
-    
-    # Will read each file and append to bias_images list where the arrays have dtype = float32
-    for bias in bias_list:
-        bias_data = fits.getdata(bias)[100:-100, 100:-100]
-        bias_images.append(bias_data.astype('f4'))
+    With output_format='compressed' the master is saved tile-compressed without loss (see
+    frames.write_frame).
 
-    # Reads the list of biases and sigma clips the arrays
-    bias_images_masked = sigma_clip(bias_images, cenfunc='median', sigma=3, axis=0) 
+    """
 
-    # Creates a final 2D array that is the mean of each pixel from all different biases
-    median_bias = numpy.ma.mean(bias_images_masked, axis=0)
+    # Sigma clips the biases tile by tile and takes the mean of each pixel from all different biases,
+    # keeping at most memory_limit bytes of the stack in memory and using workers threads
+    median_bias = combine_frames(bias_list, sigma=3, trim=trim, memory_limit=memory_limit, workers=workers,
+                                 method=method, validate=validate)
 
     # Create a new FITS file from the resulting median bias frame.
     # You can replace the header with something more meaningful with information.
-    primary = fits.PrimaryHDU(data=median_bias.data, header=fits.Header())
-    hdul = fits.HDUList([primary])
-    hdul.writeto(median_bias_filename, overwrite=True)
+    write_frame(median_bias_filename, median_bias, fits.Header(), output_format)
     return median_bias
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: cache.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import hashlib
+import json
+import os
+import threading
+
+# Name of the manifest written next to the outputs of a reduction
+MANIFEST_FILENAME = 'reduction-manifest.json'
+
+
+def file_fingerprint(filename, contents=False):
+    """Fingerprint of a file: its path, size and modification time, or the SHA-256 of its
+    contents when contents is True (slower, but survives copies and touches)"""
+
+    if contents:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024**2), b''):
+                digest.update(chunk)
+        return [os.path.abspath(filename), digest.hexdigest()]
+
+    stat = os.stat(filename)
+
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+
+class BuildCache:
+    """Manifest of the stages of a reduction and the inputs they were built from.
+
+    - Accept the directory where the outputs (and the manifest) are written.
+    - A stage's key hashes its input files, its parameters (trim region, combine settings, ...)
+      and the keys of the stages it depends on, so rebuilding a stage invalidates everything
+      built from it.
+    - A stage is fresh if its key matches the one in the manifest and all its outputs exist.
+    - record can be called from several threads at once (e.g. by the tasks of a
+      scheduler.TaskGraph): the manifest is updated and saved under a lock.
+    - Stages recorded with save=False (e.g. every science frame) are only written by the next
+      record or save, so that many of them cost one write of the manifest.
+
+    """
+
+    def __init__(self, directory, contents=False):
+
+        self.filename = os.path.join(directory, MANIFEST_FILENAME)
+        self.contents = contents
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.filename):
+            with open(self.filename) as file:
+                self.manifest = json.load(file)
+        else:
+            self.manifest = dict()
+
+    def key(self, files=(), parameters=None, dependencies=()):
+        "Hash of the input files, the parameters and the keys of the stages it depends on"
+
+        description = {
+            'files': [file_fingerprint(file, self.contents) for file in files],
+            'parameters': parameters,
+            'dependencies': list(dependencies),
+        }
+        encoded = json.dumps(description, sort_keys=True, default=str).encode()
+
+        return hashlib.sha256(encoded).hexdigest()
+
+    def is_fresh(self, stage, key):
+        "Whether stage was already built from the same inputs and its outputs are still there"
+
+        entry = self.manifest.get(stage)
+        if entry is None or entry['key'] != key:
+            return False
+
+        return all(os.path.exists(output) for output in entry['outputs'])
+
+    def values(self, stage):
+        "Values (e.g. the gain) recorded for a stage"
+
+        return self.manifest[stage]['values']
+
+    def record(self, stage, key, outputs=(), values=None, save=True):
+        "Records that stage was built from key, and saves the manifest unless save is False"
+
+        with self._lock:
+            self.manifest[stage] = {'key': key, 'outputs': list(outputs), 'values': values}
+            if save:
+                self._save()
+
+    def save(self):
+        "Saves the manifest, with the stages recorded with save=False"
+
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        "Writes the manifest, which must be done holding the lock"
+
+        # Writes to a temporary file first so an interrupted run can't leave a broken manifest, named
+        # after the process and thread so that nothing else can replace or remove it in between
+        temporary = f"{self.filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(temporary, self.filename)
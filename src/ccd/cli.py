@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: cli.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+"""Command line interface of the reduction, run as
+
+    python src/ccd <subcommand> [options]
+
+Each subcommand only imports the modules it needs, so e.g. ptc doesn't load photutils,
+astroscrappy or matplotlib.
+
+"""
+
+import argparse
+import glob
+import sys
+
+
+def trim_argument(value):
+    "Parses --trim, which is a number of pixels or DATASEC"
+
+    return value if value == 'DATASEC' else int(value)
+
+
+def masters(args):
+    "Combines the bias, dark and flat frames of a night into master frames"
+
+    from bias import create_median_bias
+    from darks import create_median_dark
+    from flats import create_median_flat
+
+    options = dict(workers=args.workers, method=args.method, trim=args.trim, output_format=args.output_format)
+    median_bias_filename = args.data_dir + 'Median-Bias.fits'
+    median_dark_filename = args.data_dir + 'Median-Dark.fits'
+    median_flat_filename = args.data_dir + 'Median-AutoFlat.fits'
+
+    create_median_bias(sorted(glob.glob(args.data_dir + "Bias*")), median_bias_filename, **options)
+    create_median_dark(sorted(glob.glob(args.data_dir + "Dark*")), median_bias_filename, median_dark_filename, **options)
+    create_median_flat(sorted(glob.glob(args.data_dir + "domeflat*")), median_bias_filename, median_flat_filename,
+                       median_dark_filename, **options)
+
+
+def reduce(args):
+    "Runs the whole reduction of a night"
+
+    from reduction import run_reduction
+
+    run_reduction(args.data_dir, workers=args.workers, use_cache=not args.no_cache, cosmic_rays=args.cosmic_rays,
+                  trim=args.trim, cube=args.cube, metrics=args.metrics, profile_stage=args.profile_stage,
+                  profiler=args.profiler, profile_output=args.profile_output, full_ptc=args.full_ptc,
+                  library=args.library, dry_run=args.dry_run, output_format=args.output_format,
+                  quantize_level=args.quantize_level)
+
+
+def photometry(args):
+    "Measures the light curve of the reduced science frames of a night"
+
+    from diff_photometry import run_ensemble_photometry, run_photometry
+
+    if args.ensemble:
+        options = dict(threshold=args.threshold, max_sources=args.max_stars, workers=args.workers)
+        if args.x is not None:
+            options.update(target=(args.x[0], args.y[0]))
+        if args.radius is not None:
+            options.update(radius=args.radius)
+        run_ensemble_photometry(args.data_dir, args.output_dir, **options)
+        return
+
+    options = dict()
+    if args.x is not None:
+        options.update(x_positions=args.x, y_positions=args.y)
+    if args.radius is not None:
+        options.update(radii=[args.radius])
+
+    run_photometry(args.data_dir, args.output_dir, **options)
+
+
+def period(args):
+    "Finds the period and eclipses of a light curve saved by photometry"
+
+    from analysis import load_light_curve, run_analysis
+    from store import STORE_NAME
+
+    times, fluxes = load_light_curve(args.output_dir + STORE_NAME, args.star, args.column)
+
+    print(run_analysis(times, fluxes, method=args.method, n_bootstraps=args.bootstraps, workers=args.workers))
+
+
+def watch(args):
+    "Reduces science frames as they arrive and extends the light curve"
+
+    from watch import LightCurveWatcher
+
+    watcher = LightCurveWatcher(args.data_dir, args.x, args.y, radii=[args.radius], cosmic_rays=args.cosmic_rays,
+                                trim=args.trim, write_reduced=args.write_reduced)
+    watcher.watch(poll_interval=args.interval, timeout=args.timeout)
+
+
+def ptc(args):
+    "Measures the gain and readout noise of the detector"
+
+    from ptc import calculate_gain, calculate_readout_noise, measure_ptc
+
+    flat_files = sorted(glob.glob(args.data_dir + "domeflat*"))
+    bias_files = sorted(glob.glob(args.data_dir + "Bias*"))
+
+    if not args.full:
+        gain = calculate_gain(flat_files, trim=args.trim)
+        readout_noise = calculate_readout_noise(bias_files, gain, trim=args.trim)
+        print(f"Gain = {gain:.2f} e-/ADU")
+        print(f"Readout Noise = {readout_noise:.2f} e-")
+        return
+
+    result = measure_ptc(flat_files, bias_files, trim=args.trim, tile_size=args.tile_size, regions=args.regions,
+                         workers=args.workers, gain_map_filename=args.gain_map)
+
+    print(f"Gain = {result.gain:.3f} +/- {result.gain_error:.3f} e-/ADU")
+    print(f"Readout Noise = {result.readout_noise:.2f} +/- {result.readout_noise_error:.2f} e-")
+    print(f"{result.used.sum()} of {result.used.size} tile points used")
+    if args.regions is not None:
+        print("Gain of each region (e-/ADU):")
+        for row in result.gain_map:
+            print('  ' + ' '.join(f"{gain:.3f}" for gain in row))
+
+
+def make_parser():
+
+    parser = argparse.ArgumentParser(prog='ccd', description="CCD image reduction and analysis")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_command(function, data_dir=True):
+        subparser = subparsers.add_parser(function.__name__, help=function.__doc__, description=function.__doc__)
+        subparser.set_defaults(function=function)
+        if data_dir:
+            subparser.add_argument('data_dir', help="directory of the night, ending with /")
+        return subparser
+
+    # The choices are written out instead of importing them from the modules, which would be slow
+    subparser = add_command(masters)
+    subparser.add_argument('--workers', type=int, default=1)
+    subparser.add_argument('--method', default='astropy', choices=('astropy', 'fast', 'single-pass'))
+    subparser.add_argument('--trim', type=trim_argument, default=100, help="pixels trimmed from each edge, or DATASEC")
+    subparser.add_argument('--output-format', default='fits', choices=('fits', 'compressed'))
+
+    subparser = add_command(reduce)
+    subparser.add_argument('--workers', type=int, default=1)
+    subparser.add_argument('--no-cache', action='store_true', help="redo every stage")
+    subparser.add_argument('--cosmic-rays', default='full', choices=('off', 'full', 'tiled', 'targets'))
+    subparser.add_argument('--trim', type=trim_argument, default=100, help="pixels trimmed from each edge, or DATASEC")
+    subparser.add_argument('--cube', action='store_true', help="store the reduced frames in one cube")
+    subparser.add_argument('--full-ptc', action='store_true', help="fit the gain to every flat and bias pair")
+    subparser.add_argument('--library', help="calibration library to add the masters to and take them from")
+    subparser.add_argument('--dry-run', action='store_true', help="only print the stages that would run")
+    subparser.add_argument('--output-format', default='fits', choices=('fits', 'compressed'),
+                           help="save the masters and reduced frames as plain or tile-compressed FITS")
+    subparser.add_argument('--quantize-level', type=float,
+                           help="quantize the compressed science frames to 1/Q of their noise (lossless if not given)")
+    subparser.add_argument('--metrics', help="JSON lines file to save the timing of each stage to")
+    subparser.add_argument('--profile-stage', choices=('bias', 'dark', 'flat', 'ptc', 'science'))
+    subparser.add_argument('--profiler', default='cprofile', choices=('cprofile', 'tracemalloc'))
+    subparser.add_argument('--profile-output', help="file to save the cProfile stats to")
+
+    subparser = add_command(photometry)
+    subparser.add_argument('--output-dir', default='', help="where to save the photometry store")
+    subparser.add_argument('--x', type=float, nargs='+', help="x of the target and the comparison objects")
+    subparser.add_argument('--y', type=float, nargs='+', help="y of the target and the comparison objects")
+    subparser.add_argument('--radius', type=float, help="aperture radius")
+    subparser.add_argument('--ensemble', action='store_true',
+                           help="measure every star and compare the target (the first --x/--y) to all the others")
+    subparser.add_argument('--threshold', type=float, default=5, help="detection threshold of --ensemble, in sigma")
+    subparser.add_argument('--max-stars', type=int, help="only measure this many of the brightest stars")
+    subparser.add_argument('--workers', type=int, default=1)
+
+    subparser = add_command(period, data_dir=False)
+    subparser.add_argument('--output-dir', default='', help="where the photometry store was saved")
+    subparser.add_argument('--star', help="id of a star of the store, instead of the target's flux ratio")
+    subparser.add_argument('--column', help="column of the store to use (RATIO, or FLUX, LIGHT_CURVE... with --star)")
+    subparser.add_argument('--method', default='fast', choices=('fast', 'exact'))
+    subparser.add_argument('--bootstraps', type=int, default=0, help="resamples for the false alarm probability")
+    subparser.add_argument('--workers', type=int, default=1)
+
+    subparser = add_command(watch)
+    subparser.add_argument('--x', type=float, nargs='+', required=True, help="x of the target and the comparison objects")
+    subparser.add_argument('--y', type=float, nargs='+', required=True, help="y of the target and the comparison objects")
+    subparser.add_argument('--radius', type=float, default=10, help="aperture radius")
+    subparser.add_argument('--cosmic-rays', default='targets', choices=('off', 'full', 'tiled', 'targets'))
+    subparser.add_argument('--trim', type=trim_argument, default=100, help="pixels trimmed from each edge, or DATASEC")
+    subparser.add_argument('--write-reduced', action='store_true', help="also save the reduced frames")
+    subparser.add_argument('--interval', type=float, default=2, help="seconds between polls")
+    subparser.add_argument('--timeout', type=float, help="stop after this many seconds without new frames")
+
+    subparser = add_command(ptc)
+    subparser.add_argument('--trim', type=trim_argument, default=100, help="pixels trimmed from each edge, or DATASEC")
+    subparser.add_argument('--full', action='store_true', help="fit the photon transfer curve of every pair")
+    subparser.add_argument('--tile-size', type=int, default=64, help="side of the tiles of the full fit")
+    subparser.add_argument('--regions', type=int, nargs=2, metavar=('ROWS', 'COLUMNS'),
+                           help="also fit each of this grid of regions (e.g. the amplifiers)")
+    subparser.add_argument('--workers', type=int, default=1)
+    subparser.add_argument('--gain-map', help="FITS file to save the gain map to")
+
+    return parser
+
+
+def main(argv=None):
+
+    args = make_parser().parse_args(argv)
+    if args.command == 'photometry' and (args.x is None) != (args.y is None):
+        sys.exit("photometry needs both --x and --y")
+
+    args.function(args)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: combine.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from astropy.stats import sigma_clip
+from frames import DEFAULT_TRIM, image_hdu, open_frame, read_section, trim_section
+from metrics import span
+import numpy
+
+# Default amount of memory (in bytes) that the stack of tiles being combined may use
+DEFAULT_MEMORY_LIMIT = 2 * 1024**3
+
+# sigma_clip keeps a masked copy of the stack plus a few temporary arrays, so a tile really costs a
+# few times the size of its raw data
+CLIP_OVERHEAD = 6
+
+# Kernels that can be used to sigma clip and combine a stack
+COMBINE_METHODS = ('astropy', 'fast', 'single-pass')
+
+
+def tile_rows(n_frames, n_columns, memory_limit=DEFAULT_MEMORY_LIMIT):
+    "Number of detector rows per tile so that the clipped stack fits in memory_limit bytes"
+
+    # Corrected tiles can be float64 once a float64 master has been subtracted from them
+    bytes_per_row = n_frames * n_columns * 8 * CLIP_OVERHEAD
+
+    return max(1, int(memory_limit // bytes_per_row))
+
+
+def sorted_median(values, low, high):
+    "Median of values[i, low[i]:high[i]] for each row i of an array sorted along its last axis"
+
+    rows = numpy.arange(len(values))
+    n_kept = high - low
+
+    median_low = values[rows, low + numpy.maximum(n_kept - 1, 0) // 2]
+    median_high = values[rows, low + n_kept // 2]
+
+    return 0.5 * (median_low.astype('f8') + median_high)
+
+
+def kept_mask(values, low, high):
+    "Mask of the ranges values[i, low[i]:high[i]], or True when every value is kept"
+
+    if not low.any() and numpy.all(high == values.shape[1]):
+        return True
+
+    index = numpy.arange(values.shape[1])
+
+    return (index >= low[:, numpy.newaxis]) & (index < high[:, numpy.newaxis])
+
+
+def clipped_mean(stack, sigma=3, maxiters=5, method='fast'):
+    """Sigma clips each pixel of a stack along the first axis and returns the mean of the kept values.
+
+    - method='astropy' uses sigma_clip(cenfunc='median') + numpy.ma.mean.
+    - method='fast' does the same clipping (median centre, standard deviation, at most maxiters
+      iterations) without masked arrays. Each pixel's values are sorted once, so the values that
+      survive clipping are always a contiguous range of the sorted values and medians are just
+      indexed. After the first iteration only the pixels where something was clipped are revisited.
+    - method='single-pass' clips once around the median using the MAD standard deviation, which
+      is cheaper and robust enough for bias and dark stacks.
+
+    NaN values in the stack are ignored.
+
+    """
+
+    if method == 'astropy':
+        stack_sc = sigma_clip(stack, cenfunc='median', sigma=sigma, maxiters=maxiters, axis=0)
+        return numpy.ma.mean(stack_sc, axis=0).data
+
+    if method not in COMBINE_METHODS:
+        raise ValueError(f"method must be one of {COMBINE_METHODS}, not {method!r}")
+
+    n_frames = stack.shape[0]
+
+    # (pixels, frames) layout so that the values of each pixel are contiguous, sorted with NaNs last
+    values = numpy.ascontiguousarray(stack.reshape(n_frames, -1).T)
+    values.sort(axis=1)
+
+    # The kept values of each pixel are values[pixel, low:high]
+    low = numpy.zeros(len(values), dtype=int)
+    high = numpy.count_nonzero(~numpy.isnan(values), axis=1)
+
+    # Only pixels where something was clipped in the last iteration need another one
+    active = numpy.arange(len(values))
+    active_values = values
+
+    for iteration in range(maxiters if method == 'fast' else 1):
+        active_low = low[active]
+        active_high = high[active]
+        center = sorted_median(active_values, active_low, active_high)
+
+        if method == 'fast':
+            kept = kept_mask(active_values, active_low, active_high)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                std = numpy.std(active_values, axis=1, where=kept)
+        else:
+            absolute_deviation = numpy.abs(active_values - center[:, numpy.newaxis])
+            absolute_deviation.sort(axis=1)
+            std = 1.4826 * sorted_median(absolute_deviation, active_low, active_high)
+
+        # Clips everything further than sigma standard deviations from the median, which for sorted
+        # values just moves the ends of the kept range
+        lower = (center - sigma * std)[:, numpy.newaxis]
+        upper = (center + sigma * std)[:, numpy.newaxis]
+        new_low = numpy.maximum(active_low, numpy.count_nonzero(active_values < lower, axis=1))
+        new_high = numpy.minimum(active_high, numpy.count_nonzero(active_values <= upper, axis=1))
+
+        # Stops once nothing new gets clipped
+        changed = (new_low != active_low) | (new_high != active_high)
+        low[active] = new_low
+        high[active] = new_high
+        active = active[changed]
+        if not len(active):
+            break
+        active_values = values[active]
+
+    # Sums all the values at once, and only the pixels that lost some of them value by value
+    sums = numpy.sum(values, axis=1)
+    clipped = numpy.flatnonzero((low > 0) | (high < n_frames))
+    kept = kept_mask(values[clipped], low[clipped], high[clipped])
+    sums[clipped] = numpy.sum(values[clipped], axis=1, where=kept)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / (high - low)
+
+    return mean.reshape(stack.shape[1:])
+
+
+def compare_kernels(stack, sigma=3, method='fast'):
+    "Maximum absolute difference between the method kernel and the astropy one for a stack"
+
+    reference = clipped_mean(stack, sigma=sigma, method='astropy')
+    result = clipped_mean(stack, sigma=sigma, method=method)
+
+    return numpy.nanmax(numpy.abs(result - reference))
+
+
+def combine_frames(
+    file_list,
+    preprocess=None,
+    sigma=3,
+    trim=DEFAULT_TRIM,
+    memory_limit=DEFAULT_MEMORY_LIMIT,
+    workers=1,
+    method='astropy',
+    validate=False,
+):
+    """Sigma clips and combines a stack of frames one row tile at a time.
+
+    - Accept a list of FITS file paths as file_list.
+    - Open every file memory-mapped and read only the rows of the trimmed region (see
+      frames.trim_section) that belong to the current tile, as float32.
+    - Optionally correct each tile with preprocess(tile, header, rows), where rows is the
+      slice of the trimmed frame that the tile covers (used to subtract master frames).
+    - Sigma clip each pixel of the tile stack with the median and a sigma threshold and take
+      the mean of the remaining values, exactly as sigma_clip + numpy.ma.mean on the full stack.
+      A faster kernel can be chosen with method (see clipped_mean), and validate=True prints the
+      maximum deviation of that kernel from the astropy one.
+    - Combine up to workers tiles at the same time in a thread pool (the numpy kernels release
+      the GIL), each one writing straight into its rows of the output frame.
+    - Keep the tile stacks of all the workers together within memory_limit bytes.
+    - Return the combined frame as a 2D float64 numpy array (the dtype numpy.ma.mean gives).
+
+    Each pixel is clipped independently, so the result doesn't depend on the tile size or on
+    the number of workers.
+
+    """
+
+    hduls = [open_frame(file) for file in file_list]
+    headers = [image_hdu(hdul).header for hdul in hduls]
+
+    # Trimmed region of the frames and its size
+    frame_rows, frame_columns = trim_section(headers[0], trim)
+    n_rows = frame_rows.stop - frame_rows.start
+    n_columns = frame_columns.stop - frame_columns.start
+
+    # Splits the memory budget between the workers, and makes sure every worker gets at least one tile
+    rows_per_tile = tile_rows(len(file_list), n_columns, memory_limit / workers)
+    rows_per_tile = min(rows_per_tile, -(-n_rows // workers))
+
+    combined = numpy.empty((n_rows, n_columns), dtype='f8')
+
+    # Reading from the open files isn't thread safe, so only one worker reads at a time
+    read_lock = threading.Lock()
+    deviations = []
+
+    def combine_tile(rows):
+        section_rows = slice(frame_rows.start + rows.start, frame_rows.start + rows.stop)
+        stack = None
+
+        # Only reads the section of each file that belongs to this tile
+        for i, hdul in enumerate(hduls):
+            if preprocess is None:
+                # Reads straight into the stack
+                if stack is None:
+                    stack = numpy.empty((len(hduls), rows.stop - rows.start, n_columns), dtype='f4')
+                with read_lock, span('read'):
+                    read_section(image_hdu(hdul), section_rows, frame_columns, out=stack[i])
+                continue
+
+            with read_lock, span('read'):
+                tile = read_section(image_hdu(hdul), section_rows, frame_columns)
+            with span('preprocess'):
+                tile = preprocess(tile, headers[i], rows)
+
+            # The stack takes the dtype of the corrected tiles, as a list of them would
+            if stack is None:
+                stack = numpy.empty((len(hduls),) + tile.shape, dtype=tile.dtype)
+            stack[i] = tile
+
+        if validate and method != 'astropy':
+            deviations.append(compare_kernels(stack, sigma=sigma, method=method))
+
+        # Sigma clips the tile and stores the mean of each pixel in the output frame
+        with span('clip'):
+            combined[rows] = clipped_mean(stack, sigma=sigma, method=method)
+
+    tiles = [slice(start, min(start + rows_per_tile, n_rows)) for start in range(0, n_rows, rows_per_tile)]
+
+    try:
+        if workers == 1:
+            for rows in tiles:
+                combine_tile(rows)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # list() makes sure exceptions raised in the workers are raised here
+                list(executor.map(combine_tile, tiles))
+
+    finally:
+        for hdul in hduls:
+            hdul.close()
+
+    if deviations:
+        print(f"Max deviation of the {method} combine from astropy = {max(deviations):.3g}")
+
+    return combined
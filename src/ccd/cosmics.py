@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: cosmics.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import numpy
+
+# Ways of removing cosmic rays from a science frame
+COSMIC_RAY_MODES = ('off', 'full', 'tiled', 'targets')
+
+# Time spent (in seconds) removing cosmic rays from each frame, for each mode
+cosmic_ray_times = {mode: [] for mode in COSMIC_RAY_MODES}
+
+
+def clean_region(data, cleaned, rows, columns, margin, options):
+    """Runs detect_cosmics on data[rows, columns] padded by margin pixels on each side, and writes
+    the cleaned (unpadded) region into cleaned. The padding gives the detection the same
+    neighbourhood it would have on the full frame, so regions don't show seams."""
+
+    from astroscrappy import detect_cosmics
+
+    n_rows, n_columns = data.shape
+    padded_rows = slice(max(rows.start - margin, 0), min(rows.stop + margin, n_rows))
+    padded_columns = slice(max(columns.start - margin, 0), min(columns.stop + margin, n_columns))
+
+    mask, region = detect_cosmics(data[padded_rows, padded_columns], **options)
+
+    # Position of the unpadded region inside the padded one
+    inner_rows = slice(rows.start - padded_rows.start, rows.stop - padded_rows.start)
+    inner_columns = slice(columns.start - padded_columns.start, columns.stop - padded_columns.start)
+    cleaned[rows, columns] = region[inner_rows, inner_columns]
+
+
+def remove_cosmic_rays(
+    data,
+    mode='full',
+    positions=None,
+    target_radius=50,
+    tile_size=512,
+    overlap=32,
+    workers=1,
+    **options,
+):
+    """Removes cosmic rays from a reduced science frame with astroscrappy.
+
+    - mode='off' returns the data as it is.
+    - mode='full' runs detect_cosmics on the whole frame.
+    - mode='tiled' runs it on tile_size x tile_size tiles padded by overlap pixels, using workers
+      threads. With enough overlap the result matches the full frame one.
+    - mode='targets' only cleans squares of half-size target_radius around positions, a list of
+      (x, y) tuples, which is all aperture photometry needs.
+    - Any other keyword (niter, sigclip, gain, readnoise, objlim, ...) is passed to detect_cosmics,
+      so accuracy can be traded for speed (e.g. fewer iterations). gain and readnoise should come
+      from ptc.calculate_gain and ptc.calculate_readout_noise.
+    - The time spent is added to cosmic_ray_times[mode].
+    - Return the cleaned frame as a 2D float32 numpy array.
+
+    """
+
+    if mode not in COSMIC_RAY_MODES:
+        raise ValueError(f"mode must be one of {COSMIC_RAY_MODES}, not {mode!r}")
+
+    start = time.perf_counter()
+
+    if mode == 'off':
+        cleaned = data
+
+    elif mode == 'full':
+        from astroscrappy import detect_cosmics
+        mask, cleaned = detect_cosmics(data, **options)
+
+    else:
+        cleaned = data.astype('f4')
+        n_rows, n_columns = data.shape
+
+        # Regions of the frame that get cleaned, as (rows, columns) slices
+        if mode == 'tiled':
+            regions = [(slice(y, min(y + tile_size, n_rows)), slice(x, min(x + tile_size, n_columns)))
+                       for y in range(0, n_rows, tile_size) for x in range(0, n_columns, tile_size)]
+        else:
+            if positions is None:
+                raise ValueError("mode='targets' needs the positions of the targets")
+            regions = []
+            for x, y in positions:
+                x, y = int(round(x)), int(round(y))
+                regions.append((slice(max(y - target_radius, 0), min(y + target_radius + 1, n_rows)),
+                                slice(max(x - target_radius, 0), min(x + target_radius + 1, n_columns))))
+
+        def clean(region):
+            clean_region(data, cleaned, region[0], region[1], overlap, options)
+
+        if workers == 1:
+            for region in regions:
+                clean(region)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(clean, regions))
+
+    cosmic_ray_times[mode].append(time.perf_counter() - start)
+
+    return cleaned
+
+
+def reset_cosmic_ray_times():
+    "Forgets the times recorded so far, so a new reduction only reports its own frames"
+
+    for times in cosmic_ray_times.values():
+        times.clear()
+
+
+def print_cosmic_ray_times():
+    "Prints the number of frames and the time spent removing cosmic rays in each mode"
+
+    for mode, times in cosmic_ray_times.items():
+        if times:
+            print(f"Cosmic rays ({mode}): {len(times)} frames, {numpy.sum(times):.2f} s total, "
+                  f"{numpy.mean(times):.2f} s per frame")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: cube.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import io
+import os
+
+from astropy.table import Table
+from metrics import count_bytes
+import numpy
+
+# Columns of the per-frame metadata table
+CUBE_COLUMNS = ('JD-OBS', 'EXPTIME', 'SOURCE')
+
+# Name of the cube that run_reduction saves in the directory of a night
+CUBE_NAME = 'reduced-science'
+
+
+class FrameCube:
+    """Reduced frames of a night stored as one memory-mappable float32 cube (frames x y x x).
+
+    - The frames are stored back to back in {path}.f4 as little-endian float32.
+    - The companion table {path}.ecsv has one row per frame with its JD-OBS, EXPTIME and the
+      raw file it was reduced from (SOURCE), and the shape of the frames in its metadata.
+    - Frames are appended one at a time, each adding one line to the end of the table;
+      reading gives views of a memory map, so frames and stamps are never copied or decoded.
+
+    """
+
+    def __init__(self, path):
+
+        self.data_filename = path + '.f4'
+        self.table_filename = path + '.ecsv'
+
+        if os.path.exists(self.table_filename):
+            self.table = Table.read(self.table_filename, format='ascii.ecsv')
+        else:
+            self.table = Table(names=CUBE_COLUMNS, dtype=('f8', 'f8', 'U256'))
+
+        self._memmap = None
+
+    @classmethod
+    def create(cls, path):
+        "Creates an empty cube at path, replacing any cube that was there"
+
+        for filename in (path + '.f4', path + '.ecsv'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        return cls(path)
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def shape(self):
+        "Shape (y, x) of the frames, which is (0, 0) until the first one is appended"
+
+        return tuple(self.table.meta.get('shape', (0, 0)))
+
+    def append(self, data, header, source=''):
+        "Appends a reduced frame with its header (for JD-OBS and EXPTIME) and source filename"
+
+        if len(self) == 0:
+            self.table.meta['shape'] = list(data.shape)
+        elif data.shape != self.shape:
+            raise ValueError(f"Frame has shape {data.shape} but the cube has frames of shape {self.shape}")
+
+        with open(self.data_filename, 'ab') as file:
+            data = numpy.ascontiguousarray(data, dtype='<f4')
+            data.tofile(file)
+        count_bytes(written=data.nbytes)
+
+        # The table is written after the data, so it never lists a frame that isn't complete. Its
+        # header (with the shape) is only written with the first frame, and then one line per frame.
+        self.table.add_row((header.get('JD-OBS', numpy.nan), header.get('EXPTIME', numpy.nan), source))
+        if len(self) == 1:
+            self.table.write(self.table_filename, format='ascii.ecsv', overwrite=True)
+        else:
+            lines = io.StringIO()
+            self.table[-1:].write(lines, format='ascii.ecsv')
+            with open(self.table_filename, 'a') as file:
+                file.write(lines.getvalue().splitlines()[-1] + '\n')
+        self._memmap = None
+
+    @property
+    def frames(self):
+        "Memory map of all the frames, as a (frames, y, x) read-only array"
+
+        if len(self) == 0:
+            return numpy.empty((0,) + self.shape, dtype='<f4')
+
+        if self._memmap is None or len(self._memmap) != len(self):
+            self._memmap = numpy.memmap(self.data_filename, dtype='<f4', mode='r', shape=(len(self),) + self.shape)
+
+        return self._memmap
+
+    def frame(self, i):
+        "Frame i of the cube, as a view of the memory map"
+
+        return self.frames[i]
+
+    def stamp(self, i, x, y, half_size):
+        "Square cutout of frame i centred on (x, y), as a view of the memory map"
+
+        x, y = int(round(x)), int(round(y))
+
+        return self.frames[i, max(y - half_size, 0):y + half_size + 1, max(x - half_size, 0):x + half_size + 1]
+
+    def stream(self):
+        """Yields (i, frame, metadata row) for each frame, which can be used instead of
+        pipeline.stream_reduced_frames to measure a night again"""
+
+        for i in range(len(self)):
+            yield i, self.frame(i), self.table[i]
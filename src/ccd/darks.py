@@ -5,10 +5,12 @@
 # @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
 
 from astropy.io import fits
-from astropy.stats import sigma_clip
+from combine import DEFAULT_MEMORY_LIMIT, combine_frames
+from frames import DEFAULT_TRIM, write_frame
 import numpy
 
-def create_median_dark(dark_list, bias_filename, median_dark_filename):
+def create_median_dark(dark_list, bias_filename, median_dark_filename, memory_limit=DEFAULT_MEMORY_LIMIT,
+                       workers=1, method='astropy', validate=False, trim=DEFAULT_TRIM, output_format='fits'):
     """This function must:
 
     - Accept a list of dark file paths to combine as dark_list.
@@ -24,37 +26,30 @@ def create_median_dark(dark_list, bias_filename, median_dark_filename):
     - Save the resulting dark frame to a FITS file with the name median_dark_filename.
     - Return the median dark frame as a 2D numpy array.
 
+    With output_format='compressed' the master is saved tile-compressed without loss (see
+    frames.write_frame).
+
     """
 
     bias = fits.getdata(bias_filename)
-    dark_bias_data = []
-    exp_times = []
-
-    # Will read each file and append to dark_bias_data list where the arrays have dtype = float32
-    for file in dark_list:
-        dark = fits.open(file)
-        dark_data = dark[0].data[100:-100, 100:-100].astype('f4')
-        exptime = dark[0].header['EXPTIME']
-        exp_times.append(exptime)
+    exp_times = [fits.getheader(file)['EXPTIME'] for file in dark_list]
 
-        # Subtracts bias from each dark image
-        dark_data_no_bias = dark_data - bias
-        
-        # Divides each dark image (with bias subtracted) by the exposure time to get dark current, and adds to list
-        dark_bias_data.append(dark_data_no_bias / exptime) 
+    def correct_dark(dark_data, header, rows):
+        # Subtracts bias from each dark tile
+        dark_data_no_bias = dark_data - bias[rows]
 
-    # Reads the list of darks and sigma clips the arrays
-    dark_sc = sigma_clip(dark_bias_data, cenfunc='median', sigma=3, axis=0)
+        # Divides each dark tile (with bias subtracted) by the exposure time to get dark current
+        return dark_data_no_bias / header['EXPTIME']
 
-    # Creates a final 2D array that is the mean of each pixel from all different darks
-    median_dark = numpy.ma.mean(dark_sc, axis=0)
+    # Sigma clips the darks tile by tile and takes the mean of each pixel from all different darks
+    median_dark = combine_frames(dark_list, preprocess=correct_dark, sigma=3, trim=trim, memory_limit=memory_limit,
+                                 workers=workers, method=method, validate=validate)
 
     # Create a new FITS file from the resulting median dark frame.
-    dark_hdu = fits.PrimaryHDU(data=median_dark.data, header=fits.Header())
-    dark_hdu.header['EXPTIME'] = numpy.mean(exp_times)
-    dark_hdu.header['COMMENT'] = 'Combined dark image with bias subtracted'
-    hdul = fits.HDUList([dark_hdu])
-    hdul.writeto(median_dark_filename, overwrite=True)
+    header = fits.Header()
+    header['EXPTIME'] = numpy.mean(exp_times)
+    header['COMMENT'] = 'Combined dark image with bias subtracted'
+    write_frame(median_dark_filename, median_dark, header, output_format)
 
     
     return median_dark
@@ -1,63 +1,218 @@
 import glob
+import itertools
 import numpy
+import os
 import re
 from astropy.io import fits
-from photometry import do_aperture_photometry
-from photutils.centroids import centroid_sources, centroid_quadratic
+from cache import BuildCache
+from cube import CUBE_NAME, FrameCube
+from photometry import measure_apertures
+from registration import Registration, centroid_cutouts
+from store import FRAME_COLUMNS, STORE_NAME, PhotometryStore
 
 
-# Grabs all science files and sorts them numerically
-data_dir = '../../20250529/'
-reduced_science_files = sorted(glob.glob(data_dir + "reduced_science*"), key=lambda x: int(re.search(r'reduced_science(\d+)', x).group(1)))
+# After viewing the reduced file, the radii, annulus size, and positions are selected to perform aperture photometry
+RADII = [10]
+SKY_RADIUS_IN = 18
+SKY_ANNULUS_WIDTH = 4
 
 
-# After viewing the reduced file, the radii, annulus size, and positions are selected to perform aperture photometry
-radii = [10]
-sky_radius_in = 18
-sky_annulus_width = 4
+# x and y poistions of both target and comparison objects in the first file, where first entry is target and last two
+# are comparison. The positions in the other files are found by registering them against the first one, since the camera
+# drifts during the night
+X_POSITIONS = numpy.array([409, 387, 570])
+Y_POSITIONS = numpy.array([408, 520, 107])
+
+
+def find_reduced_science_files(data_dir):
+    "Grabs all reduced science files in data_dir and sorts them numerically"
+
+    return sorted(glob.glob(data_dir + "reduced_science*"),
+                  key=lambda x: int(re.search(r'reduced_science(\d+)', x).group(1)))
+
+
+def differential_photometry(
+    reduced_science_files,
+    x_positions=X_POSITIONS,
+    y_positions=Y_POSITIONS,
+    radii=RADII,
+    sky_radius_in=SKY_RADIUS_IN,
+    sky_annulus_width=SKY_ANNULUS_WIDTH,
+    store_path=None,
+    frames=None,
+):
+    """Light curve of the target (the first position) relative to the mean of the comparison
+    objects (the others), with positions measured on the first file. Returns the time in minutes
+    after the first observation and the flux ratio, as numpy arrays.
+
+    frames is an iterable of (i, data, header) of the frames named by reduced_science_files, in
+    the same order (see reduced_frames), which are read from the files if it isn't given. The
+    positions are those of the first frame it yields, whatever its index.
+
+    With store_path, each frame is also appended to a store.PhotometryStore there as it is
+    measured: its JD-OBS, time, ratio and file, and the flux, raw flux, sky and position of every
+    object with the first of radii.
+
+    """
+
+    x_positions = numpy.asarray(x_positions)
+    y_positions = numpy.asarray(y_positions)
+
+    # Creates empty lists of the time stamps, target flux, and comparison fluxes
+    time_stamps = []
+    target_flux = []
+    comparison_flux = []
+
+    if store_path is not None:
+        store = PhotometryStore.create(store_path, range(len(x_positions)), x_positions, y_positions, radius=radii[0],
+                                       sky_radius_in=sky_radius_in, sky_annulus_width=sky_annulus_width)
+
+    if frames is None:
+        frames = read_reduced_frames(reduced_science_files)
+
+    # Performs the aperture photometry given the information of the upper two comments
+    registration = None
+    for filename, (i, data, header) in zip(reduced_science_files, frames):
+        time_stamps.append(header['JD-OBS'])
+
+        # Estimates the shift of this file relative to the first one with an FFT cross-correlation of the binned images
+        if registration is None:
+            registration = Registration(data, binning=4)
+        dx, dy = registration.shift(data)
+
+        # Accurately finds the position of each object (target + comparisons), using only a cutout around each of them
+        # Creates a list of positions as a list of tuples for the objects to later perform aperture photometry
+        position = centroid_cutouts(data, x_positions + dx, y_positions + dy, box_size=35)
+
+        # Performs aperture photometry on the data already loaded, with one row of fluxes per position and one
+        # column per radius
+        result = measure_apertures(data, position, radii, sky_radius_in, sky_annulus_width, header=header)
+
+        # Appends flux of target and mean of the comparison objects to their respective lists
+        target_flux.append(result.fluxes[0, 0])
+        comparison_flux.append(numpy.mean(result.fluxes[1:, 0]))
+
+        if store_path is not None:
+            position = numpy.array(position)
+            store.append({'JD-OBS': header['JD-OBS'], 'TIME': (header['JD-OBS'] - time_stamps[0]) * 24 * 60,
+                          'RATIO': target_flux[-1] / comparison_flux[-1], 'SOURCE': filename},
+                         {'FLUX': result.fluxes[:, 0], 'RAW_FLUX': result.raw_fluxes[:, 0], 'SKY': result.sky,
+                          'X': position[:, 0], 'Y': position[:, 1]})
+
+    ratio = numpy.array(target_flux) / numpy.array(comparison_flux)
+    time = (numpy.array(time_stamps) - numpy.min(time_stamps)) * 24 * 60  # Sets time to minutes after first observation
+
+    return time, ratio
+
+
+def read_reduced_frames(reduced_science_files):
+    "Yields (i, data, header) for each reduced science file, reading them one at a time"
+
+    for i, filename in enumerate(reduced_science_files):
+        # getdata finds the image in the first extension of compressed frames, along with its header
+        data, header = fits.getdata(filename, header=True)
+        yield i, data.astype('f4'), header
+
+
+def reduced_frames(data_dir):
+    """Names of the reduced science frames of data_dir and an iterable of (i, data, header) over
+    them. The frames come from the cube.FrameCube saved by run_reduction with cube, through its
+    memory map, unless there are reduced science files newer than it."""
+
+    reduced_science_files = find_reduced_science_files(data_dir)
+    cube = FrameCube(data_dir + CUBE_NAME)
+
+    if len(cube) and all(os.path.getmtime(filename) <= os.path.getmtime(cube.table_filename)
+                         for filename in reduced_science_files):
+        return list(cube.table['SOURCE']), cube.stream()
+
+    return reduced_science_files, read_reduced_frames(reduced_science_files)
+
+
+def run_photometry(data_dir, output_dir='', **options):
+    """Measures the light curve of the reduced science frames of data_dir (see reduced_frames) with
+    differential_photometry (with options), and saves it to the store.PhotometryStore
+    {output_dir}photometry"""
+
+    names, frames = reduced_frames(data_dir)
+
+    return differential_photometry(names, store_path=output_dir + STORE_NAME, frames=frames, **options)
+
+
+def run_ensemble_photometry(
+    data_dir,
+    output_dir='',
+    target=(X_POSITIONS[0], Y_POSITIONS[0]),
+    threshold=5,
+    max_sources=None,
+    radius=RADII[0],
+    sky_radius_in=SKY_RADIUS_IN,
+    sky_annulus_width=SKY_ANNULUS_WIDTH,
+    workers=1,
+):
+    """Light curves of every star in the field against an ensemble of comparison stars.
+
+    - Detect the stars on the first reduced science frame of data_dir (see reduced_frames and
+      ensemble.detect_sources), the brightest max_sources of them if it is given.
+    - Measure all of them on every file (see ensemble.flux_matrix), with the gain and readout
+      noise saved by run_reduction if there are any, and make their light curves relative to the
+      weighted ensemble of the others (see ensemble.ensemble_photometry).
+    - The target is the star closest to target (x, y), and is left out of the ensemble.
+    - Save everything to the store.PhotometryStore {output_dir}photometry: the light curve of the
+      target (RATIO) and the ensemble (ENSEMBLE) of each frame, and the flux, its uncertainty
+      (if there is a gain) and the light curve (LIGHT_CURVE) of every star. The target, weights and
+      comparison stars are kept in its metadata.
+    - Return the time in minutes, the ratio of the target and the EnsembleResult.
+
+    """
 
+    from ensemble import detect_sources, ensemble_photometry, flux_matrix
 
-# x and y poistions of both target and comparison objects, where first entry is target and last two are comparison
-x_positions_1 = numpy.array([409, 387, 570]) # 1st set is a rough estimate of position for first 121 files
-y_positions_1 = numpy.array([408, 520, 107])
+    reduced_science_files, frames = reduced_frames(data_dir)
 
-x_positions_2 = numpy.array([485, 463, 645]) # 2nd set is a rough estimate of position for last 22 files since camera didn't center
-y_positions_2 = numpy.array([444, 560, 148])
+    # The first frame is read once, to find the stars and then to measure them
+    first = next(iter(frames))
+    frames = itertools.chain([first], frames)
+    reference = first[1]
 
+    border = sky_radius_in + sky_annulus_width + 10
+    x_positions, y_positions = detect_sources(reference, threshold, border=border, max_sources=max_sources)
+    target_index = numpy.argmin(numpy.hypot(x_positions - target[0], y_positions - target[1]))
+    print(f"Measuring {len(x_positions)} stars, with the target at ({x_positions[target_index]:.1f}, "
+          f"{y_positions[target_index]:.1f})")
 
-# Creates empty lists of the time stamps, target flux, and comparison fluxes
-time_stamps = []
-target_flux = []
-comparison_flux = []
+    # Uses the gain and readout noise measured by run_reduction for the uncertainties, if there are any
+    detector = dict()
+    cache = BuildCache(data_dir)
+    if 'ptc' in cache.manifest:
+        gain, readout_noise = cache.values('ptc')
+        detector = {'gain': gain, 'readout_noise': readout_noise}
 
+    times, fluxes, errors = flux_matrix(frames, x_positions, y_positions, radius,
+                                        sky_radius_in, sky_annulus_width, workers=workers, **detector)
+    result = ensemble_photometry(fluxes, errors, exclude=[target_index])
+    print(f"{result.comparison.sum()} comparison stars used after {result.iterations} iterations")
 
-# Performs the aperture photometry given the information of the upper two comments
-for i in range(len(reduced_science_files)):
-    science = fits.open(reduced_science_files[i])
-    time_stamps.append(science[0].header['JD-OBS'])
-    data = science[0].data.astype('f4') 
+    time = (times - numpy.min(times)) * 24 * 60  # Sets time to minutes after first observation
+    ratio = result.light_curves[:, target_index]
 
-    # Accurately finds the position of each object (target + 2 comparisons) 
-    # Creates a list of positions as a list of tuples for the 3 objects to later perform aperture photometry
-    if i<121:
-        tuple_array = centroid_sources(data - numpy.median(data), xpos=x_positions_1, ypos=y_positions_1, box_size=35, centroid_func=centroid_quadratic)
-        position = list(zip(tuple_array[0], tuple_array[1]))
-        
-    else:
-        tuple_array = centroid_sources(data - numpy.median(data), xpos=x_positions_2, ypos=y_positions_2, box_size=35, centroid_func=centroid_quadratic)
-        position = list(zip(tuple_array[0], tuple_array[1]))
+    star_columns = {'FLUX': '<f8', 'LIGHT_CURVE': '<f8'}
+    star_values = {'FLUX': fluxes, 'LIGHT_CURVE': result.light_curves}
+    if errors is not None:
+        star_columns['ERROR'] = '<f8'
+        star_values['ERROR'] = errors
 
-    # Performs aperture photometry and returns a dictionary in the format:
-    # {(x, y): [radii, fluxes, raw_fluxes]}, in this case will return a dictionary with 3 keys (the 3 different positions)
-    aperture_photometry_data = do_aperture_photometry(reduced_science_files[i], position, radii, sky_radius_in, sky_annulus_width)
-    
-    # Appends flux of target and mean of two comparison objects to their respective lists
-    target_flux.append(aperture_photometry_data[position[0]][1][0])
-    comparison_flux.append(1/2 * (aperture_photometry_data[position[1]][1][0] + aperture_photometry_data[position[2]][1][0])) 
+    store = PhotometryStore.create(output_dir + STORE_NAME, range(len(x_positions)), x_positions, y_positions,
+                                   frame_columns={**FRAME_COLUMNS, 'ENSEMBLE': '<f8'}, star_columns=star_columns,
+                                   radius=radius, sky_radius_in=sky_radius_in, sky_annulus_width=sky_annulus_width,
+                                   target=int(target_index), weights=result.weights.tolist(),
+                                   comparison=numpy.flatnonzero(result.comparison).tolist())
+    store.append({'JD-OBS': times, 'TIME': time, 'RATIO': ratio, 'ENSEMBLE': result.ensemble,
+                  'SOURCE': reduced_science_files}, star_values)
 
+    return time, ratio, result
 
-ratio = numpy.array(target_flux) / numpy.array(comparison_flux)
-time = (numpy.array(time_stamps) - numpy.min(time_stamps)) * 24 * 60  # Sets time to minutes after first observation
 
-numpy.save("times.npy", time)
-numpy.save("fluxes.npy", ratio)
\ No newline at end of file
+if __name__ == "__main__":
+
+    run_photometry('../../20250529/')
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: eclipsing.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import numpy
+
+# Algorithms of search_eclipses
+ECLIPSE_METHODS = ('bls', 'pdm')
+
+# Default widths of the box searched for eclipses, as fractions of the period
+DEFAULT_DURATIONS = (0.02, 0.05, 0.1, 0.2)
+
+# Default memory (in bytes) that the folded light curves of a chunk of trial periods may use
+DEFAULT_MEMORY_LIMIT = 256 * 1024**2
+
+# Peak bytes used per point and trial period while folding (the phases, the bin index and one
+# tiled copy of the weights), measured with tracemalloc on chunks of bls_statistic and pdm_statistic
+BYTES_PER_POINT = 24
+
+# Peak bytes used per phase bin and trial period by the binned folds and box_search (measured as
+# above, up to about 72 with wide boxes, rounded up; pdm_statistic only uses about 28)
+BYTES_PER_BIN = 80
+
+# Minimum depth / uncertainty of a secondary eclipse for it to count as detected
+DETECTION_THRESHOLD = 3
+
+
+def period_grid(times, minimum_period=None, maximum_period=None, n_bins=100, oversampling=1):
+    """Trial periods (in the units of times) evenly spaced in frequency, so that the phase of the
+    last point moves by 1 / (n_bins * oversampling) between trial periods, i.e. no more than one
+    phase bin. By default the periods go from 20 times the median spacing of the points to the
+    span of the light curve."""
+
+    times = numpy.sort(times)
+    baseline = times[-1] - times[0]
+
+    if minimum_period is None:
+        minimum_period = 20 * numpy.median(numpy.diff(times))
+    if maximum_period is None:
+        maximum_period = baseline
+
+    frequency_step = 1 / (n_bins * oversampling * baseline)
+    frequencies = numpy.arange(1 / maximum_period, 1 / minimum_period + frequency_step, frequency_step)
+
+    return 1 / frequencies[::-1]
+
+
+def period_chunks(n_periods, n_points, n_bins, memory_limit=DEFAULT_MEMORY_LIMIT):
+    "Slices of the trial periods that are folded together, so each chunk fits in memory_limit bytes"
+
+    chunk_size = max(1, int(memory_limit // (n_points * BYTES_PER_POINT + n_bins * BYTES_PER_BIN)))
+
+    return [slice(start, min(start + chunk_size, n_periods)) for start in range(0, n_periods, chunk_size)]
+
+
+def binned_folds(times, values, periods, n_bins):
+    """Folds the light curve at each of the periods and sums it in n_bins phase bins. Returns the
+    count, sum and sum of squares of values in each bin, as (periods, n_bins) arrays."""
+
+    phases = numpy.outer(1 / periods, times)
+    phases -= numpy.floor(phases)
+
+    # Index of the bin of each point in a flattened (periods, n_bins) array
+    index = (phases * n_bins).astype(numpy.intp)
+    numpy.minimum(index, n_bins - 1, out=index)
+    index += n_bins * numpy.arange(len(periods))[:, numpy.newaxis]
+    index = index.ravel()
+
+    size = len(periods) * n_bins
+    shape = (len(periods), n_bins)
+    counts = numpy.bincount(index, minlength=size).reshape(shape)
+    sums = numpy.bincount(index, weights=numpy.tile(values, len(periods)), minlength=size).reshape(shape)
+    squares = numpy.bincount(index, weights=numpy.tile(values**2, len(periods)), minlength=size).reshape(shape)
+
+    return counts, sums, squares
+
+
+def box_search(counts, sums, widths):
+    """Best box-shaped dip of folded light curves binned as by binned_folds, with values that
+    have zero mean. Tries boxes of every width (in bins) in widths starting at every bin,
+    wrapping around in phase. Returns the signal residue (the reduction in the sum of squares of
+    the light curve when the box is fitted), and the first bin and the width of the best box, for
+    each folded light curve."""
+
+    n_folds, n_bins = counts.shape
+    n_points = counts[0].sum()
+    rows = numpy.arange(n_folds)
+
+    # Cumulative sums over the bins repeated once, so boxes can wrap past phase 1
+    max_width = max(widths)
+    cumulative_counts = numpy.zeros((n_folds, n_bins + max_width + 1))
+    cumulative_sums = numpy.zeros((n_folds, n_bins + max_width + 1))
+    numpy.cumsum(numpy.concatenate([counts, counts[:, :max_width]], axis=1), axis=1, out=cumulative_counts[:, 1:])
+    numpy.cumsum(numpy.concatenate([sums, sums[:, :max_width]], axis=1), axis=1, out=cumulative_sums[:, 1:])
+
+    best_power = numpy.zeros(n_folds)
+    best_start = numpy.zeros(n_folds, dtype=int)
+    best_width = numpy.full(n_folds, widths[0])
+
+    for width in widths:
+        n_in = cumulative_counts[:, width:width + n_bins] - cumulative_counts[:, :n_bins]
+        s = cumulative_sums[:, width:width + n_bins] - cumulative_sums[:, :n_bins]
+
+        # Only dips (boxes below the mean) with points both in and out of them count
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            power = numpy.where((s < 0) & (n_in > 0) & (n_in < n_points), s**2 * n_points / (n_in * (n_points - n_in)), 0)
+
+        start = numpy.argmax(power, axis=1)
+        better = power[rows, start] > best_power
+        best_power[better] = power[rows, start][better]
+        best_start[better] = start[better]
+        best_width[better] = width
+
+    return best_power, best_start, best_width
+
+
+def bls_statistic(times, fluxes, periods, durations=DEFAULT_DURATIONS, n_bins=100, memory_limit=DEFAULT_MEMORY_LIMIT):
+    """Box least squares spectrum of a light curve: for each trial period, the fraction of the
+    variance of the fluxes explained by the best box-shaped dip with a width in durations
+    (fractions of the period), on the light curve folded in n_bins phase bins. The periods are
+    folded in chunks that use at most memory_limit bytes."""
+
+    values = fluxes - numpy.mean(fluxes)
+    total = numpy.sum(values**2)
+    widths = sorted({max(1, int(round(duration * n_bins))) for duration in durations})
+
+    power = numpy.empty(len(periods))
+    for chunk in period_chunks(len(periods), len(times), n_bins, memory_limit):
+        counts, sums, squares = binned_folds(times, values, periods[chunk], n_bins)
+        power[chunk] = box_search(counts, sums, widths)[0] / total
+
+    return power
+
+
+def pdm_statistic(times, fluxes, periods, n_bins=20, memory_limit=DEFAULT_MEMORY_LIMIT):
+    """Phase dispersion minimization statistic (Stellingwerf 1978) of a light curve: for each
+    trial period, the variance of the fluxes within n_bins phase bins over their total variance.
+    It is smallest at the true period. The periods are folded in chunks that use at most
+    memory_limit bytes."""
+
+    values = fluxes - numpy.mean(fluxes)
+    total_variance = numpy.var(values, ddof=1)
+
+    theta = numpy.empty(len(periods))
+    for chunk in period_chunks(len(periods), len(times), n_bins, memory_limit):
+        counts, sums, squares = binned_folds(times, values, periods[chunk], n_bins)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            within = numpy.where(counts > 0, squares - sums**2 / counts, 0).sum(axis=1)
+        degrees_of_freedom = len(times) - (counts > 0).sum(axis=1)
+        theta[chunk] = within / degrees_of_freedom / total_variance
+
+    return theta
+
+
+def peak_half_width(periods, statistic, best):
+    """Half width at half maximum, in period, of the peak of statistic (higher is better) at index
+    best, measured from the median of statistic"""
+
+    half = (statistic[best] + numpy.median(statistic)) / 2
+
+    low = best
+    while low > 0 and statistic[low - 1] > half:
+        low -= 1
+    high = best
+    while high < len(statistic) - 1 and statistic[high + 1] > half:
+        high += 1
+
+    return max(abs(periods[high] - periods[low]) / 2, abs(periods[min(best + 1, len(periods) - 1)] - periods[best]))
+
+
+class EclipseSolution:
+    """Eclipses of a binary found by measure_eclipses or search_eclipses.
+
+    - period and period_error, in the units of the times (period_error is None if the period
+      was given rather than searched for).
+    - epoch and epoch_error: time of the middle of a primary eclipse, near the middle of the
+      light curve.
+    - primary_depth and secondary_depth with their errors, as fractions of the flux out of
+      eclipse (1 - minimum / out), and the phase of the secondary eclipse after the primary one.
+    - primary_duration and secondary_duration, as fractions of the period.
+    - secondary_detected: whether the secondary is deeper than DETECTION_THRESHOLD times its error.
+    - periods and statistic: the spectrum searched by search_eclipses, if any.
+
+    """
+
+    def __init__(self, **values):
+
+        self.period_error = None
+        self.periods = None
+        self.statistic = None
+        self.__dict__.update(values)
+
+    def __repr__(self):
+
+        return (f"EclipseSolution(period={self.period:.6g}, epoch={self.epoch:.6g}, "
+                f"primary_depth={self.primary_depth:.4f}+-{self.primary_depth_error:.4f}, "
+                f"secondary_depth={self.secondary_depth:.4f}+-{self.secondary_depth_error:.4f})")
+
+
+def _phase_distance(phase, center):
+    "Distance in phase between phase and center, wrapping around"
+
+    distance = numpy.abs(phase - center) % 1
+
+    return numpy.minimum(distance, 1 - distance)
+
+
+def _best_box(phase, values, widths, n_bins, exclude=None):
+    """Center phase and duration (fractions of the period) of the deepest box in a folded light
+    curve, leaving out the points where exclude is True"""
+
+    keep = slice(None) if exclude is None else ~exclude
+    counts, sums, squares = binned_folds(phase[keep], values[keep] - numpy.mean(values[keep]), numpy.ones(1), n_bins)
+    power, start, width = box_search(counts, sums, widths)
+
+    return ((start[0] + width[0] / 2) / n_bins) % 1, width[0] / n_bins
+
+
+def measure_eclipses(times, fluxes, period, durations=DEFAULT_DURATIONS, n_bins=100):
+    """Finds the primary and secondary eclipses of a light curve folded at period.
+
+    - The primary eclipse is the deepest box-shaped dip (of a width in durations, fractions of
+      the period, in n_bins phase bins), and the secondary the deepest one outside it.
+    - The bottom of each eclipse is found by fitting a parabola to the points in its box, whose
+      covariance gives the error of the epoch and of the flux at the bottom (the mean flux in
+      the box is used if the fit fails).
+    - Depths are the flux at the bottom against the mean of the points outside both eclipses.
+    - Return an EclipseSolution.
+
+    """
+
+    times = numpy.asarray(times, dtype='f8')
+    fluxes = numpy.asarray(fluxes, dtype='f8')
+    finite = numpy.isfinite(times) & numpy.isfinite(fluxes)
+    times, fluxes = times[finite], fluxes[finite]
+
+    widths = sorted({max(1, int(round(duration * n_bins))) for duration in durations})
+    phase = (times / period) % 1
+
+    primary_phase, primary_duration = _best_box(phase, fluxes, widths, n_bins)
+    in_primary = _phase_distance(phase, primary_phase) < primary_duration / 2
+
+    # The wings of the primary, just outside its box, can't be the secondary
+    near_primary = _phase_distance(phase, primary_phase) < primary_duration
+    secondary_phase, secondary_duration = _best_box(phase, fluxes, widths, n_bins, exclude=near_primary)
+    in_secondary = (_phase_distance(phase, secondary_phase) < secondary_duration / 2) & ~in_primary
+
+    out_of_eclipse = ~(in_primary | in_secondary)
+    mean_out = numpy.mean(fluxes[out_of_eclipse])
+    scatter = numpy.std(fluxes[out_of_eclipse], ddof=1)
+    n_out = out_of_eclipse.sum()
+
+    def minimum(in_eclipse, center, duration):
+        """Phase and flux of the bottom of an eclipse with their errors, from a parabola fitted to
+        its points, or the middle of the box and the mean flux in it if the fit doesn't work"""
+
+        n_in = in_eclipse.sum()
+        if n_in == 0:
+            return center, duration / numpy.sqrt(12), mean_out, numpy.inf
+
+        mean_in = numpy.mean(fluxes[in_eclipse])
+        fallback = center, duration / numpy.sqrt(12), mean_in, scatter / numpy.sqrt(n_in)
+        if n_in <= 3:
+            return fallback
+
+        offset = (phase[in_eclipse] - center + 0.5) % 1 - 0.5
+        (a, b, c), covariance = numpy.polyfit(offset, fluxes[in_eclipse], 2, cov=True)
+        if a <= 0 or abs(b / (2 * a)) > duration / 2:
+            return fallback
+
+        vertex = -b / (2 * a)
+        vertex_gradient = numpy.array([b / (2 * a**2), -1 / (2 * a), 0])
+        value_gradient = numpy.array([b**2 / (4 * a**2), -b / (2 * a), 1])
+
+        return (center + vertex, numpy.sqrt(vertex_gradient @ covariance @ vertex_gradient),
+                c - b**2 / (4 * a), numpy.sqrt(value_gradient @ covariance @ value_gradient))
+
+    def depth(flux, flux_error):
+        error = numpy.hypot(flux_error / mean_out, flux * scatter / numpy.sqrt(n_out) / mean_out**2)
+        return 1 - flux / mean_out, error
+
+    # The middle and the depth of each eclipse are measured at its bottom
+    primary_phase, center_error, primary_flux, primary_flux_error = minimum(in_primary, primary_phase,
+                                                                            primary_duration)
+    secondary_phase, secondary_error, secondary_flux, secondary_flux_error = minimum(in_secondary, secondary_phase,
+                                                                                     secondary_duration)
+    primary_depth, primary_depth_error = depth(primary_flux, primary_flux_error)
+    secondary_depth, secondary_depth_error = depth(secondary_flux, secondary_flux_error)
+
+    # Epoch of the primary eclipse closest to the middle of the light curve
+    epoch = primary_phase * period
+    epoch += numpy.round((numpy.mean(times) - epoch) / period) * period
+
+    return EclipseSolution(
+        period=period,
+        epoch=epoch,
+        epoch_error=center_error * period,
+        primary_depth=primary_depth,
+        primary_depth_error=primary_depth_error,
+        primary_duration=primary_duration,
+        secondary_phase=(secondary_phase - primary_phase) % 1,
+        secondary_depth=secondary_depth,
+        secondary_depth_error=secondary_depth_error,
+        secondary_duration=secondary_duration,
+        secondary_detected=secondary_depth > DETECTION_THRESHOLD * secondary_depth_error,
+    )
+
+
+def search_eclipses(
+    times,
+    fluxes,
+    periods=None,
+    method='bls',
+    durations=DEFAULT_DURATIONS,
+    n_bins=100,
+    memory_limit=DEFAULT_MEMORY_LIMIT,
+):
+    """Finds the period and the eclipses of an eclipsing binary.
+
+    - Search the trial periods (by default period_grid(times, n_bins=n_bins)) with method:
+      'bls' (bls_statistic with durations) or 'pdm' (pdm_statistic), folding chunks of periods
+      within memory_limit bytes.
+    - Measure the eclipses at the best period with measure_eclipses. If no secondary eclipse is
+      found there but two are found half an orbit apart at twice the period, with depths that
+      differ by more than DETECTION_THRESHOLD times their error, the best period was half the
+      orbit (two different eclipses folded on top of each other), and twice the period is used
+      instead. Equal dips at twice the period are the same eclipse, which folding always finds
+      at phase 0.5.
+    - The period error is the half width of the peak of the spectrum.
+    - Return an EclipseSolution, with the spectrum as periods and statistic.
+
+    """
+
+    if method not in ECLIPSE_METHODS:
+        raise ValueError(f"method must be one of {ECLIPSE_METHODS}, not {method!r}")
+
+    times = numpy.asarray(times, dtype='f8')
+    fluxes = numpy.asarray(fluxes, dtype='f8')
+    finite = numpy.isfinite(times) & numpy.isfinite(fluxes)
+    times, fluxes = times[finite], fluxes[finite]
+
+    if periods is None:
+        periods = period_grid(times, n_bins=n_bins)
+    periods = numpy.asarray(periods, dtype='f8')
+
+    if method == 'bls':
+        statistic = bls_statistic(times, fluxes, periods, durations, n_bins, memory_limit)
+        score = statistic
+    else:
+        statistic = pdm_statistic(times, fluxes, periods, memory_limit=memory_limit)
+        score = -statistic
+
+    best = numpy.argmax(score)
+    period_error = peak_half_width(periods, score, best)
+    solution = measure_eclipses(times, fluxes, periods[best], durations, n_bins)
+
+    if not solution.secondary_detected:
+        doubled = measure_eclipses(times, fluxes, 2 * periods[best], durations, n_bins)
+        different = (abs(doubled.primary_depth - doubled.secondary_depth)
+                     > DETECTION_THRESHOLD * numpy.hypot(doubled.primary_depth_error, doubled.secondary_depth_error))
+        if doubled.secondary_detected and abs(doubled.secondary_phase - 0.5) < 0.1 and different:
+            solution = doubled
+            period_error *= 2
+
+    solution.period_error = period_error
+    solution.periods = periods
+    solution.statistic = statistic
+
+    return solution
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: ensemble.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from photometry import measure_apertures
+from registration import Registration
+
+# Number of frames measured together by flux_matrix, which is how many are kept in memory at once
+DEFAULT_BATCH_SIZE = 8
+
+
+def detect_sources(data, threshold=5, fwhm=4, border=30, max_sources=None):
+    """Stars in a reduced frame, found with DAOStarFinder at threshold times the sigma-clipped
+    standard deviation of the background.
+
+    Stars closer than border pixels to an edge (where the sky annulus or the drift of the
+    telescope would take them off the frame) are left out. Returns the x and y positions as numpy
+    arrays, brightest first, keeping only the max_sources brightest if it is given.
+
+    """
+
+    from astropy.stats import sigma_clipped_stats
+    from photutils.detection import DAOStarFinder
+
+    mean, median, std = sigma_clipped_stats(data, sigma=3)
+    sources = DAOStarFinder(fwhm=fwhm, threshold=threshold * std)(data - median)
+    if sources is None:
+        return numpy.empty(0), numpy.empty(0)
+
+    # photutils 3 renamed the centroid columns
+    prefix = 'x_centroid' in sources.colnames
+    x = numpy.asarray(sources['x_centroid' if prefix else 'xcentroid'], dtype='f8')
+    y = numpy.asarray(sources['y_centroid' if prefix else 'ycentroid'], dtype='f8')
+    inside = (x >= border) & (x < data.shape[1] - border) & (y >= border) & (y < data.shape[0] - border)
+
+    order = numpy.argsort(-numpy.asarray(sources['flux'])[inside])[:max_sources]
+
+    return x[inside][order], y[inside][order]
+
+
+def flux_matrix(
+    frames,
+    x_positions,
+    y_positions,
+    radius=10,
+    sky_radius_in=18,
+    sky_annulus_width=4,
+    binning=4,
+    gain=None,
+    readout_noise=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    workers=1,
+):
+    """This function must:
+
+    - Accept an iterable of (i, data, header) as frames, such as
+      pipeline.stream_reduced_frames or cube.FrameCube.stream, and the positions of N stars in
+      the first frame (e.g. from detect_sources).
+    - Register each frame against the first one (see registration.Registration) and measure all
+      the stars at once with measure_apertures, with an aperture of radius.
+    - Measure batch_size frames at a time, up to workers of them at the same time, so that only
+      batch_size frames are in memory.
+    - Return the JD-OBS of each frame, and the (M frames x N stars) matrix of sky-subtracted
+      fluxes and of their uncertainties. The uncertainties (photon noise of the star and the
+      sky, and readout noise) are only computed if gain (e-/ADU) and readout_noise (e-) are
+      given, and are None otherwise.
+
+    """
+
+    x_positions = numpy.asarray(x_positions, dtype='f8')
+    y_positions = numpy.asarray(y_positions, dtype='f8')
+    area = numpy.pi * radius**2
+
+    registration = None
+    times = []
+    fluxes = []
+    errors = []
+
+    def measure(frame):
+        i, data, header = frame
+        dx, dy = registration.shift(data)
+        positions = numpy.column_stack([x_positions + dx, y_positions + dy])
+        result = measure_apertures(data, positions, [radius], sky_radius_in, sky_annulus_width)
+
+        flux = result.fluxes[:, 0]
+        error = None
+        if gain is not None and readout_noise is not None:
+            # In ADU: star and sky photon noise, and readout noise, over the area of the aperture
+            error = numpy.sqrt(numpy.maximum(flux, 0) / gain + area * numpy.maximum(result.sky, 0) / gain
+                               + area * (readout_noise / gain)**2)
+
+        return header['JD-OBS'], flux, error
+
+    def measure_batch(batch):
+        if workers == 1:
+            results = [measure(frame) for frame in batch]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(measure, batch))
+
+        for time, flux, error in results:
+            times.append(time)
+            fluxes.append(flux)
+            errors.append(error)
+
+    batch = []
+    for frame in frames:
+        if registration is None:
+            registration = Registration(frame[1], binning=binning)
+
+        batch.append(frame)
+        if len(batch) == batch_size:
+            measure_batch(batch)
+            batch = []
+    measure_batch(batch)
+
+    fluxes = numpy.array(fluxes).reshape(len(times), len(x_positions))
+    errors = numpy.array(errors).reshape(fluxes.shape) if gain is not None and readout_noise is not None else None
+
+    return numpy.array(times), fluxes, errors
+
+
+class EnsembleResult:
+    """Light curves of every star relative to an ensemble of comparison stars.
+
+    - light_curves: (frames x stars) flux of each star divided by the ensemble (leaving the star
+      itself out of it), normalized to a median of 1.
+    - ensemble: weighted mean of the normalized fluxes of the comparison stars in each frame.
+    - weights: weight of each star in the ensemble (0 for the ones that aren't used).
+    - comparison: mask of the stars used as comparisons.
+    - scatter: robust standard deviation of the light curve of each star.
+    - iterations: number of times the ensemble was recomputed.
+
+    """
+
+    def __init__(self, light_curves, ensemble, weights, comparison, scatter, iterations):
+
+        self.light_curves = light_curves
+        self.ensemble = ensemble
+        self.weights = weights
+        self.comparison = comparison
+        self.scatter = scatter
+        self.iterations = iterations
+
+
+def robust_std(values, axis=0):
+    "Standard deviation from the median absolute deviation, ignoring NaNs"
+
+    median = numpy.nanmedian(values, axis=axis, keepdims=True)
+
+    return 1.4826 * numpy.nanmedian(numpy.abs(values - median), axis=axis)
+
+
+def relative_fluxes(normalized, comparison, weights):
+    """Each star's normalized fluxes divided by the weighted mean of the comparison stars without
+    itself, normalized to a median of 1, and that weighted mean of all the comparisons"""
+
+    # Weighted sum of the comparisons, from which each star takes itself out
+    comparisons = numpy.where(comparison, normalized, 0) * numpy.where(comparison, weights, 0)
+    weighted = comparisons.sum(axis=1)
+    total = numpy.where(comparison, weights, 0).sum()
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        others = (weighted[:, numpy.newaxis] - comparisons) / (total - numpy.where(comparison, weights, 0))
+        relative = normalized / others
+        relative /= numpy.nanmedian(relative, axis=0)
+
+    return relative, weighted / total
+
+
+def ensemble_photometry(fluxes, errors=None, exclude=(), rejection_sigma=3, max_iterations=10):
+    """This function must:
+
+    - Accept the (frames x stars) matrix of fluxes from flux_matrix, and optionally their
+      uncertainties, and the indices of stars that must not be comparisons (e.g. the target) as
+      exclude.
+    - Normalize each star by its median flux, and make the ensemble as the weighted mean of the
+      normalized comparison stars in each frame, starting with weights from their brightness (or
+      their uncertainties).
+    - Measure the scatter of each star relative to the ensemble without itself, weight each
+      comparison by 1 / scatter^2, so noisy and variable stars count less, and reject the
+      comparisons whose scatter is more than rejection_sigma above what their noise explains
+      (their uncertainties, or photon noise from their brightness). Repeat until no more are
+      rejected, at most max_iterations times.
+    - Return an EnsembleResult with the light curve of every star.
+
+    All the stars are handled at once: the ensemble without star j is the weighted sum of all of
+    them minus star j, so there is no loop over the stars.
+
+    """
+
+    median_flux = numpy.nanmedian(fluxes, axis=0)
+    comparison = numpy.isfinite(median_flux) & (median_flux > 0) & numpy.all(numpy.isfinite(fluxes), axis=0)
+    comparison[list(exclude)] = False
+    if not comparison.any():
+        raise ValueError("There are no stars with finite, positive fluxes to use as comparisons")
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        normalized = fluxes / median_flux
+
+        # Noise each star is expected to have, up to a constant factor
+        if errors is not None:
+            expected = numpy.nanmedian(errors / fluxes, axis=0)
+        else:
+            expected = 1 / numpy.sqrt(median_flux)
+    weights = numpy.where(comparison, 1 / expected**2, 0)
+
+    for iteration in range(1, max_iterations + 1):
+        relative, ensemble = relative_fluxes(normalized, comparison, weights)
+        scatter = robust_std(relative)
+        weights = numpy.where(comparison, 1 / scatter**2, 0)
+
+        # Compares the scatter of the comparisons with the noise they should have, in log so the
+        # rejection doesn't depend on the constant factor of expected
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            excess = numpy.log(scatter / expected)
+        center = numpy.median(excess[comparison])
+        spread = max(robust_std(excess[comparison]), 1e-3)
+        rejected = comparison & ~(excess <= center + rejection_sigma * spread)
+
+        # Keeps at least two comparisons, so every star has an ensemble without itself
+        if not rejected.any() or numpy.count_nonzero(comparison & ~rejected) < 2:
+            break
+        comparison &= ~rejected
+        weights[rejected] = 0
+
+    # The light curves relative to the final weights
+    relative, ensemble = relative_fluxes(normalized, comparison, weights)
+    weights = numpy.where(comparison, weights, 0)
+
+    return EnsembleResult(relative, ensemble, weights, comparison, robust_std(relative), iteration)
@@ -5,16 +5,21 @@
 # @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
 
 from astropy.io import fits
-from astropy.stats import sigma_clip
+from combine import DEFAULT_MEMORY_LIMIT, combine_frames
+from frames import DEFAULT_TRIM, write_frame
 import numpy
-from astropy.visualization import ImageNormalize, LinearStretch, ZScaleInterval
-from matplotlib import pyplot as plt
 
 def create_median_flat(
     flat_list,
     bias_filename,
     median_flat_filename,
     dark_filename,
+    memory_limit=DEFAULT_MEMORY_LIMIT,
+    workers=1,
+    method='astropy',
+    validate=False,
+    trim=DEFAULT_TRIM,
+    output_format='fits',
 ):
     """This function must:
 
@@ -35,40 +40,32 @@ def create_median_flat(
       median_flat_filename.
     - Return the normalised median flat frame as a 2D numpy array.
 
+    With output_format='compressed' the master is saved tile-compressed without loss (see
+    frames.write_frame).
+
     """
 
     bias = fits.getdata(bias_filename)
 
-    dark = fits.getdata(dark_filename)
-    dark_file = fits.open(dark_filename)
-    dark_exptime = dark_file[0].header['EXPTIME']
-
-    flat_bias_data = []
-
-    # Will read each file and append to dark_bias_data list where the arrays have dtype = float32
-    for file in flat_list:
-        flat = fits.open(file)
-        flat_data = flat[0].data[100:-100, 100:-100].astype('f4')
-        flat_exptime = flat[0].header['EXPTIME']
+    dark, dark_header = fits.getdata(dark_filename, header=True)
+    dark_exptime = dark_header['EXPTIME']
 
-        # Subtracts bias from each flat and adds to flat_bias_data list
-        flat_bias_data.append(flat_data - bias - dark * flat_exptime / dark_exptime) 
+    def correct_flat(flat_data, header, rows):
+        # Subtracts bias and the dark scaled to the flat exposure time from each flat tile
+        return flat_data - bias[rows] - dark[rows] * header['EXPTIME'] / dark_exptime
 
-    # Reads the list of flats and sigma clips the arrays
-    flat_sc = sigma_clip(flat_bias_data, cenfunc='median', sigma=3, axis=0)
-
-    # Creates a final 2D array that is the mean of each pixel from all different flats, and then divides by the median 
-    # flat value to normalize
-    flat = numpy.ma.mean(flat_sc, axis=0)
+    # Sigma clips the flats tile by tile and creates a final 2D array that is the mean of each pixel from all
+    # different flats, and then divides by the median flat value to normalize
+    flat = combine_frames(flat_list, preprocess=correct_flat, sigma=3, trim=trim, memory_limit=memory_limit,
+                          workers=workers, method=method, validate=validate)
 
     # Normalizes the resulting flat to get the median flat
     median_flat = flat / numpy.median(flat)
 
     # Create a new FITS file from the resulting median dark frame.
-    flat_hdu = fits.PrimaryHDU(data=median_flat.data, header=fits.Header())
-    flat_hdu.header['COMMENT'] = 'Normalized flat image with bias subtracted'
-    hdul = fits.HDUList([flat_hdu])
-    hdul.writeto(median_flat_filename, overwrite=True)
+    header = fits.Header()
+    header['COMMENT'] = 'Normalized flat image with bias subtracted'
+    write_frame(median_flat_filename, median_flat, header, output_format)
  
     return median_flat
 
@@ -91,9 +88,11 @@ def plot_flat(
 
     """
 
+    from astropy.visualization import ImageNormalize, LinearStretch, ZScaleInterval
+    from matplotlib import pyplot as plt
+
     # Reads the normalized flat file
-    flat = fits.open(median_flat_filename)
-    flat_data = flat[0].data.astype('f4')
+    flat_data = fits.getdata(median_flat_filename).astype('f4')
 
     # Plots and saves the flat frame using imshow
     plt.figure()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: frames.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import re
+
+from astropy.io import fits
+from metrics import count_bytes, count_written
+import numpy
+
+# Number of pixels trimmed from each edge of the raw frames, where the detector is nonuniform
+DEFAULT_TRIM = 100
+
+# Formats the master and reduced frames can be written in: plain FITS, or a tile-compressed image in
+# the first extension of the file
+OUTPUT_FORMATS = ('fits', 'compressed')
+
+# Shape of the tiles of compressed frames, which are decompressed one by one when reading a section
+COMPRESSION_TILE_SHAPE = (64, 64)
+
+# Quantization level of lossy science frames: the step is the noise of each tile divided by it
+DEFAULT_QUANTIZE_LEVEL = 16
+
+
+def trim_section(header, trim=DEFAULT_TRIM):
+    """Rows and columns (as slices) of the part of a raw frame that is kept.
+
+    trim is either the number of pixels removed from each edge, or 'DATASEC' to use the
+    [x1:x2,y1:y2] section (1-based, inclusive) given by the DATASEC keyword of the header.
+
+    """
+
+    if trim == 'DATASEC':
+        x1, x2, y1, y2 = map(int, re.findall(r'\d+', header['DATASEC']))
+        return slice(y1 - 1, y2), slice(x1 - 1, x2)
+
+    return slice(trim, header['NAXIS2'] - trim), slice(trim, header['NAXIS1'] - trim)
+
+
+def open_frame(filename):
+    """Opens a FITS file memory-mapped, without scaling the data, so that sections of it can be read
+    with read_section without loading the whole frame"""
+
+    # astropy can't scale a memory-mapped image, so read_section applies BSCALE/BZERO itself
+    return fits.open(filename, memmap=True, do_not_scale_image_data=True)
+
+
+def image_hdu(hdul):
+    """HDU with the image of a frame: the primary HDU, or the first extension when the primary one
+    is empty, as in tile-compressed files"""
+
+    if hdul[0].header.get('NAXIS', 0) == 0 and len(hdul) > 1:
+        return hdul[1]
+
+    return hdul[0]
+
+
+def read_section(hdu, rows, columns, out=None):
+    """Reads hdu.data[rows, columns] from an HDU opened with open_frame as float32, converting it
+    exactly once. out can be a preallocated float32 array to read into (it is only used if it has
+    the right shape). Of a tile-compressed HDU, only the tiles that overlap the section are
+    decompressed."""
+
+    raw = hdu.section[rows, columns]
+    count_bytes(read=raw.nbytes)
+    if out is None or out.shape != raw.shape:
+        out = numpy.empty(raw.shape, dtype='f4')
+    out[...] = raw
+
+    bscale = hdu.header.get('BSCALE', 1)
+    bzero = hdu.header.get('BZERO', 0)
+    if bscale != 1:
+        out *= bscale
+    if bzero != 0:
+        out += bzero
+
+    return out
+
+
+def read_frame(filename, trim=DEFAULT_TRIM, out=None):
+    """Reads only the trimmed section (see trim_section) of the image of a FITS file (see image_hdu) as float32.
+
+    out can be a preallocated float32 array to reuse when reading many frames in a loop. Returns
+    the data and the header.
+
+    """
+
+    with open_frame(filename) as hdul:
+        hdu = image_hdu(hdul)
+        header = hdu.header
+        rows, columns = trim_section(header, trim)
+        data = read_section(hdu, rows, columns, out)
+
+    return data, header
+
+
+def write_frame(filename, data, header=None, output_format='fits', quantize_level=None):
+    """This function must:
+
+    - Save data with header to filename, replacing it, as float32 unless it has another float dtype.
+    - With output_format='fits', write it as the primary HDU.
+    - With output_format='compressed', write it tile-compressed (in COMPRESSION_TILE_SHAPE tiles)
+      in the first extension, with the same header: losslessly (GZIP_2, which shuffles the bytes
+      of the floats) without quantize_level, or quantized to 1 / quantize_level of the noise of
+      each tile and RICE_1 compressed. The dither is seeded from the data, so the same frame is
+      always written the same way, and a HISTORY card records the quantization.
+
+    """
+
+    from astropy.io.fits.hdu.compressed import DITHER_SEED_CHECKSUM, SUBTRACTIVE_DITHER_1
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}, not {output_format!r}")
+
+    if data.dtype.kind != 'f':
+        data = data.astype('f4')
+    header = fits.Header() if header is None else header.copy()
+
+    if output_format == 'fits':
+        hdul = fits.HDUList([fits.PrimaryHDU(data=data, header=header)])
+    elif quantize_level is None:
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data=data, header=header, compression_type='GZIP_2',
+                                                                  quantize_level=0,
+                                                                  tile_shape=COMPRESSION_TILE_SHAPE)])
+    else:
+        header['HISTORY'] = f"Quantized to 1/{quantize_level:g} of the noise of each tile (lossy)"
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data=data, header=header, compression_type='RICE_1',
+                                                                  quantize_level=quantize_level,
+                                                                  quantize_method=SUBTRACTIVE_DITHER_1,
+                                                                  dither_seed=DITHER_SEED_CHECKSUM,
+                                                                  tile_shape=COMPRESSION_TILE_SHAPE)])
+
+    hdul.writeto(filename, overwrite=True)
+    count_written(filename)
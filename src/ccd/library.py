@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: library.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import bisect
+import glob
+import json
+import os
+
+from astropy.io import fits
+from astropy.time import Time
+from bias import create_median_bias
+from cache import BuildCache
+from darks import create_median_dark
+from flats import create_median_flat
+from frames import DEFAULT_TRIM
+from ptc import calculate_gain, calculate_readout_noise
+from science import CalibrationContext
+
+# Name of the index written in the directory of a calibration library
+LIBRARY_INDEX_FILENAME = 'calibration-index.json'
+
+# Raw calibration frames of a night, in the order they are combined (each needs the ones before)
+RAW_PATTERNS = {'bias': 'Bias*', 'dark': 'Dark*', 'flat': 'domeflat*'}
+
+# Header keywords the CCD temperature can be under, in order of preference
+TEMPERATURE_KEYWORDS = ('CCD-TEMP', 'CCDTEMP', 'CCD_TEMP', 'SET-TEMP')
+
+
+def frame_metadata(filename):
+    """Date (JD), filter, exposure time, binning ('XxY') and CCD temperature of a raw frame, from
+    its header. The date falls back to DATE-OBS and then to the modification time of the file."""
+
+    header = fits.getheader(filename)
+
+    if 'JD-OBS' in header:
+        date = float(header['JD-OBS'])
+    elif 'DATE-OBS' in header:
+        date = Time(header['DATE-OBS']).jd
+    else:
+        date = Time(os.path.getmtime(filename), format='unix').jd
+
+    x_binning = header.get('XBINNING', header.get('CCDXBIN', 1))
+    y_binning = header.get('YBINNING', header.get('CCDYBIN', 1))
+    temperature = next((float(header[key]) for key in TEMPERATURE_KEYWORDS if key in header), None)
+
+    return {
+        'date': date,
+        'filter': header.get('FILTER'),
+        'exptime': float(header.get('EXPTIME', 0)),
+        'binning': f"{x_binning}x{y_binning}",
+        'temperature': temperature,
+    }
+
+
+def bucket_key(kind, binning, filter=None):
+    "Index bucket of a master: its kind and binning, and for flats also its filter"
+
+    return (kind, binning, filter if kind == 'flat' else None)
+
+
+class CalibrationLibrary:
+    """Master frames of many nights, indexed by date, filter, exposure time, binning and CCD
+    temperature, so that nights without their own calibrations can be reduced with the closest
+    ones.
+
+    - Accept the directory of the library, where the masters and the index
+      (calibration-index.json) are kept. It is created if it doesn't exist.
+    - add_night combines the calibration frames of a night into masters, once: nights whose
+      frames were already added are skipped.
+    - find returns the master of a kind with the same binning (and filter, for flats) that was
+      taken closest in time, among those within max_temperature_difference degrees of the
+      requested temperature. The masters are kept in buckets of the same kind, binning and filter,
+      sorted by date, so a lookup is a dictionary access and a bisection, followed by a walk past
+      the closest masters only if they were taken at another temperature or with another trim.
+    - calibration_for loads (once) the CalibrationContext of the best masters for a science frame,
+      and can be passed to science.reduce_science_frame instead of the master filenames.
+
+    """
+
+    def __init__(self, directory, max_temperature_difference=5):
+
+        self.directory = directory
+        self.max_temperature_difference = max_temperature_difference
+        self.filename = os.path.join(directory, LIBRARY_INDEX_FILENAME)
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.exists(self.filename):
+            with open(self.filename) as file:
+                self.entries = json.load(file)['entries']
+        else:
+            self.entries = []
+
+        # Entries of each bucket sorted by date, and their dates to bisect
+        self.buckets = dict()
+        for entry in self.entries:
+            self._insert(entry)
+
+        # CalibrationContexts already loaded, by the filenames of their masters
+        self.contexts = dict()
+
+    def _insert(self, entry):
+
+        entries, dates = self.buckets.setdefault(bucket_key(entry['kind'], entry['binning'], entry['filter']), ([], []))
+        position = bisect.bisect(dates, entry['date'])
+        entries.insert(position, entry)
+        dates.insert(position, entry['date'])
+
+    def path(self, entry):
+        "Absolute filename of the master of an entry (the index stores it relative to the library)"
+
+        return os.path.join(self.directory, entry['filename'])
+
+    def save(self):
+        "Writes the index, through a temporary file so an interrupted run can't leave it broken"
+
+        with open(self.filename + '.tmp', 'w') as file:
+            json.dump({'entries': self.entries}, file, indent=2)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def find(self, kind, date, binning='1x1', filter=None, exptime=None, temperature=None, trim=None):
+        """Index entry of the best master of kind ('bias', 'dark' or 'flat') for a frame taken at
+        date (JD) with the given binning, filter, exposure time and temperature, and if trim is
+        given, combined with that trim. Darks taken on the same date are told apart by how close
+        their exposure time is. Returns None if there is no master that matches."""
+
+        entries, dates = self.buckets.get(bucket_key(kind, binning, filter), ([], []))
+
+        def matches(entry):
+            if trim is not None and entry['trim'] != trim:
+                return False
+            return (temperature is None or entry['temperature'] is None
+                    or abs(entry['temperature'] - temperature) <= self.max_temperature_difference)
+
+        def distance(entry):
+            return (abs(entry['date'] - date), abs(entry['exptime'] - exptime) if exptime is not None else 0)
+
+        # Walks out from the date in both directions until the closest matching master on each side
+        position = bisect.bisect(dates, date)
+        best = None
+        for candidates in (range(position - 1, -1, -1), range(position, len(entries))):
+            for i in candidates:
+                if matches(entries[i]):
+                    if best is None or distance(entries[i]) < distance(best):
+                        best = entries[i]
+                    break
+
+        return best
+
+    def masters_for(self, science_filename, trim=None):
+        """Index entries of the bias, dark and flat that best match a science frame (see find),
+        raising a FileNotFoundError if the library has no master of one of them"""
+
+        metadata = frame_metadata(science_filename)
+        masters = []
+
+        for kind in ('bias', 'dark', 'flat'):
+            entry = self.find(kind, metadata['date'], metadata['binning'], metadata['filter'], metadata['exptime'],
+                              metadata['temperature'], trim)
+            if entry is None:
+                raise FileNotFoundError(f"The calibration library in {self.directory} has no {kind} for "
+                                        f"{science_filename} (binning {metadata['binning']}, filter "
+                                        f"{metadata['filter']})")
+            masters.append(entry)
+
+        return masters
+
+    def calibration_for(self, science_filename, trim=None):
+        "CalibrationContext of the best masters for a science frame, loaded once for all the frames that use them"
+
+        bias, dark, flat = self.masters_for(science_filename, trim)
+        filenames = (self.path(bias), self.path(flat), self.path(dark))
+
+        if filenames not in self.contexts:
+            self.contexts[filenames] = CalibrationContext(*filenames)
+
+        return self.contexts[filenames]
+
+    def add_night(self, data_dir, trim=DEFAULT_TRIM, workers=1, method='astropy', output_format='fits'):
+        """This function must:
+
+        - Accept the directory of a night with raw calibration frames (Bias*, Dark*, domeflat*).
+        - Group them by binning (and flats also by filter) and combine each group into a master
+          in {library}/{night}/, the darks with the bias of the night (or the closest one in the
+          library) and the flats with its bias and dark, as run_reduction does.
+        - Record each master in the index with the date, filter, exposure time, binning and
+          temperature of its first frame, and for the biases also the gain and readout noise of
+          the night (see ptc) when there are two flats and two biases.
+        - Save the masters in output_format (see frames.write_frame), always losslessly.
+        - Skip the groups that are already in the library, so adding a night again is free.
+        - Return the entries of the masters that were built.
+
+        """
+
+        night = os.path.basename(os.path.normpath(data_dir))
+        night_dir = os.path.join(self.directory, night)
+        os.makedirs(night_dir, exist_ok=True)
+
+        cache = BuildCache(self.directory)
+        parameters = {'trim': trim, 'method': method}
+        if output_format != 'fits':
+            parameters['output_format'] = output_format
+        known_keys = {entry['key'] for entry in self.entries}
+
+        # Raw frames of each kind, grouped by their bucket
+        groups = dict()
+        for kind, pattern in RAW_PATTERNS.items():
+            for filename in sorted(glob.glob(os.path.join(data_dir, pattern))):
+                metadata = frame_metadata(filename)
+                group = groups.setdefault(bucket_key(kind, metadata['binning'], metadata['filter']),
+                                          {'files': [], 'metadata': metadata})
+                group['files'].append(filename)
+
+        added = []
+        for (kind, binning, filter), group in groups.items():
+            files = group['files']
+            metadata = group['metadata']
+
+            key = cache.key(files, parameters)
+            if key in known_keys:
+                continue
+
+            name = f"{kind}-{binning}" + (f"-{filter}" if filter is not None else '')
+            filename = os.path.join(night_dir, f"{name}-{key[:8]}.fits")
+
+            # The masters each one is corrected with are the ones of the night if they were just built
+            bias = self.find('bias', metadata['date'], binning, temperature=metadata['temperature'], trim=trim)
+            dark = self.find('dark', metadata['date'], binning, exptime=metadata['exptime'],
+                             temperature=metadata['temperature'], trim=trim)
+            if (kind == 'dark' and bias is None) or (kind == 'flat' and (bias is None or dark is None)):
+                print(f"Skipping the {name} frames of {night}: there is no bias or dark to correct them with")
+                continue
+
+            values = None
+            if kind == 'bias':
+                create_median_bias(files, filename, workers=workers, method=method, trim=trim,
+                                   output_format=output_format)
+
+                flats = sorted(glob.glob(os.path.join(data_dir, RAW_PATTERNS['flat'])))
+                if len(flats) >= 2 and len(files) >= 2:
+                    gain = calculate_gain(flats, trim=trim)
+                    readout_noise = calculate_readout_noise(files, gain, trim=trim)
+                    values = {'gain': float(gain), 'readout_noise': float(readout_noise)}
+            elif kind == 'dark':
+                create_median_dark(files, self.path(bias), filename, workers=workers, method=method, trim=trim,
+                                   output_format=output_format)
+            else:
+                create_median_flat(files, self.path(bias), filename, self.path(dark), workers=workers, method=method,
+                                   trim=trim, output_format=output_format)
+
+            entry = {'kind': kind, 'filename': os.path.relpath(filename, self.directory), 'key': key, 'night': night,
+                     'trim': trim, 'values': values, **metadata}
+            self.entries.append(entry)
+            self._insert(entry)
+            added.append(entry)
+
+        self.save()
+
+        return added
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: metrics.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from contextlib import contextmanager, nullcontext
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+
+# Profilers that can be run on one stage
+PROFILERS = ('cprofile', 'tracemalloc')
+
+# Recorder that spans are reported to, or None when instrumentation is disabled
+_recorder = None
+
+# Returned by span when instrumentation is disabled, so a disabled span costs one function call
+_NO_SPAN = nullcontext()
+
+
+def max_rss():
+    "Peak resident memory of this process so far, in MB (ru_maxrss is in kB on Linux)"
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Recorder:
+    """Collects timing spans and I/O counts of a run.
+
+    - Each span records its path (the names of the spans it is nested in, joined by '/'; spans
+      of other threads, such as the tile workers of combine_frames, are nested in the span the
+      main thread is in), its duration, the bytes read and written while it was open (as reported with
+      count_bytes) and the peak RSS of the process when it ended, plus any extra fields.
+    - Every span is written as one JSON line to output (a filename) if given, and kept to print
+      a summary at the end of the run.
+    - Spans and byte counts of worker processes (which have a Recorder of their own) are added
+      with merge, nested in the span the thread that receives them is in.
+    - The stage named profile_stage is run under profiler ('cprofile' or 'tracemalloc'), whose
+      report is printed and, for cProfile, saved to profile_output.
+
+    """
+
+    def __init__(self, output=None, profile_stage=None, profiler='cprofile', profile_output=None):
+
+        if profiler not in PROFILERS:
+            raise ValueError(f"profiler must be one of {PROFILERS}, not {profiler!r}")
+
+        self.spans = []
+        self.profile_stage = profile_stage
+        self.profiler = profiler
+        self.profile_output = profile_output
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        self._local = threading.local()
+        self._main_thread = threading.main_thread()
+        self._main_stack = []
+        self._lock = threading.Lock()
+        self._file = open(output, 'a') if output is not None else None
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+            if threading.current_thread() is self._main_thread:
+                self._main_stack = self._local.stack
+        return self._local.stack
+
+    def _path(self, stack):
+        "Path of a span of this thread, whose spans are nested in the main thread's ones"
+
+        if threading.current_thread() is not self._main_thread:
+            return '/'.join(self._main_stack + stack)
+
+        return '/'.join(stack)
+
+    def _save(self, record):
+        "Keeps a record, which must be done holding the lock"
+
+        self.spans.append(record)
+        if self._file is not None:
+            self._file.write(json.dumps(record, default=str) + '\n')
+            self._file.flush()
+
+    def count(self, read=0, written=0):
+        "Adds to the bytes read and written, from any thread"
+
+        with self._lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def merge(self, records, bytes_read=0, bytes_written=0):
+        """Adds the span records and byte counts of another process, nesting the spans in the one
+        this thread is in"""
+
+        prefix = self._path(self._stack())
+        with self._lock:
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+            for record in records:
+                self._save({**record, 'span': f"{prefix}/{record['span']}" if prefix else record['span']})
+
+    @contextmanager
+    def span(self, name, **fields):
+        stack = self._stack()
+        stack.append(name)
+        path = self._path(stack)
+
+        profiling = name == self.profile_stage
+        if profiling:
+            self._start_profile()
+
+        bytes_read, bytes_written = self.bytes_read, self.bytes_written
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            if profiling:
+                self._stop_profile()
+
+            # With threads, the counts of spans that overlap include each other's I/O
+            record = {
+                'span': path,
+                'seconds': seconds,
+                'bytes_read': self.bytes_read - bytes_read,
+                'bytes_written': self.bytes_written - bytes_written,
+                'max_rss_mb': max_rss(),
+                'time': time.time(),
+                'pid': os.getpid(),
+                **fields,
+            }
+            with self._lock:
+                self._save(record)
+
+    def _start_profile(self):
+        if self.profiler == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            tracemalloc.start()
+
+    def _stop_profile(self):
+        if self.profiler == 'cprofile':
+            self._profile.disable()
+            stream = io.StringIO()
+            pstats.Stats(self._profile, stream=stream).sort_stats('cumulative').print_stats(20)
+            print(f"Profile of {self.profile_stage}:\n{stream.getvalue()}")
+            if self.profile_output is not None:
+                self._profile.dump_stats(self.profile_output)
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"Memory of {self.profile_stage}: peak {peak / 1024**2:.1f} MB traced, top allocations:")
+            for statistic in snapshot.statistics('lineno')[:20]:
+                print(f"  {statistic}")
+
+    def summary(self):
+        """Totals for each span path, in the order they first appeared: a list of (path, count,
+        seconds, bytes read, bytes written, peak RSS)"""
+
+        totals = dict()
+        for record in self.spans:
+            count, seconds, bytes_read, bytes_written, rss = totals.get(record['span'], (0, 0, 0, 0, 0))
+            totals[record['span']] = (count + 1, seconds + record['seconds'], bytes_read + record['bytes_read'],
+                                      bytes_written + record['bytes_written'], max(rss, record['max_rss_mb']))
+
+        return [(path,) + total for path, total in totals.items()]
+
+    def print_summary(self):
+        "Prints the summary as a table"
+
+        print(f"{'stage':<32} {'count':>6} {'total s':>9} {'mean s':>9} {'read MB':>9} {'written MB':>10} {'RSS MB':>8}")
+        for path, count, seconds, bytes_read, bytes_written, rss in self.summary():
+            print(f"{path:<32} {count:>6} {seconds:9.3f} {seconds / count:9.4f} {bytes_read / 1024**2:9.1f} "
+                  f"{bytes_written / 1024**2:10.1f} {rss:8.1f}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def enable(output=None, profile_stage=None, profiler='cprofile', profile_output=None):
+    "Starts recording spans with a new Recorder (see Recorder for the arguments) and returns it"
+
+    global _recorder
+    _recorder = Recorder(output, profile_stage, profiler, profile_output)
+
+    return _recorder
+
+
+def disable():
+    "Stops recording spans, closing the output of the current Recorder"
+
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+
+@contextmanager
+def recording(output=None, profile_stage=None, profiler='cprofile', profile_output=None, summary=True):
+    """Records the spans of the code in it (see enable), if there is an output or a stage to
+    profile, and prints the summary table at the end. Yields the Recorder, or None."""
+
+    if output is None and profile_stage is None:
+        yield None
+        return
+
+    recorder = enable(output, profile_stage, profiler, profile_output)
+    try:
+        yield recorder
+    finally:
+        disable()
+        if summary:
+            recorder.print_summary()
+
+
+def span(name, **fields):
+    """Context manager that times the code in it as a span called name, with extra fields (e.g.
+    the file being reduced) in its record. Does nothing unless instrumentation is enabled."""
+
+    if _recorder is None:
+        return _NO_SPAN
+
+    return _recorder.span(name, **fields)
+
+
+def count_bytes(read=0, written=0):
+    "Adds to the bytes read from and written to disk, if instrumentation is enabled"
+
+    if _recorder is not None:
+        _recorder.count(read, written)
+
+
+def count_written(filename):
+    "Adds the size of a file that was just written to the bytes written"
+
+    if _recorder is not None:
+        _recorder.count(written=os.path.getsize(filename))
+
+
+def enabled():
+    "Whether instrumentation is enabled"
+
+    return _recorder is not None
+
+
+def collect():
+    """Takes the span records and the bytes read and written recorded so far out of the current
+    Recorder, to send them from a worker process to the main one (see merge)"""
+
+    if _recorder is None:
+        return [], 0, 0
+
+    with _recorder._lock:
+        collected = _recorder.spans, _recorder.bytes_read, _recorder.bytes_written
+        _recorder.spans = []
+        _recorder.bytes_read = _recorder.bytes_written = 0
+
+    return collected
+
+
+def merge(records, bytes_read=0, bytes_written=0):
+    "Adds what collect took out of a worker process to the current Recorder, if instrumentation is enabled"
+
+    if _recorder is not None:
+        _recorder.merge(records, bytes_read, bytes_written)
@@ -5,10 +5,77 @@
 # @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
 
 from astropy.io import fits
-from astropy.stats import sigma_clip
 import numpy
-from photutils.aperture import CircularAnnulus, CircularAperture, aperture_photometry
-from matplotlib import pyplot as plt
+
+# Ways of estimating the sky level in the annulus
+SKY_METHODS = ('mean', 'median')
+
+
+class PhotometryResult:
+    """Aperture photometry of several positions with several radii on one frame.
+
+    - positions is the list of (x, y) tuples and radii the list of aperture radii.
+    - fluxes and raw_fluxes are (positions x radii) arrays with the sky-subtracted and total
+      fluxes in each aperture.
+    - sky is the sky level per pixel measured in the annulus around each position.
+    - header is the FITS header of the frame, if it was given.
+
+    """
+
+    def __init__(self, positions, radii, fluxes, raw_fluxes, sky, header=None):
+
+        self.positions = positions
+        self.radii = radii
+        self.fluxes = fluxes
+        self.raw_fluxes = raw_fluxes
+        self.sky = sky
+        self.header = header
+
+    def as_dict(self):
+        "Results in the format of do_aperture_photometry: {(x, y): [radii, fluxes, raw_fluxes]}"
+
+        return {tuple(position): [self.radii, list(self.fluxes[i]), list(self.raw_fluxes[i])]
+                for i, position in enumerate(self.positions)}
+
+
+def measure_apertures(data, positions, radii, sky_radius_in, sky_annulus_width, sky_method='mean', header=None):
+    """Measures all the apertures and sky annuli of a frame in one aperture_photometry call.
+
+    - Accept a 2D array as data, a list of (x, y) tuples as positions and a list of radii.
+    - The sky annulus goes from sky_radius_in to sky_radius_in + sky_annulus_width and is only
+      measured once per position, whatever the number of radii.
+    - sky_method='mean' uses the mean of the annulus as the sky level, 'median' uses the
+      sigma-clipped median, which isn't biased by stars falling in the annulus.
+    - The data is only read, never modified or copied.
+    - Return a PhotometryResult, which keeps header along.
+
+    """
+
+    if sky_method not in SKY_METHODS:
+        raise ValueError(f"sky_method must be one of {SKY_METHODS}, not {sky_method!r}")
+
+    from astropy.stats import SigmaClip
+    from photutils.aperture import ApertureStats, CircularAnnulus, CircularAperture, aperture_photometry
+
+    apertures = [CircularAperture(positions, radius) for radius in radii]
+    annulus = CircularAnnulus(positions, sky_radius_in, sky_radius_in + sky_annulus_width)
+
+    # Sums every aperture of every position at once, one column per radius (plus the annulus)
+    table = aperture_photometry(data, apertures + [annulus])
+    raw_fluxes = numpy.column_stack([table[f'aperture_sum_{i}'].value for i in range(len(radii))])
+
+    # Grabs the background's level in the annulus
+    if sky_method == 'mean':
+        sky = table[f'aperture_sum_{len(radii)}'].value / annulus.area
+    else:
+        sky = ApertureStats(data, annulus, sigma_clip=SigmaClip(sigma=3)).median
+
+    # Multiplies the sky level by each aperture's area and subtracts it
+    areas = numpy.array([aperture.area for aperture in apertures])
+    fluxes = raw_fluxes - numpy.outer(sky, areas)
+
+    return PhotometryResult(positions, radii, fluxes, raw_fluxes, sky, header)
+
 
 def do_aperture_photometry(
     image,
@@ -16,6 +83,7 @@ def do_aperture_photometry(
     radii,
     sky_radius_in,
     sky_annulus_width,
+    sky_method='mean',
 ):
     """This function must:
 
@@ -34,39 +102,20 @@ def do_aperture_photometry(
     Note that the automated tests just check that you are returning from this
     function, but they do not check the contents of the returned data.
 
-    """
-
-    data = fits.getdata(image)
-    results = dict()
-    
-    for position in positions:
-        raw_fluxes = []
-        fluxes = []
-        for radius in radii:
-            # Makes a circular aperture and caclulates the total flux in the area
-            aperture = CircularAperture(position, radius)
-            raw_flux = aperture_photometry(data, aperture)['aperture_sum'].value
-            raw_fluxes.append(raw_flux[0])
-
-            # Makes a circular annulus and calculates the total background flux in that area
-            annulus = CircularAnnulus(position, sky_radius_in, sky_radius_in + sky_annulus_width)
-            raw_background = aperture_photometry(data, annulus)['aperture_sum'].value
+    The photometry is done by measure_apertures, with the sky level from sky_method.
 
-            # Grabs the background's mean in the annulus and multiplies it by aperture's area to grab background in only 
-            # annulus
-            background_mean = raw_background / annulus.area
-            background = background_mean * aperture.area
+    image can also be a 2D array that is already in memory, which is measured directly, without
+    reading the file again or copying the data.
 
-            # Calculates total flux
-            flux = raw_flux[0] - background[0]
-            fluxes.append(flux)
-            
+    """
 
-        # Puts a dictionary where one position has a list of fluxes with change in radius
-        results[position] = [radii, fluxes, raw_fluxes]
+    if isinstance(image, numpy.ndarray):
+        data = image
+    else:
+        data = fits.getdata(image)
 
-    
-    return results
+    # Returns a dictionary where one position has a list of fluxes with change in radius
+    return measure_apertures(data, positions, radii, sky_radius_in, sky_annulus_width, sky_method).as_dict()
 
 
 def plot_radial_profile(aperture_photometry_data, output_filename="radial_profile.png"):
@@ -82,7 +131,9 @@ def plot_radial_profile(aperture_photometry_data, output_filename="radial_profil
     - Save the plot to the file specified in output_filename.
 
     """
-    
+
+    from matplotlib import pyplot as plt
+
     plt.figure()
     # For loop to read each different position and plot the corresponding radial profile 
     for key in aperture_photometry_data:
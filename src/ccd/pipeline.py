@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: pipeline.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import numpy
+from photometry import measure_apertures
+from registration import Registration, centroid_cutouts
+from frames import DEFAULT_TRIM, write_frame
+from science import reduce_science_data
+
+
+def stream_reduced_frames(
+    science_files,
+    calibration,
+    write_dir=None,
+    cosmic_rays='full',
+    cosmic_ray_options=None,
+    trim=DEFAULT_TRIM,
+    output_format='fits',
+    quantize_level=None,
+):
+    """Reduces raw science frames one at a time and yields them without keeping them around.
+
+    - Accept a list of raw science frame filenames as science_files and a CalibrationContext.
+    - Reduce each frame in memory as reduce_science_frame does.
+    - Optionally save each frame as {write_dir}reduced_science{i+1}.fits, in output_format (see
+      frames.write_frame).
+    - Yield (i, reduced_science, header) for each frame, in the order of science_files.
+
+    """
+
+    for i, science_filename in enumerate(science_files):
+        reduced_science, header = reduce_science_data(science_filename, calibration, cosmic_rays, cosmic_ray_options,
+                                                      trim=trim)
+
+        if write_dir is not None:
+            write_frame(f"{write_dir}reduced_science{i+1}.fits", reduced_science, header, output_format,
+                        quantize_level)
+
+        yield i, reduced_science, header
+
+
+def measure_frame(data, x_positions, y_positions, radii, sky_radius_in, sky_annulus_width, box_size=35):
+    """Centroids the stars near (x_positions, y_positions) on a reduced frame and measures them with
+    measure_apertures, returning its PhotometryResult"""
+
+    # Accurately finds the position of each object, using the background of a cutout around it
+    positions = centroid_cutouts(data, x_positions, y_positions, box_size=box_size)
+
+    return measure_apertures(data, positions, radii, sky_radius_in, sky_annulus_width)
+
+
+def extract_light_curve(
+    frames,
+    x_positions,
+    y_positions,
+    radii=(10,),
+    sky_radius_in=18,
+    sky_annulus_width=4,
+    box_size=35,
+    binning=4,
+):
+    """Differential light curve of a target from a stream of reduced frames.
+
+    - Accept an iterable of (i, data, header) as frames, such as stream_reduced_frames, so only
+      one frame is in memory at a time.
+    - The first position in (x_positions, y_positions) is the target and the rest are
+      comparison stars, with positions measured on the first frame.
+    - Follow the drift of the telescope by registering each frame against the first one (see
+      registration.Registration, binning the frames by binning) and shifting the positions.
+    - Measure each frame with measure_frame, using the first of radii.
+    - Return the time in minutes after the first frame (from JD-OBS) and the ratio of the target
+      flux to the mean comparison flux, as numpy arrays.
+
+    """
+
+    time_stamps = []
+    target_flux = []
+    comparison_flux = []
+
+    registration = None
+    x_positions = numpy.asarray(x_positions)
+    y_positions = numpy.asarray(y_positions)
+
+    for i, data, header in frames:
+        if registration is None:
+            registration = Registration(data, binning=binning)
+
+        dx, dy = registration.shift(data)
+        result = measure_frame(data, x_positions + dx, y_positions + dy, radii, sky_radius_in, sky_annulus_width,
+                               box_size)
+
+        time_stamps.append(header['JD-OBS'])
+        target_flux.append(result.fluxes[0, 0])
+        comparison_flux.append(numpy.mean(result.fluxes[1:, 0]))
+
+    ratio = numpy.array(target_flux) / numpy.array(comparison_flux)
+    time = (numpy.array(time_stamps) - numpy.min(time_stamps)) * 24 * 60  # Sets time to minutes after first observation
+
+    return time, ratio
@@ -4,10 +4,18 @@
 # @Filename: ptc.py
 # @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
 
+from concurrent.futures import ThreadPoolExecutor
+import math
+
 from astropy.io import fits
+from frames import DEFAULT_TRIM, read_frame
 import numpy
 
-def calculate_gain(files):
+# Side of the square tiles in which measure_ptc measures the statistics of each pair, in pixels
+DEFAULT_TILE_SIZE = 64
+
+
+def calculate_gain(files, trim=DEFAULT_TRIM):
     """This function must:
 
     - Accept a list of files that you need to calculate the gain
@@ -18,8 +26,8 @@ def calculate_gain(files):
     """
 
     # Get the first two flats from the list, making sure we get from the center since edges are nonuniform
-    flat1 = fits.getdata(files[0]).astype('f4')[100:-100, 100:-100]
-    flat2 = fits.getdata(files[1]).astype('f4')[100:-100, 100:-100]
+    flat1, header = read_frame(files[0], trim=trim)
+    flat2, header = read_frame(files[1], trim=trim)
     
     # Calculate the variance of the difference between the two images
     flat_diff = flat1 - flat2
@@ -34,7 +42,7 @@ def calculate_gain(files):
     return gain
 
 
-def calculate_readout_noise(files, gain):
+def calculate_readout_noise(files, gain, trim=DEFAULT_TRIM):
     """This function must:
 
     - Accept a list of files that you need to calculate the readout noise
@@ -48,8 +56,8 @@ def calculate_readout_noise(files, gain):
 
     # Get the first two biases from the list, where we can use a very large region since the bias level is very flat.
     # So we just trim the images to remove the contribution from the edge pixels.
-    bias1 = fits.getdata(files[0]).astype('f4')[100:-100, 100:-100]
-    bias2 = fits.getdata(files[1]).astype('f4')[100:-100, 100:-100]
+    bias1, header = read_frame(files[0], trim=trim)
+    bias2, header = read_frame(files[1], trim=trim)
     
     # Calculate the variance of the difference between the two images
     bias_diff = bias1 - bias2
@@ -60,3 +68,290 @@ def calculate_readout_noise(files, gain):
     readout_noise = (readout_noise_adu * gain).astype(numpy.float64)
 
     return readout_noise
+
+
+def tile_view(data, tile_size=DEFAULT_TILE_SIZE):
+    """View of a 2D array as (tile rows, tile columns, pixels) of tile_size x tile_size tiles,
+    dropping the rows/columns that don't fit"""
+
+    n_rows = data.shape[0] // tile_size
+    n_columns = data.shape[1] // tile_size
+    tiles = data[:n_rows * tile_size, :n_columns * tile_size].reshape(n_rows, tile_size, n_columns, tile_size)
+
+    return tiles.transpose(0, 2, 1, 3).reshape(n_rows, n_columns, tile_size * tile_size)
+
+
+def clipped_mask(values, sigma=3, maxiters=5):
+    """Mask of the values kept by sigma clipping each row of values (along the last axis) around
+    its median, all rows at once"""
+
+    kept = numpy.isfinite(values)
+
+    for iteration in range(maxiters):
+        masked = numpy.where(kept, values, numpy.nan)
+        center = numpy.nanmedian(masked, axis=-1, keepdims=True)
+        std = numpy.nanstd(masked, axis=-1, keepdims=True)
+
+        new_kept = kept & (numpy.abs(values - center) <= sigma * std)
+        if numpy.array_equal(new_kept, kept):
+            break
+        kept = new_kept
+
+    return kept
+
+
+def clipped_variance_factor(sigma=3):
+    """Fraction of the variance of Gaussian values that is left after clipping them as clipped_mask
+    does, which cuts the tails at sigma times the standard deviation of the values it keeps. That
+    is the variance of a Gaussian truncated at k standard deviations, found by iterating
+    k = sigma * sqrt(factor(k)) to where the clipping converges (k = 2.95 and 0.970 for sigma=3)."""
+
+    def factor(k):
+        return 1 - 2 * k * math.exp(-k**2 / 2) / math.sqrt(2 * math.pi) / math.erf(k / math.sqrt(2))
+
+    k = sigma
+    for iteration in range(100):
+        k = sigma * math.sqrt(factor(k))
+
+    return factor(k)
+
+
+def pair_statistics(files, bias_level=0, trim=DEFAULT_TRIM, tile_size=DEFAULT_TILE_SIZE, sigma=3):
+    """Statistics of each tile of a pair of frames (a list of two files).
+
+    - Read both frames, subtract bias_level (a number, or one value per tile) and split them into
+      tile_size x tile_size tiles (see tile_view).
+    - Scale the second frame to the level of the first in each tile, so that the flat field
+      structure cancels in their difference even if the exposure times are different.
+    - Sigma clip the difference in each tile, which removes hot pixels, cosmic rays and most of
+      any star, and use the same pixels for the means. The clipping also cuts the tails of the
+      noise, so the variance is divided by clipped_variance_factor(sigma).
+    - Return the mean of each frame, the variance of the difference and the number of pixels
+      kept, as (tile rows, tile columns) float64 arrays.
+
+    """
+
+    frame1, header = read_frame(files[0], trim=trim)
+    frame2, header = read_frame(files[1], trim=trim)
+
+    bias_level = numpy.asarray(bias_level, dtype='f8')[..., numpy.newaxis]
+    tiles1 = tile_view(frame1, tile_size) - bias_level
+    tiles2 = tile_view(frame2, tile_size) - bias_level
+
+    ratio = numpy.median(tiles1, axis=-1, keepdims=True) / numpy.median(tiles2, axis=-1, keepdims=True)
+    difference = tiles1 - ratio * tiles2
+
+    kept = clipped_mask(difference, sigma=sigma)
+    n_kept = numpy.count_nonzero(kept, axis=-1)
+
+    mean1 = numpy.sum(tiles1, axis=-1, where=kept) / n_kept
+    mean2 = numpy.sum(tiles2, axis=-1, where=kept) / n_kept
+    variance = numpy.var(difference, axis=-1, where=kept, ddof=1) / clipped_variance_factor(sigma)
+
+    return mean1, mean2, variance, n_kept
+
+
+def find_pairs(files):
+    """Pairs of files taken with the same exposure time, in the order of the list. If there are
+    none (e.g. every flat has a different exposure), consecutive files are paired instead."""
+
+    groups = dict()
+    for file in files:
+        groups.setdefault(fits.getheader(file).get('EXPTIME'), []).append(file)
+
+    pairs = [group[i:i + 2] for group in groups.values() for i in range(0, len(group) - 1, 2)]
+    if not pairs:
+        pairs = [files[i:i + 2] for i in range(0, len(files) - 1, 2)]
+
+    return pairs
+
+
+def solve_ptc(normal_matrix, normal_vector, chi2=1):
+    """Gain (e-/ADU) and readout noise (e-) with their uncertainties from the normal equations of
+    the photon transfer curve fit (see measure_ptc), which can have any leading dimensions. The
+    covariance is scaled by chi2, the reduced chi squared of the fit, when it is larger than 1."""
+
+    covariance = numpy.linalg.inv(normal_matrix) * max(chi2, 1)
+    solution = numpy.einsum('...ij,...j->...i', covariance, normal_vector) / max(chi2, 1)
+    inverse_gain = solution[..., 0]
+    readout_variance = solution[..., 1]
+
+    gain = 1 / inverse_gain
+    gain_error = numpy.sqrt(covariance[..., 0, 0]) * gain**2
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        readout_noise_adu = numpy.sqrt(readout_variance)
+        readout_noise = readout_noise_adu * gain
+
+        # Propagates the uncertainties of 1 / gain and of the readout variance (in ADU^2), which are correlated
+        derivative_variance = gain / (2 * readout_noise_adu)
+        derivative_inverse_gain = -readout_noise_adu * gain**2
+        readout_noise_error = numpy.sqrt(derivative_variance**2 * covariance[..., 1, 1]
+                                         + derivative_inverse_gain**2 * covariance[..., 0, 0]
+                                         + 2 * derivative_variance * derivative_inverse_gain * covariance[..., 0, 1])
+
+    return gain, gain_error, readout_noise, readout_noise_error
+
+
+class PTCResult:
+    """Photon transfer curve measured by measure_ptc.
+
+    - gain (e-/ADU) and readout_noise (e-), with their uncertainties gain_error and
+      readout_noise_error, fitted over every tile of every pair.
+    - signal and variance: the points of the curve (bias subtracted signal and half the variance
+      of the difference of each pair, in ADU), one row per pair and one column per tile. used
+      marks the points kept by the fit.
+    - gain_map, gain_map_error and readout_noise_map: the same fit done in each region (each
+      tile by default), as 2D arrays.
+
+    """
+
+    def __init__(self, gain, gain_error, readout_noise, readout_noise_error, signal, variance, used, gain_map,
+                 gain_map_error, readout_noise_map):
+
+        self.gain = gain
+        self.gain_error = gain_error
+        self.readout_noise = readout_noise
+        self.readout_noise_error = readout_noise_error
+        self.signal = signal
+        self.variance = variance
+        self.used = used
+        self.gain_map = gain_map
+        self.gain_map_error = gain_map_error
+        self.readout_noise_map = readout_noise_map
+
+
+def measure_ptc(
+    flat_files,
+    bias_files,
+    trim=DEFAULT_TRIM,
+    tile_size=DEFAULT_TILE_SIZE,
+    sigma=3,
+    rejection_sigma=5,
+    regions=None,
+    workers=1,
+    gain_map_filename=None,
+):
+    """This function must:
+
+    - Accept every flat and bias file of the night, and pair them up with find_pairs, so that
+      all the flat exposure levels are used instead of just the first two files.
+    - Measure the clipped statistics of every tile of every pair (see pair_statistics), up to
+      workers pairs at the same time. Only the two frames of each pair being measured are in
+      memory.
+    - Fit the photon transfer curve variance = signal / gain + readout variance of all the
+      points (the bias pairs are its zero signal points) by weighted least squares, rejecting
+      points more than rejection_sigma from it, e.g. tiles with a star or a hot column.
+    - Fit the same curve in each region of the detector, a (rows, columns) grid of regions such
+      as the amplifiers, or in each tile if regions is None, and save the gain map to
+      gain_map_filename if it is given.
+    - Return a PTCResult.
+
+    Pairs with different exposure times (when no two flats share one) work too, since the second
+    frame is scaled to the first (see pair_statistics): if r is the ratio of their bias subtracted
+    signals S1 / S2, the variance of S1 - r S2 is S1 (1 + r) / gain + (1 + r^2) x readout variance.
+
+    """
+
+    flat_pairs = find_pairs(flat_files)
+    bias_pairs = [bias_files[i:i + 2] for i in range(0, len(bias_files) - 1, 2)]
+    if not flat_pairs or not bias_pairs:
+        raise ValueError("measure_ptc needs at least two flats and two biases")
+
+    def measure(pairs, bias_level=0):
+        "pair_statistics of each pair, up to workers at the same time"
+
+        if workers == 1:
+            return [pair_statistics(pair, bias_level, trim, tile_size, sigma) for pair in pairs]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda pair: pair_statistics(pair, bias_level, trim, tile_size, sigma), pairs))
+
+    bias_statistics = measure(bias_pairs)
+
+    # Bias level of each tile, subtracted from the flats
+    bias_level = numpy.mean([0.5 * (mean1 + mean2) for mean1, mean2, variance, n_kept in bias_statistics], axis=0)
+    flat_statistics = measure(flat_pairs, bias_level)
+
+    # Points of the curve, one row per pair: variance = signal / gain + scale x readout variance
+    signal = []
+    scale = []
+    variance = []
+    n_kept = []
+    for mean1, mean2, difference_variance, n in bias_statistics:
+        signal.append(numpy.zeros_like(mean1))
+        scale.append(numpy.ones_like(mean1))
+        variance.append(difference_variance / 2)
+        n_kept.append(n)
+    for mean1, mean2, difference_variance, n in flat_statistics:
+        ratio = mean1 / mean2
+        signal.append(mean1 * (1 + ratio) / 2)
+        scale.append((1 + ratio**2) / 2)
+        variance.append(difference_variance / 2)
+        n_kept.append(n)
+
+    signal = numpy.array(signal)
+    scale = numpy.array(scale)
+    variance = numpy.array(variance)
+
+    # The variance of a sample variance of n values is 2 variance^2 / (n - 1)
+    used = numpy.isfinite(signal) & numpy.isfinite(variance) & (variance > 0)
+    signal = numpy.where(used, signal, 0)
+    variance = numpy.where(used, variance, 1)
+    weights = (numpy.array(n_kept) - 1) / (2 * variance**2)
+
+    def normal_equations(axis):
+        "Normal equations of the weighted fit of the used points, summed over axis"
+
+        w = weights * used
+        sums = [numpy.sum(w * a * b, axis) for a, b in ((signal, signal), (signal, scale), (scale, scale),
+                                                         (signal, variance), (scale, variance))]
+        matrix = numpy.stack([sums[0], sums[1], sums[1], sums[2]], axis=-1).reshape(sums[0].shape + (2, 2))
+        vector = numpy.stack([sums[3], sums[4]], axis=-1)
+
+        return matrix, vector
+
+    # Fits all the points, then fits again without the outliers until none are left
+    while True:
+        matrix, vector = normal_equations(axis=None)
+        inverse_gain, readout_variance = numpy.linalg.solve(matrix, vector)
+        residuals = (variance - signal * inverse_gain - scale * readout_variance) * numpy.sqrt(weights)
+
+        outliers = used & (numpy.abs(residuals) > rejection_sigma)
+        if not outliers.any():
+            break
+        used &= ~outliers
+
+    chi2 = numpy.sum(residuals[used]**2) / (numpy.count_nonzero(used) - 2)
+    gain, gain_error, readout_noise, readout_noise_error = solve_ptc(matrix, vector, chi2)
+
+    # Sums the normal equations of the tiles in each region (each tile on its own by default)
+    matrix, vector = normal_equations(axis=0)
+    if regions is not None:
+        region_rows, region_columns = regions
+        n_rows = matrix.shape[0] - matrix.shape[0] % region_rows
+        n_columns = matrix.shape[1] - matrix.shape[1] % region_columns
+        matrix = matrix[:n_rows, :n_columns].reshape(region_rows, n_rows // region_rows, region_columns,
+                                                     n_columns // region_columns, 2, 2).sum(axis=(1, 3))
+        vector = vector[:n_rows, :n_columns].reshape(region_rows, n_rows // region_rows, region_columns,
+                                                     n_columns // region_columns, 2).sum(axis=(1, 3))
+
+    # Regions without enough points to fit have no gain
+    determinant = numpy.linalg.det(matrix)
+    matrix[determinant <= 0] = numpy.eye(2)
+    gain_map, gain_map_error, readout_noise_map, readout_noise_map_error = solve_ptc(matrix, vector)
+    gain_map[determinant <= 0] = numpy.nan
+    gain_map_error[determinant <= 0] = numpy.nan
+    readout_noise_map[determinant <= 0] = numpy.nan
+
+    if gain_map_filename is not None:
+        header = fits.Header()
+        header['GAIN'] = (gain, 'Gain of the whole detector (e-/ADU)')
+        header['RDNOISE'] = (readout_noise, 'Readout noise of the whole detector (e-)')
+        header['TILESIZE'] = (tile_size, 'Side of the tiles (pixels)')
+        fits.HDUList([fits.PrimaryHDU(data=gain_map.astype('f4'), header=header),
+                      fits.ImageHDU(data=readout_noise_map.astype('f4'), name='RDNOISE')]).writeto(
+            gain_map_filename, overwrite=True)
+
+    return PTCResult(gain, gain_error, readout_noise, readout_noise_error, numpy.where(used, signal, numpy.nan),
+                     numpy.where(used, variance, numpy.nan), used, gain_map, gain_map_error, readout_noise_map)
@@ -5,7 +5,9 @@
 # @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
 
 
-def run_reduction(data_dir):
+def run_reduction(data_dir, workers=1, use_cache=True, cosmic_rays='full', cosmic_ray_options=None, trim=100,
+                  cube=False, metrics=None, profile_stage=None, profiler='cprofile', profile_output=None, full_ptc=False,
+                  library=None, dry_run=False, output_format='fits', quantize_level=None):
     """This function must run the entire CCD reduction process. You can implement it
     in any way that you want but it must perform a valid reduction for the two
     science frames in the dataset using the functions that you have implemented in
@@ -16,58 +18,306 @@ def run_reduction(data_dir):
     relevant information to the screen or to a file, and that any plots are saved to
     PNG or PDF files.
 
+    The master frames are combined using workers threads, and the science frames are reduced
+    over workers processes.
+
+    The stages are tasks of a scheduler.TaskGraph, with the files they read and write declared,
+    and up to workers of them run at the same time as soon as what they need is ready: the gain
+    and readout noise don't wait for the masters, and the science frames start as soon as the
+    masters exist. With dry_run, the plan of what would run is printed and the graph returned
+    without running anything.
+
+    Cosmic rays are removed with the cosmic_rays mode of cosmics.remove_cosmic_rays, using the
+    measured gain and readout noise and any other cosmic_ray_options.
+
+    trim is the section of the raw frames that is kept: the number of pixels removed from each
+    edge, or 'DATASEC' to use the section given in the headers.
+
+    With full_ptc, the gain and readout noise are fitted to the photon transfer curve of every
+    flat and bias pair (see ptc.measure_ptc) instead of the first two of each, and the gain map
+    is saved to {data_dir}Gain-Map.fits.
+
+    With library (a directory), the masters come from a library.CalibrationLibrary instead: the
+    calibration frames of the night, if it has any, are added to it (once), and the night is
+    reduced with the masters that best match its first science frame, along with the gain and
+    readout noise measured with them. Nights without calibrations can be reduced this way.
+
+    With output_format='compressed', the masters and reduced science frames are saved as
+    tile-compressed FITS (see frames.write_frame): the masters losslessly, and the science frames
+    quantized to 1 / quantize_level of their noise if quantize_level is given, or losslessly if not.
+
+    With cube, the reduced science frames are stored in one cube.FrameCube at
+    {data_dir}reduced-science (.f4 and .ecsv) instead of separate FITS files, which the photometry
+    then reads through a memory map (see diff_photometry.reduced_frames).
+
+    With metrics (a filename), every stage and every science frame is timed along with the bytes
+    it read and wrote and the peak memory, saved as JSON lines to metrics and summarised at the end
+    (see metrics.Recorder). profile_stage ('bias', 'dark', 'flat', 'ptc' or 'science') is run
+    under profiler ('cprofile' or 'tracemalloc'), saving the cProfile stats to profile_output.
+
+    With use_cache, the inputs of every stage are recorded in a manifest in data_dir (see
+    cache.BuildCache) and stages whose inputs haven't changed since the last run are skipped.
+
     """
     
     import glob
+    from cache import BuildCache
     from bias import create_median_bias
     from darks import create_median_dark
     from flats import create_median_flat
-    from ptc import calculate_gain, calculate_readout_noise
-    from science import reduce_science_frame
+    from ptc import calculate_gain, calculate_readout_noise, measure_ptc
+    from cosmics import print_cosmic_ray_times, reset_cosmic_ray_times
+    from science import CalibrationContext, reduce_science_frames
+    from cube import CUBE_NAME, FrameCube
+    from library import CalibrationLibrary
+    from metrics import recording, span
+    from scheduler import TaskGraph
 
 
-    # Collects all the different types of images from the given directory, and sorts them in a list
-    bias_files = sorted(glob.glob(data_dir + "Bias*"))
-    dark_files = sorted(glob.glob(data_dir + "Dark*"))
-    flat_files = sorted(glob.glob(data_dir + "domeflat*"))
-    science_files = sorted(glob.glob(data_dir + "LPSEB*"))
+    reset_cosmic_ray_times()
 
-    # Naming of the median filenames for the biases, darks, and flats
-    median_bias_filename = data_dir + 'Median-Bias.fits'
-    median_dark_filename = data_dir + 'Median-Dark.fits'
-    median_flat_filename = data_dir + 'Median-AutoFlat.fits'
+    # Times each stage if metrics (a JSON lines file) or a stage to profile are given
+    with recording(metrics, profile_stage, profiler, profile_output):
+        # Collects all the different types of images from the given directory, and sorts them in a list
+        bias_files = sorted(glob.glob(data_dir + "Bias*"))
+        dark_files = sorted(glob.glob(data_dir + "Dark*"))
+        flat_files = sorted(glob.glob(data_dir + "domeflat*"))
+        science_files = sorted(glob.glob(data_dir + "LPSEB*"))
 
-    
-    # Creates the medians from the list of biases, darks, and flats
-    median_bias = create_median_bias(bias_files, median_bias_filename)
-    median_dark = create_median_dark(dark_files, median_bias_filename, median_dark_filename)
-    median_flat = create_median_flat(flat_files, median_bias_filename, median_flat_filename, median_dark_filename)
-    
+        # Naming of the median filenames for the biases, darks, and flats
+        median_bias_filename = data_dir + 'Median-Bias.fits'
+        median_dark_filename = data_dir + 'Median-Dark.fits'
+        median_flat_filename = data_dir + 'Median-AutoFlat.fits'
 
-    # Calculates and prints out the gain and readout noise from the list of flats and biases, respectively
-    gain = calculate_gain(flat_files)
-    print(f"Gain = {gain:.2f} e-/ADU")
+        # Parameters that change the masters, included in the cache keys along with the input files
+        combine_parameters = {'trim': trim, 'sigma': 3, 'method': 'astropy'}
 
-    readout_noise = calculate_readout_noise(bias_files, gain)
-    print(f"Readout Noise = {readout_noise:.2f} e-")
+        # The format is only added when it isn't the default, so the keys of plain FITS outputs stay the same
+        format_parameters = {'output_format': output_format} if output_format != 'fits' else dict()
+        combine_parameters.update(format_parameters)
 
+        cache = BuildCache(data_dir)
+        bias_key = cache.key(bias_files, combine_parameters)
+        dark_key = cache.key(dark_files, combine_parameters, [bias_key])
+        flat_key = cache.key(flat_files, combine_parameters, [bias_key, dark_key])
 
-    # For loop to reduce each science image found in the list of science files, and save it with a reduced_science{i}.fits name
-    for i in range(len(science_files)):
-        science_filename = science_files[i]
-        
-        reduced_science = reduce_science_frame(
-        science_filename,
-        median_bias_filename,
-        median_flat_filename,
-        median_dark_filename,
-        reduced_science_filename=f"{data_dir}reduced_science{i+1}.fits"
-        )
+        # Each stage is a task that runs as soon as the files and values it needs are ready
+        graph = TaskGraph()
+        ptc_tasks = []
+
+        # Errors of the gain and readout noise, which are only known when the full curve is fitted
+        ptc_errors = []
+
+        # Cosmic ray removal needs the gain and readout noise, unless they are given explicitly
+        uses_gain = cosmic_rays != 'off' and not {'gain', 'readnoise'} <= set(cosmic_ray_options or dict())
+
+        if library is not None:
+            calibration_library = CalibrationLibrary(library)
+            if (bias_files or dark_files or flat_files) and dry_run:
+                print(f"Would add the calibration frames of {data_dir} to {library}")
+            elif bias_files or dark_files or flat_files:
+                calibration_library.add_night(data_dir, trim=trim, workers=workers, output_format=output_format)
+
+            # The masters are chosen for the first science frame, so without any there is nothing else to do
+            if not science_files:
+                print(f"No science frames to reduce in {data_dir}")
+                return graph if dry_run else None
+
+            # The masters' keys stand in for the night's own, so the science frames are redone if they change
+            bias_entry, dark_entry, flat_entry = calibration_library.masters_for(science_files[0], trim)
+            median_bias_filename = calibration_library.path(bias_entry)
+            median_dark_filename = calibration_library.path(dark_entry)
+            median_flat_filename = calibration_library.path(flat_entry)
+            bias_key, dark_key, flat_key = bias_entry['key'], dark_entry['key'], flat_entry['key']
+            print(f"Using the masters of {bias_entry['night']} (bias), {dark_entry['night']} (dark) and "
+                  f"{flat_entry['night']} (flat) from {library}")
+
+            ptc_values = None
+            if bias_entry['values'] is not None:
+                ptc_values = [bias_entry['values']['gain'], bias_entry['values']['readout_noise']]
+            elif uses_gain:
+                raise ValueError(f"The bias of {bias_entry['night']} has no gain (measuring it needs two flats and "
+                                 "two biases), which the cosmic ray removal needs")
+        else:
+            # Creates the medians from the list of biases, darks, and flats, unless they are already up to date
+            def make_bias():
+                with span('bias'):
+                    create_median_bias(bias_files, median_bias_filename, workers=workers, trim=trim,
+                                       output_format=output_format)
+                cache.record('bias', bias_key, [median_bias_filename])
+
+            def make_dark():
+                with span('dark'):
+                    create_median_dark(dark_files, median_bias_filename, median_dark_filename, workers=workers,
+                                       trim=trim, output_format=output_format)
+                cache.record('dark', dark_key, [median_dark_filename])
+
+            def make_flat():
+                with span('flat'):
+                    create_median_flat(flat_files, median_bias_filename, median_flat_filename, median_dark_filename,
+                                       workers=workers, trim=trim, output_format=output_format)
+                cache.record('flat', flat_key, [median_flat_filename])
+
+            graph.add('bias', make_bias, inputs=bias_files, outputs=[median_bias_filename],
+                      skip=use_cache and cache.is_fresh('bias', bias_key), reason='up to date')
+            graph.add('dark', make_dark, inputs=dark_files + [median_bias_filename], outputs=[median_dark_filename],
+                      skip=use_cache and cache.is_fresh('dark', dark_key), reason='up to date')
+            graph.add('flat', make_flat, inputs=flat_files + [median_bias_filename, median_dark_filename],
+                      outputs=[median_flat_filename], skip=use_cache and cache.is_fresh('flat', flat_key),
+                      reason='up to date')
+
+            # The gain only needs the flats and the readout noise the biases and the gain, not the masters
+            if full_ptc:
+                ptc_key = cache.key(flat_files + bias_files, {'trim': trim, 'full': True})
+            else:
+                ptc_key = cache.key(flat_files[:2] + bias_files[:2], {'trim': trim})
+            ptc_fresh = use_cache and cache.is_fresh('ptc', ptc_key)
+            ptc_values = cache.values('ptc') if ptc_fresh else None
+
+            def measure_full_ptc():
+                with span('ptc'):
+                    result = measure_ptc(flat_files, bias_files, trim=trim, workers=workers,
+                                         gain_map_filename=data_dir + 'Gain-Map.fits')
+                ptc_values[:] = [float(result.gain), float(result.readout_noise)]
+                ptc_errors[:] = [float(result.gain_error), float(result.readout_noise_error)]
+                cache.record('ptc', ptc_key, values=ptc_values)
+
+            def measure_gain():
+                with span('ptc', step='gain'):
+                    return calculate_gain(flat_files, trim=trim)
+
+            def measure_readout_noise():
+                gain = graph.results['gain']
+                with span('ptc', step='readout_noise'):
+                    readout_noise = calculate_readout_noise(bias_files, gain, trim=trim)
+                ptc_values[:] = [float(gain), float(readout_noise)]
+                cache.record('ptc', ptc_key, values=ptc_values)
+
+            if not ptc_fresh:
+                ptc_values = []
+                if full_ptc:
+                    ptc_tasks.append(graph.add('ptc', measure_full_ptc, inputs=flat_files + bias_files))
+                else:
+                    ptc_tasks.append(graph.add('gain', measure_gain, inputs=flat_files[:2]))
+                    ptc_tasks.append(graph.add('readout_noise', measure_readout_noise, inputs=bias_files[:2],
+                                               after=['gain']))
+
+        def science_options():
+            "Options of the cosmic ray removal, with the measured gain and readout noise if it uses them"
+
+            if not uses_gain:
+                return cosmic_ray_options
+
+            # astroscrappy uses the measured gain and readout noise unless they are given explicitly
+            gain, readout_noise = ptc_values
+            return {'gain': float(gain), 'readnoise': float(readout_noise), **(cosmic_ray_options or dict())}
+
+        def pending_science(options):
+            """Science frames that need reducing with options, as {science_file: (key, reduced filename)},
+            and the key of the cube. Only the frames whose raw file, output name or masters changed since
+            the last run are pending, or all of them (without keys of their own) if the cube changed."""
+
+            if cube:
+                cube_parameters = {'trim': trim, 'cosmic_rays': cosmic_rays, 'cosmic_ray_options': options}
+                cube_key = cache.key(science_files, cube_parameters, [bias_key, dark_key, flat_key])
+                if use_cache and cache.is_fresh('cube', cube_key):
+                    return dict(), cube_key
+                return {science_file: (None, None) for science_file in science_files}, cube_key
+
+            pending = dict()
+            for i in range(len(science_files)):
+                reduced_science_filename = f"{data_dir}reduced_science{i+1}.fits"
+                science_parameters = {'trim': trim, 'output': reduced_science_filename, 'cosmic_rays': cosmic_rays,
+                                      'cosmic_ray_options': options}
+                if output_format != 'fits':
+                    science_parameters.update(output_format=output_format, quantize_level=quantize_level)
+                key = cache.key([science_files[i]], science_parameters, [bias_key, dark_key, flat_key])
+
+                if not (use_cache and cache.is_fresh(f'science:{science_files[i]}', key)):
+                    pending[science_files[i]] = (key, reduced_science_filename)
+
+            return pending, None
+
+        def reduce_science():
+            options = science_options()
+            pending, cube_key = pending_science(options)
+            pending_files = list(pending)
+            pending_filenames = [reduced_science_filename for key, reduced_science_filename in pending.values()]
+
+            # The cube is rebuilt in order from all the frames if any of them changed
+            frame_cube = None
+            if cube and pending_files:
+                pending_filenames = None
+                frame_cube = FrameCube.create(cube_filename)
+
+            print(f"Reducing {len(pending_files)} of {len(science_files)} science frames")
+
+            # Loads the master frames once for all the science images
+            failures = dict()
+            if pending_files:
+                with span('science', frames=len(pending_files)):
+                    calibration = CalibrationContext(median_bias_filename, median_flat_filename, median_dark_filename)
+
+                    # Reduces each science image found in the list of science files, and saves it with a reduced_science{i}.fits name
+                    failures = reduce_science_frames(pending_files, calibration, data_dir, workers=workers,
+                                                     reduced_science_filenames=pending_filenames,
+                                                     cosmic_rays=cosmic_rays, cosmic_ray_options=options, trim=trim,
+                                                     cube=frame_cube, output_format=output_format,
+                                                     quantize_level=quantize_level)
+                print_cosmic_ray_times()
+
+            # Reports the frames that couldn't be reduced, which doesn't stop the others
+            for science_filename, error in failures.items():
+                print(f"Failed to reduce {science_filename}:\n{error}")
+
+            # The frames are recorded together, writing the manifest once
+            for science_filename, (key, reduced_science_filename) in pending.items():
+                if key is not None and science_filename not in failures:
+                    cache.record(f'science:{science_filename}', key, [reduced_science_filename], save=False)
+            cache.save()
+
+            if frame_cube is not None and not failures:
+                cache.record('cube', cube_key, [frame_cube.data_filename, frame_cube.table_filename])
+
+        # The science frames start as soon as the masters exist (and the gain, if cosmic rays are removed)
+        cube_filename = data_dir + CUBE_NAME
+        if cube:
+            science_outputs = [cube_filename + '.f4', cube_filename + '.ecsv']
+        else:
+            science_outputs = [f"{data_dir}reduced_science{i+1}.fits" for i in range(len(science_files))]
+
+        # Which frames are up to date is only known before running if the gain they are cleaned with is
+        description = f"{len(science_files)} frames, except the ones that are up to date"
+        science_fresh = False
+        if use_cache and (not uses_gain or ptc_values):
+            pending, cube_key = pending_science(science_options())
+            science_fresh = not pending
+            description = f"{len(pending)} of {len(science_files)} frames" if pending else ''
+        graph.add('science', reduce_science,
+                  inputs=science_files + [median_bias_filename, median_dark_filename, median_flat_filename],
+                  outputs=science_outputs, after=[task.name for task in ptc_tasks] if uses_gain else [],
+                  skip=science_fresh or not science_files,
+                  reason='up to date' if science_files else 'no science frames', description=description)
+
+        if dry_run:
+            print('\n'.join(graph.plan()))
+            return graph
+
+        graph.run(workers=workers)
+
+        # The gain and readout noise are printed once, whether they were measured or up to date
+        if ptc_errors:
+            print(f"Gain = {ptc_values[0]:.3f} +/- {ptc_errors[0]:.3f} e-/ADU")
+            print(f"Readout Noise = {ptc_values[1]:.2f} +/- {ptc_errors[1]:.2f} e-")
+        elif ptc_values:
+            print(f"Gain = {ptc_values[0]:.2f} e-/ADU")
+            print(f"Readout Noise = {ptc_values[1]:.2f} e-")
 
-    
     return
 
 
-data_dir = '../../20250529/'
+if __name__ == "__main__":
+
+    data_dir = '../../20250529/'
 
-run_reduction(data_dir)
\ No newline at end of file
+    run_reduction(data_dir)
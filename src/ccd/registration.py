@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: registration.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import numpy
+
+
+def bin_image(data, binning, statistic='mean'):
+    """Bins a 2D array by taking the mean (or with statistic='median', the median) of binning x
+    binning blocks, dropping the rows/columns that don't fit"""
+
+    n_rows = data.shape[0] // binning
+    n_columns = data.shape[1] // binning
+    blocks = data[:n_rows * binning, :n_columns * binning].reshape(n_rows, binning, n_columns, binning)
+
+    if statistic == 'median':
+        blocks = blocks.transpose(0, 2, 1, 3).reshape(n_rows, n_columns, binning * binning)
+        return numpy.median(blocks, axis=2).astype('f4')
+
+    return blocks.mean(axis=(1, 3), dtype='f4')
+
+
+def _peak_offset(before, peak, after):
+    "Sub-pixel offset of the peak of a parabola through three equally spaced values"
+
+    denominator = before - 2 * peak + after
+    if denominator == 0:
+        return 0.0
+
+    return 0.5 * (before - after) / denominator
+
+
+class Registration:
+    """Estimates the shift of frames relative to a reference frame by FFT cross-correlation.
+
+    - Accept the reference frame as a 2D array and the binning used for the correlation.
+    - The reference is binned and Fourier transformed once; each frame then costs one binning,
+      one FFT and one inverse FFT of the binned image.
+    - The blocks are averaged, or with statistic='median' binned with their median (an extra
+      pass over the frame), so that frames whose cosmic rays haven't been cleaned yet can be
+      registered without them dominating the correlation.
+
+    """
+
+    def __init__(self, reference, binning=4, statistic='mean'):
+
+        self.binning = binning
+        self.statistic = statistic
+        self.shape = bin_image(reference, binning, statistic).shape
+        self.reference_fft = numpy.conj(self._transform(reference))
+
+    def _transform(self, data):
+        "FFT of the binned frame with its median background removed"
+
+        binned = bin_image(data, self.binning, self.statistic)
+        binned -= numpy.median(binned)
+
+        return numpy.fft.rfft2(binned)
+
+    def shift(self, data):
+        """Shift (dx, dy) in pixels of data relative to the reference, so that a star at (x, y) in
+        the reference is at (x + dx, y + dy) in data"""
+
+        correlation = numpy.fft.irfft2(self._transform(data) * self.reference_fft, s=self.shape)
+        y_peak, x_peak = numpy.unravel_index(numpy.argmax(correlation), self.shape)
+        n_rows, n_columns = self.shape
+
+        # Refines the peak with a parabola along each axis (the correlation wraps around)
+        dy = y_peak + _peak_offset(correlation[y_peak - 1, x_peak], correlation[y_peak, x_peak],
+                                   correlation[(y_peak + 1) % n_rows, x_peak])
+        dx = x_peak + _peak_offset(correlation[y_peak, x_peak - 1], correlation[y_peak, x_peak],
+                                   correlation[y_peak, (x_peak + 1) % n_columns])
+
+        # Peaks past the middle of the image are negative shifts
+        if dy > n_rows / 2:
+            dy -= n_rows
+        if dx > n_columns / 2:
+            dx -= n_columns
+
+        return dx * self.binning, dy * self.binning
+
+
+def centroid_cutouts(data, x_positions, y_positions, box_size=35):
+    """Centroids of the stars near (x_positions, y_positions) using only a box_size cutout around
+    each of them, with the median of the cutout as its background. Returns a list of (x, y) tuples."""
+
+    from photutils.centroids import centroid_quadratic
+
+    positions = []
+    half_size = box_size // 2
+
+    for x, y in zip(x_positions, y_positions):
+        x0 = max(int(round(x)) - half_size, 0)
+        y0 = max(int(round(y)) - half_size, 0)
+        cutout = data[y0:y0 + box_size, x0:x0 + box_size]
+
+        x_centroid, y_centroid = centroid_quadratic(cutout - numpy.median(cutout))
+        positions.append((x0 + x_centroid, y0 + y_centroid))
+
+    return positions
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: scheduler.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+import traceback
+
+
+class Task:
+    """One step of a TaskGraph.
+
+    - name: unique name of the task, used for its result and in the plan.
+    - function: called with no arguments to run the task. Its return value is kept in
+      TaskGraph.results[name].
+    - inputs and outputs: the files the task reads and writes. A task depends on the tasks that
+      write its inputs; inputs that no task writes must already exist.
+    - after: names of other tasks it depends on without a file between them (e.g. values such
+      as the gain that are passed through TaskGraph.results).
+    - skip: whether the task is up to date and doesn't need to run (it still counts as done for
+      the tasks that depend on it), with reason explaining why in the plan.
+    - description: what the task does, shown in the plan.
+
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=(), after=(), skip=False, reason='', description=''):
+
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.skip = skip
+        self.reason = reason
+        self.description = description
+
+
+class TaskGraph:
+    """Tasks with declared inputs and outputs, run as soon as what they depend on is done.
+
+    - add declares a Task. The dependencies are worked out from the files each task reads and
+      writes, plus the explicit after names.
+    - levels groups the tasks in waves: each wave only depends on the ones before it, so the
+      tasks of a wave can run at the same time.
+    - plan describes what run would do without running anything (a dry run).
+    - run executes the tasks on up to workers threads, starting each one as soon as all its
+      dependencies have finished. A task that fails stops the tasks that depend on it, but not
+      the independent ones; the failures are raised together at the end.
+
+    """
+
+    def __init__(self):
+
+        self.tasks = dict()
+        self.results = dict()
+
+    def add(self, name, function, inputs=(), outputs=(), after=(), skip=False, reason='', description=''):
+        "Adds a Task (see Task for the arguments) and returns it"
+
+        if name in self.tasks:
+            raise ValueError(f"There is already a task called {name}")
+
+        self.tasks[name] = Task(name, function, inputs, outputs, after, skip, reason, description)
+
+        return self.tasks[name]
+
+    def dependencies(self):
+        """Names of the tasks each task depends on, raising a ValueError if one depends on an
+        unknown task or an input that no task writes doesn't exist"""
+
+        writers = {output: task.name for task in self.tasks.values() for output in task.outputs}
+        dependencies = dict()
+
+        for task in self.tasks.values():
+            names = set(task.after)
+            for filename in task.inputs:
+                if filename in writers:
+                    names.add(writers[filename])
+                elif not os.path.exists(filename):
+                    raise ValueError(f"{task.name} needs {filename}, which doesn't exist and no task writes")
+
+            unknown = names - set(self.tasks)
+            if unknown:
+                raise ValueError(f"{task.name} depends on unknown tasks {sorted(unknown)}")
+            dependencies[task.name] = names - {task.name}
+
+        return dependencies
+
+    def levels(self):
+        "The tasks in waves (lists of names), raising a ValueError if they depend on each other in a cycle"
+
+        dependencies = self.dependencies()
+        done = set()
+        levels = []
+
+        while len(done) < len(self.tasks):
+            ready = [name for name in self.tasks if name not in done and dependencies[name] <= done]
+            if not ready:
+                raise ValueError(f"The tasks {sorted(set(self.tasks) - done)} depend on each other in a cycle")
+            levels.append(ready)
+            done.update(ready)
+
+        return levels
+
+    def plan(self):
+        "Lines describing the waves of tasks, whether each one would run or be skipped, and what it needs"
+
+        dependencies = self.dependencies()
+        lines = []
+
+        for i, level in enumerate(self.levels()):
+            lines.append(f"Wave {i + 1}:")
+            for name in level:
+                task = self.tasks[name]
+                status = f"skip ({task.reason})" if task.skip else "run"
+                if task.description:
+                    status += f", {task.description}"
+                needs = f", after {', '.join(sorted(dependencies[name]))}" if dependencies[name] else ''
+                lines.append(f"  {name}: {status}{needs}")
+                for output in task.outputs:
+                    lines.append(f"    -> {output}")
+
+        return lines
+
+    def run(self, workers=1):
+        """Runs the tasks that aren't skipped, on up to workers threads (in the order of levels
+        with workers=1), and returns the results"""
+
+        dependencies = self.dependencies()
+        order = [name for level in self.levels() for name in level]
+        failures = dict()
+        finished = set()
+
+        def blocked(name):
+            "Whether a dependency of the task failed or was blocked itself"
+            return bool(dependencies[name] & set(failures))
+
+        def start(name):
+            task = self.tasks[name]
+            return None if task.skip else task.function()
+
+        if workers == 1:
+            for name in order:
+                if blocked(name):
+                    failures[name] = "a task it depends on failed"
+                    continue
+                try:
+                    self.results[name] = start(name)
+                except Exception:
+                    failures[name] = traceback.format_exc()
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                running = dict()
+                pending = list(order)
+
+                while pending or running:
+                    # Starts every task whose dependencies are done, and marks the ones that can't run
+                    for name in list(pending):
+                        if blocked(name):
+                            failures[name] = "a task it depends on failed"
+                            pending.remove(name)
+                        elif dependencies[name] <= finished:
+                            running[executor.submit(start, name)] = name
+                            pending.remove(name)
+
+                    if not running:
+                        continue
+
+                    done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        try:
+                            self.results[name] = future.result()
+                            finished.add(name)
+                        except Exception:
+                            failures[name] = traceback.format_exc()
+
+        if failures:
+            raise RuntimeError("Some tasks failed:\n" + '\n'.join(f"{name}: {error}" for name, error in failures.items()))
+
+        return self.results
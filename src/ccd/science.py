@@ -4,15 +4,90 @@
 # @Filename: science.py
 # @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
 
+from concurrent.futures import ProcessPoolExecutor
+import os
+import tempfile
+import traceback
+
 from astropy.io import fits
-from astroscrappy import detect_cosmics
+from cosmics import cosmic_ray_times, remove_cosmic_rays
+from frames import DEFAULT_TRIM, read_frame, write_frame
+import metrics
+from metrics import count_bytes, span
+import numpy
+
+# Arrays of a CalibrationContext that are saved to disk to share it with worker processes
+CALIBRATION_ARRAYS = ('median_bias', 'median_dark', 'flat_reciprocal')
+
+
+class CalibrationContext:
+    """Master bias, dark and flat frames loaded once to reduce many science frames.
+
+    - Reads the master frames from median_bias_filename, median_flat_filename and
+      median_dark_filename as float32.
+    - Precomputes the reciprocal of the flat, and the bias + exposure_time * dark term for each
+      exposure time it is asked for, so a frame is corrected with one subtraction and one
+      multiplication.
+
+    """
+
+    def __init__(self, median_bias_filename, median_flat_filename, median_dark_filename):
+
+        self.median_bias = fits.getdata(median_bias_filename).astype('f4')
+        self.median_dark = fits.getdata(median_dark_filename).astype('f4')
+        self.flat_reciprocal = (1 / fits.getdata(median_flat_filename)).astype('f4')
+        count_bytes(read=sum(os.path.getsize(filename) for filename in (median_bias_filename, median_dark_filename,
+                                                                         median_flat_filename)))
+
+        # bias + exposure_time * dark, for each exposure time seen so far
+        self.offsets = dict()
+
+    def save(self, directory):
+        "Saves the master frames as .npy files in directory, so other processes can memory-map them"
+
+        for name in CALIBRATION_ARRAYS:
+            numpy.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory):
+        "Loads a context saved with save, memory-mapping the master frames read-only"
+
+        calibration = cls.__new__(cls)
+        for name in CALIBRATION_ARRAYS:
+            setattr(calibration, name, numpy.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r'))
+        calibration.offsets = dict()
+
+        return calibration
+
+    def offset(self, exposure_time):
+        "Combined bias and dark frame for a science frame with the given exposure time"
+
+        if exposure_time not in self.offsets:
+            self.offsets[exposure_time] = self.median_bias + numpy.float32(exposure_time) * self.median_dark
+
+        return self.offsets[exposure_time]
+
+    def apply(self, science_data, exposure_time):
+        "Removes bias and dark and corrects by the flat a float32 science frame, in place"
+
+        science_data -= self.offset(exposure_time)
+        science_data *= self.flat_reciprocal
+
+        return science_data
+
 
 def reduce_science_frame(
     science_filename,
     median_bias_filename,
-    median_flat_filename,
-    median_dark_filename,
+    median_flat_filename=None,
+    median_dark_filename=None,
     reduced_science_filename="reduced_science.fits",
+    cosmic_rays='full',
+    cosmic_ray_options=None,
+    trim=DEFAULT_TRIM,
+    out=None,
+    output_format='fits',
+    quantize_level=None,
 ):
     """This function must:
 
@@ -34,34 +109,200 @@ def reduce_science_frame(
       reduced_science_filename.
     - Return the reduced science frame as a 2D numpy array.
 
+    A CalibrationContext can be passed instead of median_bias_filename (leaving the flat and
+    dark filenames out) to reuse master frames that have already been loaded, or a
+    library.CalibrationLibrary to use the masters in it that best match the science frame.
+
+    Cosmic rays are removed with cosmics.remove_cosmic_rays using the cosmic_rays mode ('off',
+    'full', 'tiled' or 'targets'), and cosmic_ray_options (a dictionary with the positions of the
+    targets, astroscrappy settings, ...) is passed on to it. trim is the section of the raw frame
+    that is kept (see frames.trim_section), and out a float32 buffer to read it into, which is
+    reused when reducing frames in a loop. With reduced_science_filename=None nothing is saved.
+
+    With output_format='compressed' the frame is saved tile-compressed (see frames.write_frame),
+    losslessly, or quantized to 1 / quantize_level of the noise if quantize_level is given.
+
     """
 
-    # Reads all the files and grabs their respective array
-    science = fits.open(science_filename)
-    JD = science[0].header['JD-OBS']
+    if isinstance(median_bias_filename, CalibrationContext):
+        calibration = median_bias_filename
+    elif hasattr(median_bias_filename, 'calibration_for'):
+        calibration = median_bias_filename.calibration_for(science_filename, trim)
+    else:
+        calibration = CalibrationContext(median_bias_filename, median_flat_filename, median_dark_filename)
+
+    reduced_science, header = reduce_science_data(science_filename, calibration, cosmic_rays, cosmic_ray_options,
+                                                  trim=trim, out=out)
+
+    # Create a new FITS file from the resulting reduced science frame.
+    if reduced_science_filename is not None:
+        with span('write'):
+            write_frame(reduced_science_filename, reduced_science, header, output_format, quantize_level)
+
+    return reduced_science
+
+
+def reduce_science_data(
+    science_filename,
+    calibration,
+    cosmic_rays='full',
+    cosmic_ray_options=None,
+    trim=DEFAULT_TRIM,
+    out=None,
+):
+    """Reduces a science frame with a CalibrationContext without writing it, as reduce_science_frame.
+
+    Only the trimmed section of the raw frame is read (see frames.read_frame), into out if a
+    preallocated float32 array is given. Returns the reduced science frame as a 2D float32 array
+    and the header it is saved with.
+
+    """
 
-    science_data = science[0].data[100:-100, 100:-100].astype('f4')
-    median_bias = fits.getdata(median_bias_filename)
-    median_flat = fits.getdata(median_flat_filename)
-    median_dark = fits.getdata(median_dark_filename)
+    # Reads the trimmed science frame as float32
+    with span('read'):
+        science_data, science_header = read_frame(science_filename, trim=trim, out=out)
+    JD = science_header['JD-OBS']
 
     # Exposure time of science to later use with median dark 
-    exposure_time = science[0].header['EXPTIME']
+    exposure_time = science_header['EXPTIME']
 
-    # Removes bias and dark frames, and corrects by dividing by flat frame
-    science_data -= median_bias 
-    science_data -= exposure_time * median_dark
-    science_data /= median_flat
+    # Removes bias and dark frames, and corrects by multiplying by the reciprocal of the flat frame
+    with span('calibrate'):
+        calibration.apply(science_data, exposure_time)
 
     # Removal of cosmic rays
-    mask, cleaned = detect_cosmics(science_data)
-    reduced_science = cleaned
+    with span('cosmic_rays'):
+        reduced_science = remove_cosmic_rays(science_data, mode=cosmic_rays, **(cosmic_ray_options or dict()))
 
-    # Create a new FITS file from the resulting reduced science frame.
-    science_hdu = fits.PrimaryHDU(data=reduced_science.data, header=fits.Header())
-    science_hdu.header['COMMENT'] = 'Reduced science image correcting from all 3 frames (bias, dark, and flat).'
-    science_hdu.header['JD-OBS'] = JD
-    hdul = fits.HDUList([science_hdu])
-    hdul.writeto(reduced_science_filename, overwrite=True)
+    header = fits.Header()
+    header['COMMENT'] = 'Reduced science image correcting from all 3 frames (bias, dark, and flat).'
+    header['JD-OBS'] = JD
+    header['EXPTIME'] = exposure_time
 
-    return reduced_science
+    return reduced_science, header
+
+
+# Calibration context of a worker process of reduce_science_frames, and the buffer it reads frames into
+_worker_calibration = None
+_worker_buffer = None
+
+
+def _init_worker(calibration_directory, record):
+    """Loads the shared master frames once in each worker process, and records spans of its own
+    (instead of writing to the main process' output) if the main process is recording"""
+
+    global _worker_calibration
+    _worker_calibration = CalibrationContext.load(calibration_directory)
+
+    metrics.disable()
+    if record:
+        metrics.enable()
+
+
+def _reduce_in_worker(task):
+    """Reduces one science frame in a worker, returning the error instead of raising it, the time
+    spent removing cosmic rays and the spans and bytes read and written (which are recorded in the
+    main process) and, if the frame isn't saved to a file, the reduced frame and its header"""
+
+    global _worker_buffer
+    science_filename, reduced_science_filename, cosmic_rays, cosmic_ray_options, trim, output_format, quantize_level = task
+    error = None
+    reduced = None
+
+    with span('frame', file=science_filename):
+        try:
+            if reduced_science_filename is None:
+                reduced = reduce_science_data(science_filename, _worker_calibration, cosmic_rays, cosmic_ray_options,
+                                              trim)
+            else:
+                _worker_buffer = reduce_science_frame(science_filename, _worker_calibration,
+                                                      reduced_science_filename=reduced_science_filename,
+                                                      cosmic_rays=cosmic_rays, cosmic_ray_options=cosmic_ray_options,
+                                                      trim=trim, out=_worker_buffer, output_format=output_format,
+                                                      quantize_level=quantize_level)
+        except Exception:
+            error = traceback.format_exc()
+
+    times = cosmic_ray_times[cosmic_rays]
+
+    return error, times.pop() if times else None, metrics.collect(), reduced
+
+
+def reduce_science_frames(
+    science_files,
+    calibration,
+    output_dir,
+    workers=1,
+    reduced_science_filenames=None,
+    cosmic_rays='full',
+    cosmic_ray_options=None,
+    trim=DEFAULT_TRIM,
+    cube=None,
+    output_format='fits',
+    quantize_level=None,
+):
+    """Reduces a list of science frames, optionally over a pool of worker processes.
+
+    - Accept a list of science frame filenames as science_files and a CalibrationContext.
+    - Save the frame science_files[i] as {output_dir}reduced_science{i+1}.fits (or as
+      reduced_science_filenames[i] if given), so the names don't depend on the order in which
+      the workers finish.
+    - With workers > 1, save the master frames once to a temporary directory and memory-map
+      them read-only in every worker instead of pickling them with each frame.
+    - If a cube.FrameCube is given as cube, append the frames to it in the order of science_files
+      instead of saving FITS files.
+    - Remove cosmic rays and trim the frames as in reduce_science_frame with cosmic_rays,
+      cosmic_ray_options and trim, reading every frame into the same buffer, and save them in
+      output_format (with quantize_level, see frames.write_frame).
+    - Return a dictionary {science_filename: traceback} of the frames that failed, without
+      stopping the rest of the batch.
+
+    """
+
+    if cube is not None:
+        reduced_science_filenames = [None] * len(science_files)
+    elif reduced_science_filenames is None:
+        reduced_science_filenames = [f"{output_dir}reduced_science{i+1}.fits" for i in range(len(science_files))]
+
+    tasks = [(science_filename, reduced_science_filename, cosmic_rays, cosmic_ray_options, trim, output_format,
+              quantize_level)
+             for science_filename, reduced_science_filename in zip(science_files, reduced_science_filenames)]
+    failures = dict()
+
+    if workers == 1:
+        buffer = None
+        for science_filename, reduced_science_filename, *_ in tasks:
+            with span('frame', file=science_filename):
+                try:
+                    if cube is not None:
+                        buffer, header = reduce_science_data(science_filename, calibration, cosmic_rays,
+                                                             cosmic_ray_options, trim, out=buffer)
+                        cube.append(buffer, header, science_filename)
+                    else:
+                        buffer = reduce_science_frame(science_filename, calibration,
+                                                      reduced_science_filename=reduced_science_filename,
+                                                      cosmic_rays=cosmic_rays, cosmic_ray_options=cosmic_ray_options,
+                                                      trim=trim, out=buffer, output_format=output_format,
+                                                      quantize_level=quantize_level)
+                except Exception:
+                    failures[science_filename] = traceback.format_exc()
+
+        return failures
+
+    with tempfile.TemporaryDirectory() as calibration_directory:
+        calibration.save(calibration_directory)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(calibration_directory, metrics.enabled())) as executor:
+            # map gives back the results in the order of the tasks, so the cube is in the right order
+            for (science_filename, *_), (error, seconds, records, reduced) in zip(tasks,
+                                                                                 executor.map(_reduce_in_worker, tasks)):
+                if error is not None:
+                    failures[science_filename] = error
+                if seconds is not None:
+                    cosmic_ray_times[cosmic_rays].append(seconds)
+                metrics.merge(*records)
+                if reduced is not None:
+                    cube.append(reduced[0], reduced[1], science_filename)
+
+    return failures
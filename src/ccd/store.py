@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: store.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import json
+import os
+import shutil
+
+from metrics import count_bytes
+import numpy
+
+# Name of the schema of a store, written after its columns
+SCHEMA_FILENAME = 'schema.json'
+
+# Name of the store the photometry of a night is saved to, in the output directory
+STORE_NAME = 'photometry'
+
+# Columns with one value per frame, and with one value per star and frame, of a photometry store
+FRAME_COLUMNS = {'JD-OBS': '<f8', 'TIME': '<f8', 'RATIO': '<f8', 'SOURCE': '<U256'}
+STAR_COLUMNS = {'FLUX': '<f8', 'RAW_FLUX': '<f8', 'SKY': '<f8', 'X': '<f8', 'Y': '<f8'}
+
+# Number of frames room is first made for in the star columns, which doubles every time it fills up
+INITIAL_CAPACITY = 64
+
+
+class PhotometryStore:
+    """Photometry of a night stored column by column in a directory, each column a raw binary
+    file that can be memory-mapped.
+
+    - schema.json describes the columns (name and dtype), the number of frames (rows), the
+      stars (id, x and y in the first frame) and any metadata such as the aperture radius.
+    - Frame columns (JD-OBS, TIME, SOURCE, ...) have one value per frame and are stored as
+      {column}.bin, appended to at the end.
+    - Star columns (FLUX, SKY, ...) have one value per star and frame and are stored star by
+      star, each star's values one after the other with room for capacity frames, so the light
+      curve of one star is a contiguous read. They are stored as {column}.{capacity}.bin, and
+      grow by copying them to new files with twice the capacity.
+    - append adds frames to every column and then rewrites the schema, so a store never lists a
+      frame that isn't completely written. Grown star columns only replace the old ones when the
+      schema with their capacity is written, so an interrupted append leaves the store as it was.
+
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        with open(os.path.join(path, SCHEMA_FILENAME)) as file:
+            self.schema = json.load(file)
+
+    @classmethod
+    def create(cls, path, star_ids, x_positions, y_positions, frame_columns=FRAME_COLUMNS, star_columns=STAR_COLUMNS,
+               **meta):
+        """Creates an empty store at path (replacing any that was there) for the stars with
+        star_ids at (x_positions, y_positions), with the given columns ({name: dtype}) and any
+        other metadata (e.g. radius=10)"""
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        schema = {
+            'rows': 0,
+            'capacity': 0,
+            'stars': {'id': [str(star_id) for star_id in star_ids], 'x': [float(x) for x in x_positions],
+                      'y': [float(y) for y in y_positions]},
+            'frame_columns': dict(frame_columns),
+            'star_columns': dict(star_columns),
+            'meta': meta,
+        }
+        for name in frame_columns:
+            open(os.path.join(path, f"{name}.bin"), 'wb').close()
+
+        store = cls.__new__(cls)
+        store.path = path
+        store.schema = schema
+        store._write_schema()
+
+        return store
+
+    def __len__(self):
+        return self.schema['rows']
+
+    @property
+    def n_stars(self):
+        return len(self.schema['stars']['id'])
+
+    @property
+    def star_ids(self):
+        return self.schema['stars']['id']
+
+    @property
+    def meta(self):
+        return self.schema['meta']
+
+    def _write_schema(self):
+        "Writes the schema through a temporary file, so it is always complete"
+
+        filename = os.path.join(self.path, SCHEMA_FILENAME)
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(self.schema, file, indent=2)
+        os.replace(filename + '.tmp', filename)
+
+    def _star_filename(self, name, capacity=None):
+        "File of star column name with room for capacity frames (by default, the capacity in the schema)"
+
+        return os.path.join(self.path, f"{name}.{capacity or self.schema['capacity']}.bin")
+
+    def _star_file(self, name, mode='r'):
+        "Memory map of star column name, as (stars, capacity)"
+
+        return numpy.memmap(self._star_filename(name), dtype=self.schema['star_columns'][name], mode=mode,
+                            shape=(self.n_stars, self.schema['capacity']))
+
+    def _grow(self, rows):
+        """Copies every star column to new files with room for rows frames, at least doubling the
+        capacity, and sets the capacity of the schema to it (without saving it)"""
+
+        capacity = max(self.schema['capacity'], INITIAL_CAPACITY)
+        while capacity < rows:
+            capacity *= 2
+
+        for name in self.schema['star_columns']:
+            grown = numpy.memmap(self._star_filename(name, capacity), dtype=self.schema['star_columns'][name],
+                                 mode='w+', shape=(self.n_stars, capacity))
+            if self.schema['capacity']:
+                grown[:, :len(self)] = self._star_file(name)[:, :len(self)]
+            grown.flush()
+            del grown
+
+        self.schema['capacity'] = capacity
+
+    def append(self, frame_values, star_values):
+        """Appends frames to the store.
+
+        - frame_values: {column: values} with one value per new frame for every frame column
+          (or a single value when appending one frame).
+        - star_values: {column: values} with a (new frames, stars) array for every star column
+          (or a single row of stars when appending one frame).
+
+        """
+
+        frame_values = {name: numpy.atleast_1d(numpy.asarray(values, dtype=self.schema['frame_columns'][name]))
+                        for name, values in frame_values.items()}
+        star_values = {name: numpy.atleast_2d(numpy.asarray(values, dtype=self.schema['star_columns'][name]))
+                       for name, values in star_values.items()}
+
+        if set(frame_values) != set(self.schema['frame_columns']) or set(star_values) != set(self.schema['star_columns']):
+            raise ValueError(f"append needs every column: {list(self.schema['frame_columns'])} and "
+                             f"{list(self.schema['star_columns'])}")
+
+        n_new = len(next(iter(frame_values.values())))
+        for name, values in star_values.items():
+            if values.shape != (n_new, self.n_stars):
+                raise ValueError(f"{name} has shape {values.shape}, not ({n_new}, {self.n_stars})")
+
+        start = len(self)
+        previous_capacity = self.schema['capacity']
+        if start + n_new > previous_capacity:
+            self._grow(start + n_new)
+
+        for name, values in frame_values.items():
+            # Starts from the rows in the schema, dropping anything an interrupted append left
+            with open(os.path.join(self.path, f"{name}.bin"), 'r+b') as file:
+                file.truncate(start * values.itemsize)
+                file.seek(0, os.SEEK_END)
+                values.tofile(file)
+            count_bytes(written=values.nbytes)
+
+        for name, values in star_values.items():
+            column = self._star_file(name, 'r+')
+            column[:, start:start + n_new] = values.T
+            column.flush()
+            count_bytes(written=values.nbytes)
+
+        self.schema['rows'] = start + n_new
+        self._write_schema()
+
+        # The schema now points to the grown star columns, so the old ones can go
+        if previous_capacity and previous_capacity != self.schema['capacity']:
+            for name in self.schema['star_columns']:
+                os.remove(self._star_filename(name, previous_capacity))
+
+    def column(self, name):
+        "Frame column name, as a read-only memory map of one value per frame"
+
+        if name not in self.schema['frame_columns']:
+            raise KeyError(f"{name} isn't a frame column of {self.path}")
+        if len(self) == 0:
+            return numpy.empty(0, dtype=self.schema['frame_columns'][name])
+
+        return numpy.memmap(os.path.join(self.path, f"{name}.bin"), dtype=self.schema['frame_columns'][name],
+                            mode='r', shape=(len(self),))
+
+    def star(self, name, star):
+        """Values of star column name for one star (its index, or its id as a string) in every
+        frame, as a read-only memory map of that star's values only"""
+
+        if name not in self.schema['star_columns']:
+            raise KeyError(f"{name} isn't a star column of {self.path}")
+        if isinstance(star, str):
+            star = self.star_ids.index(star)
+        if len(self) == 0:
+            return numpy.empty(0, dtype=self.schema['star_columns'][name])
+
+        # Each star's values start capacity values apart, so only this one's are mapped
+        dtype = numpy.dtype(self.schema['star_columns'][name])
+        return numpy.memmap(self._star_filename(name), dtype=dtype, mode='r', shape=(len(self),),
+                            offset=star * self.schema['capacity'] * dtype.itemsize)
+
+    def matrix(self, name):
+        "Star column name as a (frames, stars) read-only array"
+
+        if len(self) == 0:
+            return numpy.empty((0, self.n_stars), dtype=self.schema['star_columns'][name])
+
+        return self._star_file(name)[:, :len(self)].T
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: watch.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import glob
+import os
+import time
+import traceback
+
+from astropy.io import fits
+from cache import BuildCache
+from frames import DEFAULT_TRIM
+import numpy
+from pipeline import measure_frame
+from registration import Registration
+from cosmics import remove_cosmic_rays
+from science import CalibrationContext, reduce_science_data
+from store import SCHEMA_FILENAME, STORE_NAME, PhotometryStore
+
+# FITS files are written in blocks of this many bytes, so a complete file is a multiple of it
+FITS_BLOCK = 2880
+
+
+def is_complete(filename, previous_size):
+    """Whether a file that is being written looks complete: its size hasn't changed since the
+    last poll (previous_size) and is a whole number of FITS blocks"""
+
+    size = os.path.getsize(filename)
+
+    return size == previous_size and size > 0 and size % FITS_BLOCK == 0
+
+
+class LightCurveWatcher:
+    """Reduces science frames as they arrive and adds their photometry to a light curve.
+
+    - Accept the night's data_dir, where the master frames (made with 'ccd masters' or
+      run_reduction) must already be, and the positions of the target and the comparison
+      objects in the first frame, as in pipeline.extract_light_curve.
+    - Each frame is calibrated in memory with the cached masters, registered against the first
+      frame (binning with the median, since its cosmic rays are still there), cleaned of cosmic
+      rays with cosmic_rays ('targets' by default, which only cleans around the objects where
+      they are in this frame) and measured with pipeline.measure_frame.
+    - Each frame (JD-OBS, minutes after the first frame, flux ratio, the raw file, and the
+      fluxes, sky and positions of the objects) is appended to the store.PhotometryStore in
+      {data_dir}photometry, so the light curve can be looked at while observing. Restarting
+      resumes from the store.
+
+    """
+
+    def __init__(
+        self,
+        data_dir,
+        x_positions,
+        y_positions,
+        radii=(10,),
+        sky_radius_in=18,
+        sky_annulus_width=4,
+        box_size=35,
+        cosmic_rays='targets',
+        trim=DEFAULT_TRIM,
+        write_reduced=False,
+    ):
+
+        self.data_dir = data_dir
+        self.x_positions = numpy.asarray(x_positions, dtype='f8')
+        self.y_positions = numpy.asarray(y_positions, dtype='f8')
+        self.photometry_options = dict(radii=radii, sky_radius_in=sky_radius_in, sky_annulus_width=sky_annulus_width,
+                                       box_size=box_size)
+        self.cosmic_rays = cosmic_rays
+        self.trim = trim
+        self.write_reduced = write_reduced
+
+        masters = [data_dir + 'Median-Bias.fits', data_dir + 'Median-AutoFlat.fits', data_dir + 'Median-Dark.fits']
+        for filename in masters:
+            if not os.path.exists(filename):
+                raise FileNotFoundError(f"{filename} doesn't exist, make the masters first (ccd masters {data_dir})")
+        self.calibration = CalibrationContext(*masters)
+
+        # Uses the gain and readout noise measured by run_reduction, if there are any
+        self.cosmic_ray_options = dict()
+        cache = BuildCache(data_dir)
+        if 'ptc' in cache.manifest:
+            gain, readout_noise = cache.values('ptc')
+            self.cosmic_ray_options = {'gain': gain, 'readnoise': readout_noise}
+
+        if os.path.exists(os.path.join(data_dir + STORE_NAME, SCHEMA_FILENAME)):
+            self.store = PhotometryStore(data_dir + STORE_NAME)
+        else:
+            self.store = PhotometryStore.create(data_dir + STORE_NAME, range(len(self.x_positions)), self.x_positions,
+                                                self.y_positions, radius=radii[0], sky_radius_in=sky_radius_in,
+                                                sky_annulus_width=sky_annulus_width)
+
+        self.processed = set(self.store.column('SOURCE'))
+        self.registration = None
+        self.sizes = dict()
+
+    def _calibrate(self, science_filename):
+        "Calibrated frame and its header, with the cosmic rays still in it"
+
+        return reduce_science_data(science_filename, self.calibration, 'off', trim=self.trim)
+
+    def _start_registration(self, data):
+        """Registers against the first frame of the light curve, which is calibrated again when
+        resuming, or against data if it is the first frame"""
+
+        if len(self.store):
+            data, header = self._calibrate(str(self.store.column('SOURCE')[0]))
+        self.registration = Registration(data, statistic='median')
+
+    def process(self, science_filename):
+        "Reduces and measures one frame, appends it to the light curve and returns its flux ratio"
+
+        data, header = self._calibrate(science_filename)
+        if self.registration is None:
+            self._start_registration(data)
+        dx, dy = self.registration.shift(data)
+
+        # Only the neighbourhood of the objects needs cleaning, where they are in this frame
+        options = self.cosmic_ray_options
+        if self.cosmic_rays == 'targets':
+            options = {'positions': list(zip(self.x_positions + dx, self.y_positions + dy)), **options}
+        data = remove_cosmic_rays(data, mode=self.cosmic_rays, **options)
+
+        if self.write_reduced:
+            reduced_filename = f"{self.data_dir}reduced_science{len(self.store) + 1}.fits"
+            fits.PrimaryHDU(data=data, header=header).writeto(reduced_filename, overwrite=True)
+
+        result = measure_frame(data, self.x_positions + dx, self.y_positions + dy, **self.photometry_options)
+        ratio = result.fluxes[0, 0] / numpy.mean(result.fluxes[1:, 0])
+
+        first_jd = self.store.column('JD-OBS')[0] if len(self.store) else header['JD-OBS']
+        positions = numpy.array(result.positions)
+        self.store.append({'JD-OBS': header['JD-OBS'], 'TIME': (header['JD-OBS'] - first_jd) * 24 * 60, 'RATIO': ratio,
+                           'SOURCE': science_filename},
+                          {'FLUX': result.fluxes[:, 0], 'RAW_FLUX': result.raw_fluxes[:, 0], 'SKY': result.sky,
+                           'X': positions[:, 0], 'Y': positions[:, 1]})
+        self.processed.add(science_filename)
+
+        return ratio
+
+    def poll(self):
+        """Processes the new science frames that are complete (see is_complete), in the order of
+        their names. Returns the list of (filename, ratio, seconds) of the frames processed."""
+
+        processed = []
+
+        for science_filename in sorted(glob.glob(self.data_dir + "LPSEB*")):
+            if science_filename in self.processed:
+                continue
+
+            # A frame is only read once its size is the same on two polls in a row
+            previous_size = self.sizes.get(science_filename)
+            self.sizes[science_filename] = os.path.getsize(science_filename)
+            if not is_complete(science_filename, previous_size):
+                continue
+
+            # A frame that can't be reduced or measured is reported and skipped, so it doesn't stop the night
+            start = time.perf_counter()
+            try:
+                ratio = self.process(science_filename)
+            except Exception:
+                traceback.print_exc()
+                self.processed.add(science_filename)
+                continue
+            processed.append((science_filename, ratio, time.perf_counter() - start))
+
+        return processed
+
+    def watch(self, poll_interval=2, timeout=None):
+        """Polls data_dir every poll_interval seconds, printing each new point and how long it
+        took, until timeout seconds pass without new frames (forever if None) or Ctrl-C"""
+
+        last_frame = time.monotonic()
+
+        try:
+            while timeout is None or time.monotonic() - last_frame < timeout:
+                for science_filename, ratio, seconds in self.poll():
+                    last_frame = time.monotonic()
+                    print(f"{os.path.basename(science_filename)}: t = {self.store.column('TIME')[-1]:.2f} min, "
+                          f"ratio = {ratio:.4f} ({seconds:.2f} s)")
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+
+        return self.store
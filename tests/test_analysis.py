@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_analysis.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from analysis import is_regular_grid, search_periods
+import numpy
+
+
+def sinusoid(period=37, points=500):
+    rng = numpy.random.default_rng(0)
+    times = numpy.sort(rng.uniform(0, 600, points))
+    return times, 1 + 0.1 * numpy.sin(2 * numpy.pi * times / period) + rng.normal(0, 0.01, points)
+
+
+def test_irregular_grid_is_used_as_given():
+    times, fluxes = sinusoid()
+    frequency = numpy.geomspace(1 / 200, 1 / 5, 2000)
+    assert not is_regular_grid(frequency)
+
+    fast = search_periods([(times, fluxes)], method='fast', frequency=frequency)[0]
+    exact = search_periods([(times, fluxes)], method='exact', frequency=frequency)[0]
+
+    numpy.testing.assert_allclose(fast.power, exact.power)
+    assert abs(fast.period - 37) < 0.5
+
+
+def test_regular_grid_uses_the_fast_method():
+    times, fluxes = sinusoid()
+    frequency = numpy.linspace(1 / 200, 1 / 5, 2000)
+    assert is_regular_grid(frequency)
+
+    fast = search_periods([(times, fluxes)], method='fast', frequency=frequency)[0]
+    assert abs(fast.period - 37) < 0.5
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_cache.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from cache import BuildCache
+
+
+def test_record_from_many_threads(tmp_path):
+    cache = BuildCache(str(tmp_path))
+
+    def record(i):
+        cache.record(f'stage{i % 10}', str(i), values=[i])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(record, range(600)))
+
+    manifest = BuildCache(str(tmp_path)).manifest
+    assert sorted(manifest) == sorted(f'stage{i}' for i in range(10))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_record_without_saving(tmp_path):
+    cache = BuildCache(str(tmp_path))
+    cache.record('bias', 'a')
+    for i in range(5):
+        cache.record(f'science:{i}', str(i), save=False)
+
+    assert sorted(BuildCache(str(tmp_path)).manifest) == ['bias']
+
+    cache.save()
+    assert len(BuildCache(str(tmp_path)).manifest) == 6
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_combine.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from astropy.io import fits
+import numpy
+import pytest
+
+from combine import clipped_mean, combine_frames, compare_kernels
+
+# Removes TRIM pixels from each edge of the frames
+TRIM = 4
+
+
+@pytest.fixture
+def stack():
+    "Fixed stack of 9 frames, with cosmic rays in one of them and NaNs in another"
+
+    rng = numpy.random.default_rng(0)
+    stack = rng.normal(100, 5, (9, 40, 50)).astype('f4')
+    stack[3, ::7, ::5] += 500
+    stack[5, ::11, ::3] = numpy.nan
+
+    return stack
+
+
+@pytest.fixture
+def stack_files(stack, tmp_path):
+    filenames = []
+    for i, frame in enumerate(stack):
+        filenames.append(str(tmp_path / f'frame{i}.fits'))
+        fits.writeto(filenames[-1], frame)
+
+    return filenames
+
+
+@pytest.mark.filterwarnings('ignore::astropy.utils.exceptions.AstropyUserWarning')
+def test_fast_kernel_matches_astropy(stack):
+    reference = clipped_mean(stack, method='astropy')
+
+    assert numpy.allclose(clipped_mean(stack, method='fast'), reference, rtol=1e-6, atol=0)
+    assert compare_kernels(stack, method='fast') < 1e-4
+
+
+@pytest.mark.filterwarnings('ignore::astropy.utils.exceptions.AstropyUserWarning')
+def test_single_pass_kernel_removes_outliers(stack):
+    # It clips around the MAD instead, so it only agrees with astropy within the noise of the mean
+    result = clipped_mean(stack, method='single-pass')
+
+    assert numpy.all(numpy.isfinite(result))
+    assert numpy.abs(result - 100).max() < 3 * 5
+    assert compare_kernels(stack, method='single-pass') < 5
+
+
+@pytest.mark.filterwarnings('ignore::astropy.utils.exceptions.AstropyUserWarning')
+@pytest.mark.parametrize('method', ['astropy', 'fast'])
+def test_tiles_and_workers_give_the_same_master(stack, stack_files, method):
+    reference = clipped_mean(stack[:, TRIM:-TRIM, TRIM:-TRIM], method='astropy')
+    whole = combine_frames(stack_files, trim=TRIM, method=method)
+
+    # A few rows per tile, with one and with several workers
+    memory_limit = 9 * 42 * 8 * 6 * 5
+    tiled = combine_frames(stack_files, trim=TRIM, method=method, memory_limit=memory_limit)
+    parallel = combine_frames(stack_files, trim=TRIM, method=method, memory_limit=memory_limit, workers=3)
+
+    assert numpy.allclose(whole, reference, rtol=1e-6, atol=0)
+    assert numpy.array_equal(tiled, whole)
+    assert numpy.array_equal(parallel, whole)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_cube.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import numpy
+import pytest
+
+from cube import FrameCube
+
+
+def test_empty_cube(tmp_path):
+    cube = FrameCube.create(str(tmp_path / 'cube'))
+
+    assert len(cube) == 0
+    assert cube.shape == (0, 0)
+    assert cube.frames.shape == (0, 0, 0)
+    assert list(cube.stream()) == []
+
+
+def test_append_and_reopen(tmp_path):
+    cube = FrameCube.create(str(tmp_path / 'cube'))
+    for i in range(4):
+        cube.append(numpy.full((3, 5), i, dtype='f4'), {'JD-OBS': 2460000.5 + i, 'EXPTIME': 30}, f'raw, "{i}".fits')
+
+    with pytest.raises(ValueError):
+        cube.append(numpy.zeros((5, 3)), {})
+
+    cube = FrameCube(str(tmp_path / 'cube'))
+    assert len(cube) == 4
+    assert cube.shape == (3, 5)
+    assert list(cube.frames[:, 1, 2]) == [0, 1, 2, 3]
+    assert list(cube.table['SOURCE']) == [f'raw, "{i}".fits' for i in range(4)]
+    assert [row['JD-OBS'] for i, frame, row in cube.stream()] == [2460000.5 + i for i in range(4)]
+    assert cube.stamp(2, 2, 1, 1).shape == (3, 3)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_eclipsing.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import numpy
+import pytest
+
+from eclipsing import period_grid, search_eclipses
+
+
+def eclipse(phase, center, depth, duration):
+    "Parabolic dip of depth and duration (fractions of the period) centred on center"
+
+    offset = (phase - center + 0.5) % 1 - 0.5
+
+    return depth * numpy.clip(1 - (offset / (duration / 2))**2, 0, None)
+
+
+def light_curve(period, primary_depth, secondary_depth, duration):
+    rng = numpy.random.default_rng(1)
+    times = numpy.sort(rng.uniform(0, 20, 3000))
+    phase = (times / period) % 1
+    fluxes = (1 - eclipse(phase, 0, primary_depth, duration) - eclipse(phase, 0.5, secondary_depth, duration)
+              + rng.normal(0, 0.005, len(times)))
+
+    return times, fluxes
+
+
+def test_one_eclipse_per_cycle():
+    times, fluxes = light_curve(1.0, 0.3, 0, 0.08)
+    solution = search_eclipses(times, fluxes, period_grid(times, 0.3, 3))
+
+    assert solution.period == pytest.approx(1.0, abs=0.01)
+    assert solution.primary_depth == pytest.approx(0.3, abs=0.01)
+    assert not solution.secondary_detected
+
+
+def test_unequal_eclipses():
+    times, fluxes = light_curve(2.0, 0.3, 0.1, 0.04)
+    solution = search_eclipses(times, fluxes, period_grid(times, 0.3, 3))
+
+    assert solution.period == pytest.approx(2.0, abs=0.01)
+    assert solution.secondary_detected
+    assert solution.secondary_phase == pytest.approx(0.5, abs=0.01)
+    assert solution.secondary_depth == pytest.approx(0.1, abs=0.01)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_metrics.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+def test_count_bytes_from_many_threads():
+    metrics.enable()
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: [metrics.count_bytes(read=1, written=2) for _ in range(1000)], range(8)))
+        recorder = metrics._recorder
+        assert (recorder.bytes_read, recorder.bytes_written) == (8000, 16000)
+    finally:
+        metrics.disable()
+
+
+def test_merge_worker_records():
+    # What a worker process records, taken out of its Recorder
+    metrics.enable()
+    with metrics.span('frame'):
+        metrics.count_bytes(read=10, written=20)
+    records = metrics.collect()
+    metrics.disable()
+    assert records[1:] == (10, 20)
+
+    recorder = metrics.enable()
+    try:
+        with metrics.span('science'):
+            metrics.merge(*records)
+        assert [record['span'] for record in recorder.spans] == ['science/frame', 'science']
+        assert recorder.spans[-1]['bytes_read'] == 10
+        assert (recorder.bytes_read, recorder.bytes_written) == (10, 20)
+    finally:
+        metrics.disable()
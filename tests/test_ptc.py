@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_ptc.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+from astropy.io import fits
+import numpy
+
+from ptc import measure_ptc
+
+GAIN = 2.0
+READOUT_NOISE = 10.0
+
+
+def test_measure_ptc_recovers_gain_and_readout_noise(tmp_path):
+    rng = numpy.random.default_rng(0)
+    shape = (400, 400)
+    flat_field = 1 + 0.05 * rng.normal(size=shape)
+
+    def write(name, electrons, exposure_time):
+        data = 500 + rng.poisson(electrons) / GAIN + rng.normal(0, READOUT_NOISE / GAIN, shape)
+        fits.writeto(tmp_path / name, data.astype('f4'), fits.Header({'EXPTIME': exposure_time}))
+        return str(tmp_path / name)
+
+    flat_files = [write(f'flat{level}-{i}.fits', level * flat_field, level / 1000)
+                  for level in (2000, 8000, 20000, 40000) for i in range(2)]
+    bias_files = [write(f'bias{i}.fits', numpy.zeros(shape), 0) for i in range(4)]
+
+    result = measure_ptc(flat_files, bias_files, trim=8)
+
+    assert abs(result.gain - GAIN) < 3 * result.gain_error
+    assert abs(result.readout_noise - READOUT_NOISE) < 3 * result.readout_noise_error
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_scheduler.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import pytest
+from scheduler import TaskGraph
+
+
+def make_graph(tmp_path, fail=()):
+    "bias -> dark -> flat through files, and gain -> readout_noise through after"
+
+    bias, dark, flat = (str(tmp_path / name) for name in ('bias', 'dark', 'flat'))
+    ran = []
+
+    def task(name, outputs=()):
+        def function():
+            ran.append(name)
+            if name in fail:
+                raise RuntimeError(f"{name} failed")
+            for output in outputs:
+                open(output, 'w').close()
+            return name
+        return function
+
+    graph = TaskGraph()
+    graph.add('flat', task('flat', [flat]), inputs=[bias, dark], outputs=[flat])
+    graph.add('dark', task('dark', [dark]), inputs=[bias], outputs=[dark])
+    graph.add('bias', task('bias', [bias]), outputs=[bias])
+    graph.add('gain', task('gain'))
+    graph.add('readout_noise', task('readout_noise'), after=['gain'])
+
+    return graph, ran
+
+
+def test_dependencies_from_files_and_after(tmp_path):
+    graph, ran = make_graph(tmp_path)
+
+    assert graph.dependencies() == {'flat': {'bias', 'dark'}, 'dark': {'bias'}, 'bias': set(), 'gain': set(),
+                                    'readout_noise': {'gain'}}
+    assert graph.levels() == [['bias', 'gain'], ['dark', 'readout_noise'], ['flat']]
+
+
+def test_missing_input_and_unknown_task(tmp_path):
+    graph = TaskGraph()
+    graph.add('dark', lambda: None, inputs=[str(tmp_path / 'missing')])
+    with pytest.raises(ValueError, match='no task writes'):
+        graph.dependencies()
+
+    graph = TaskGraph()
+    graph.add('dark', lambda: None, after=['bias'])
+    with pytest.raises(ValueError, match='unknown'):
+        graph.dependencies()
+
+
+def test_cycle(tmp_path):
+    graph = TaskGraph()
+    graph.add('a', lambda: None, after=['b'])
+    graph.add('b', lambda: None, after=['a'])
+
+    with pytest.raises(ValueError, match='cycle'):
+        graph.levels()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_run_in_order(tmp_path, workers):
+    graph, ran = make_graph(tmp_path)
+    results = graph.run(workers=workers)
+
+    assert results == {name: name for name in ('bias', 'dark', 'flat', 'gain', 'readout_noise')}
+    assert ran.index('bias') < ran.index('dark') < ran.index('flat')
+    assert ran.index('gain') < ran.index('readout_noise')
+
+
+def test_skipped_tasks_count_as_done(tmp_path):
+    graph, ran = make_graph(tmp_path)
+    graph.tasks['gain'].skip = True
+    graph.run()
+
+    assert 'gain' not in ran and 'readout_noise' in ran
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_failure_stops_only_dependent_tasks(tmp_path, workers):
+    graph, ran = make_graph(tmp_path, fail=['dark'])
+
+    with pytest.raises(RuntimeError) as error:
+        graph.run(workers=workers)
+
+    assert 'dark: ' in str(error.value) and 'flat: a task it depends on failed' in str(error.value)
+    assert 'flat' not in ran
+    assert {'bias', 'gain', 'readout_noise'} <= set(ran)
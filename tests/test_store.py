@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @Filename: test_store.py
+# @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
+
+import numpy
+import pytest
+from store import INITIAL_CAPACITY, PhotometryStore
+
+
+def make_frames(start, n_frames, n_stars=3):
+    "Frame and star values where every value tells its frame and star apart"
+
+    frames = numpy.arange(start, start + n_frames)
+    frame_values = {'JD-OBS': 2460000 + frames, 'TIME': frames * 1.0, 'RATIO': frames / 10,
+                    'SOURCE': [f"LPSEB{i:03d}.fits" for i in frames]}
+    flux = frames[:, numpy.newaxis] * 100.0 + numpy.arange(n_stars)
+    star_values = {'FLUX': flux, 'RAW_FLUX': flux + 1, 'SKY': flux + 2, 'X': flux + 3, 'Y': flux + 4}
+
+    return frame_values, star_values
+
+
+def test_append_and_read(tmp_path):
+    path = str(tmp_path / 'photometry')
+    store = PhotometryStore.create(path, ['a', 'b', 'c'], [1, 2, 3], [4, 5, 6], radius=10)
+    store.append(*make_frames(0, 1))
+    store.append(*make_frames(1, 4))
+
+    store = PhotometryStore(path)
+    assert len(store) == 5 and store.star_ids == ['a', 'b', 'c'] and store.meta == {'radius': 10}
+    numpy.testing.assert_array_equal(store.column('TIME'), numpy.arange(5))
+    assert store.column('SOURCE')[-1] == 'LPSEB004.fits'
+    numpy.testing.assert_array_equal(store.star('FLUX', 'b'), numpy.arange(5) * 100 + 1)
+    numpy.testing.assert_array_equal(store.matrix('SKY'), make_frames(0, 5)[1]['SKY'])
+
+
+def test_grow_keeps_every_star(tmp_path):
+    path = str(tmp_path / 'photometry')
+    store = PhotometryStore.create(path, range(3), [1, 2, 3], [4, 5, 6])
+    for start in range(0, 3 * INITIAL_CAPACITY, 10):
+        store.append(*make_frames(start, 10))
+
+    store = PhotometryStore(path)
+    n_frames = len(store)
+    assert store.schema['capacity'] >= n_frames
+    for star in range(3):
+        numpy.testing.assert_array_equal(store.star('FLUX', star), numpy.arange(n_frames) * 100 + star)
+    assert sorted(name for name in (tmp_path / 'photometry').iterdir() if name.name.startswith('FLUX.')) == \
+        [tmp_path / 'photometry' / f"FLUX.{store.schema['capacity']}.bin"]
+
+
+def test_interrupted_append_leaves_the_store_as_it_was(tmp_path, monkeypatch):
+    path = str(tmp_path / 'photometry')
+    store = PhotometryStore.create(path, range(3), [1, 2, 3], [4, 5, 6])
+    store.append(*make_frames(0, INITIAL_CAPACITY))
+
+    # The next append grows the star columns, and is interrupted before the schema is written
+    def interrupted():
+        raise KeyboardInterrupt
+    monkeypatch.setattr(store, '_write_schema', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        store.append(*make_frames(INITIAL_CAPACITY, 1))
+
+    store = PhotometryStore(path)
+    assert len(store) == INITIAL_CAPACITY
+    for star in range(3):
+        numpy.testing.assert_array_equal(store.star('FLUX', star), numpy.arange(INITIAL_CAPACITY) * 100 + star)
+
+    # Resuming appends after the frames in the schema
+    store.append(*make_frames(INITIAL_CAPACITY, 2))
+    numpy.testing.assert_array_equal(store.column('TIME'), numpy.arange(INITIAL_CAPACITY + 2))
+    numpy.testing.assert_array_equal(store.star('FLUX', 2), numpy.arange(INITIAL_CAPACITY + 2) * 100 + 2)
+
+
+def test_append_needs_every_column(tmp_path):
+    store = PhotometryStore.create(str(tmp_path / 'photometry'), range(3), [1, 2, 3], [4, 5, 6])
+    frame_values, star_values = make_frames(0, 1)
+    del star_values['SKY']
+
+    with pytest.raises(ValueError):
+        store.append(frame_values, star_values)